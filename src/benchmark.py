@@ -0,0 +1,119 @@
+""" benchmark:
+    Time the stages of the analysis (see pipeline.py) on synthetic incidents at several scales (see synthetic.py)
+    - stages: chi2, initial_factor_values, transform, model, factor_values, counterfactual, all_incidents_model,
+      all_incidents_counterfactual, report_data and render
+    - every scale is run 'repeats' times: the minimum wall time of the repeats is the time of a stage (the least disturbed run)
+    - the results are appended to a csv file and compared with the previous run at the same scale: a stage is reported as a regression
+      when its minimum takes more than 'threshold' times as long as the previous minimum and is slower than the slowest previous repeat
+      (timing noise of a single run is not reported)
+
+    to run: python benchmark.py --scales 1 10 100
+Input:
+    - csv files in the data folder (distributions of the synthetic incidents)
+Output:
+    - benchmarks/results.csv: wall time, CPU time, peak memory per run, scale and stage
+"""
+import argparse
+import subprocess
+import tempfile
+import pandas as pd
+from datetime import datetime
+from pathlib import Path
+
+from pipeline import analyse_incidents, analyse_all_incidents, write_reports
+from profiler import create_profiler, stage, measure, profile_frame
+from synthetic import synthetic_incidents
+
+def git_commit(path):
+    """ short hash of the checked out commit (empty when not available) """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=path, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def run_benchmark(data_dir, scale, hierarchy_scale=1, seed=0, output_dir=None, fmt="png", dpi=300, n_jobs=-1):
+    """ run the analysis and the reports on synthetic incidents
+    Input: data folder, scale (multiple of the incidents in the data folder), hierarchy_scale (multiple of the groups and applications),
+           seed, folder of the reports (a temporary folder when not provided), format, resolution and processes of the reports
+    Returns: dataframe with a row per stage (see profiler.profile_frame)
+    """
+    profiler = create_profiler()
+    with stage(profiler, "generate") as record:
+        df_incidents = synthetic_incidents(data_dir / "incident_tickets.csv", scale, hierarchy_scale, seed)
+        df_all_incidents = synthetic_incidents(data_dir / "all_incidents.csv", scale, 1, seed)
+        measure(record, df_incidents=df_incidents, df_all_incidents=df_all_incidents)
+
+    artifacts = analyse_incidents(df_incidents, None, profiler)
+    artifacts.update(analyse_all_incidents(df_all_incidents, None, profiler))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_reports(artifacts, Path(output_dir or tmp_dir), fmt=fmt, dpi=dpi, n_jobs=n_jobs, profiler=profiler)
+
+    df_profile = profile_frame(profiler)
+    df_profile.insert(0, 'scale', scale)
+    df_profile.insert(1, 'hierarchy_scale', hierarchy_scale)
+    df_profile.insert(2, 'incidents', len(df_incidents))
+    df_profile.insert(3, 'all_incidents', len(df_all_incidents))
+    return df_profile
+
+def stage_times(df_run, keys):
+    """ minimum and maximum wall time of every stage over the repeats of a run """
+    return df_run.groupby(keys, sort=False)['wall_s'].agg(wall_s='min', wall_max_s='max').reset_index()
+
+def compare_with_previous(df_results, df_run, threshold=1.2, min_seconds=0.1):
+    """ compare the wall time of every stage with the previous run at the same scale
+        a stage is a regression when its minimum wall time is more than threshold times the previous minimum
+        and more than min_seconds above the previous maximum (the spread of the repeats is the timing noise)
+    Input: previous results, results of this run (a row per repeat and stage), threshold (ratio of the minimum wall times),
+           min_seconds: smaller increases of the wall time are not reported (timing noise of the short stages)
+    Returns: dataframe with the minimum wall times of both runs, the previous maximum, their ratio and a regression flag
+    """
+    keys = ['scale', 'hierarchy_scale', 'stage']
+    df_previous = df_results.merge(df_run[['scale', 'hierarchy_scale']].drop_duplicates())
+    if len(df_previous) == 0:
+        return pd.DataFrame()
+    df_previous = df_previous[df_previous['run'] == df_previous['run'].max()]
+    df_compare = pd.merge(stage_times(df_previous, keys), stage_times(df_run, keys)[keys + ['wall_s']], on=keys, suffixes=('_previous', ''))
+    df_compare = df_compare.rename(columns={'wall_max_s': 'wall_max_s_previous'})
+    df_compare['ratio'] = (df_compare['wall_s'] / df_compare['wall_s_previous']).round(2)
+    df_compare['regression'] = (df_compare['ratio'] > threshold) & (df_compare['wall_s'] - df_compare['wall_max_s_previous'] > min_seconds)
+    return df_compare
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of the analysis on synthetic incidents", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10], help="number of incidents as multiples of the incidents in the data folder")
+    parser.add_argument('--hierarchy-scale', type=int, default=1, help="number of groups and applications as a multiple of those in the data folder")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+    parser.add_argument('--dpi', type=int, default=300, help="resolution of the graphs")
+    parser.add_argument('--jobs', type=int, default=-1, help="number of processes that render the Excel files and graphs (-1: one per CPU)")
+    parser.add_argument('--repeats', type=int, default=3, help="number of runs per scale (the minimum wall time of a stage is compared)")
+    parser.add_argument('--threshold', type=float, default=1.2, help="report stages that take more than threshold times as long as in the previous run")
+    parser.add_argument('--min-seconds', type=float, default=0.1, help="do not report increases of the wall time below this number of seconds")
+    parser.add_argument('--results', default=None, help="csv file to which the results are appended (default: benchmarks/results.csv)")
+    args = parser.parse_args()
+
+    project_path = Path(__file__).parent.parent
+    results_file = Path(args.results) if args.results else project_path / "benchmarks" / "results.csv"
+    results_file.parent.mkdir(exist_ok=True)
+    df_results = pd.read_csv(results_file) if results_file.exists() else None
+
+    run = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    runs = []
+    for scale in args.scales:
+        print(f"Benchmark at scale {scale}")
+        df_run = pd.concat([run_benchmark(project_path / "data", scale, args.hierarchy_scale, args.seed, dpi=args.dpi, n_jobs=args.jobs)
+                            .assign(repeat=repeat) for repeat in range(args.repeats)], ignore_index=True)
+        df_run.insert(0, 'run', run)
+        df_run.insert(1, 'commit', git_commit(project_path))
+
+        df_compare = compare_with_previous(df_results, df_run, args.threshold, args.min_seconds) if df_results is not None else pd.DataFrame()
+        if len(df_compare) > 0:
+            print(df_compare.to_string(index=False))
+            if df_compare['regression'].any():
+                print("Regression in:", ", ".join(df_compare.loc[df_compare['regression'], 'stage']))
+        runs.append(df_run)
+
+    df_results = pd.concat(([df_results] if df_results is not None else []) + runs, ignore_index=True)
+    df_results.to_csv(results_file, index=False)
+    print("Results written to", results_file)
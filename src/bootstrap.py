@@ -0,0 +1,165 @@
+""" bootstrap:
+    Confidence intervals of the predicted dissatisfaction deltas (see counterfactual.py)
+    - every replicate refits the decision tree with the selected hyperparameters (no new search) on a bootstrap sample of the incidents
+      (drawn with replacement) and evaluates the interventions on all incidents with the flattened tree (see flat_tree.predict_overrides)
+    - per replicate only sums are kept: the delta sum per intervention and, per company, group and application,
+      the sums of the predicted dissatisfaction and of the deltas that are reported
+    - the replicates run in a process pool, in rounds of one replicate per process: no new round is started
+      when it would not finish within the time budget
+    - percentile intervals: the (1-confidence)/2 and (1+confidence)/2 percentiles of the replicates
+Input:
+    - fitted model, X and y of the model, interventions (column number and value), company / group / application per incident
+Output:
+    - delta sums per replicate, intervals per factor value (see delta_intervals) and per company, group, application (see group_intervals)
+"""
+import time
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.tree import DecisionTreeClassifier
+
+from flat_tree import flatten, predict_overrides
+
+def group_codes(df, dimensions, keys=None):
+    """ number every combination of dimension values (e.g. company, group, application), numbers of earlier batches are kept
+    Input: dataframe with incidents, dimensions, keys of earlier batches (index, None for the first batch)
+    Returns: code per incident, keys (index: the dimension values of every code)
+    """
+    batch_keys = pd.MultiIndex.from_frame(df[dimensions].astype(str)) # a missing value is a value of its own
+    unique_keys = batch_keys.unique()
+    keys = unique_keys if keys is None else keys.append(unique_keys.difference(keys, sort=False))
+    return keys.get_indexer(batch_keys), keys
+
+def replicate_seeds(replicates, seed=0):
+    """ independent seed per replicate """
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(replicates)]
+
+def fit_replicate(params, X, y, seed, sample_weight=None):
+    """ fit a tree with the given hyperparameters on a bootstrap sample of the rows
+    Input: hyperparameters of the selected model, X, y, seed of the sample, weight per row (optional, as the fit of the model)
+    Returns: flattened tree (see flat_tree.flatten)
+    """
+    rows = np.random.default_rng(seed).integers(len(y), size=len(y))
+    return flatten(DecisionTreeClassifier(**params).fit(X[rows], y[rows], sample_weight=None if sample_weight is None else sample_weight[rows]))
+
+def replicate_sums(tree, X, colnums, values, report, codes, n_groups):
+    """ evaluate the interventions with one replicate and sum the results
+    Input: flattened tree, X, interventions (column numbers and values), report: interventions that are summed per group,
+           group code per incident (see group_codes), number of groups
+    Returns: dictionary with the delta sums per intervention and the sums per group (groups x (predicted dissatisfaction + report))
+    """
+    proba = predict_overrides(tree, X, colnums, values)
+    deltas = proba[1:] - proba[0]
+    measures = [proba[0]] + [deltas[i] for i in report]
+    return {'deltas': deltas.sum(axis=1), 'groups': np.stack([np.bincount(codes, weights=w, minlength=n_groups) for w in measures], axis=1)}
+
+def _fit_and_sum(params, X, y, seed, sample_weight, colnums, values, report, codes, n_groups):
+    """ one replicate of the in-memory bootstrap: fit and evaluate """
+    return replicate_sums(fit_replicate(params, X, y, seed, sample_weight), X, colnums, values, report, codes, n_groups)
+
+def run_in_rounds(tasks, n_jobs=-1, time_budget=None):
+    """ run the tasks in a process pool, in rounds of one task per process
+        the first round always runs, the next round only when it is expected to finish within the time budget
+    Input: list of tasks (delayed functions), number of processes (-1: one per CPU), time budget in seconds (None: no limit)
+    Returns: results of the tasks that were run
+    """
+    round_size = effective_n_jobs(n_jobs)
+    results = []
+    start = time.perf_counter()
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while len(results) < len(tasks):
+            round_start = time.perf_counter()
+            results += parallel(tasks[len(results):len(results) + round_size])
+            round_time = time.perf_counter() - round_start
+            if time_budget is not None and time.perf_counter() - start + round_time > time_budget:
+                break
+    return results
+
+def add_sums(sums, added):
+    """ add the sums of a batch of incidents to the sums of the replicates (the later batches can have more groups) """
+    if sums is None:
+        return added
+    combined = []
+    for replicate, batch in zip(sums, added):
+        groups = np.zeros((max(len(replicate['groups']), len(batch['groups'])), batch['groups'].shape[1]))
+        groups[:len(replicate['groups'])] += replicate['groups']
+        groups[:len(batch['groups'])] += batch['groups']
+        combined.append({'deltas': replicate['deltas'] + batch['deltas'], 'groups': groups})
+    return combined
+
+def bootstrap_samples(sums, keys, counts, n, measures):
+    """ combine the sums of the replicates
+    Input: list with the sums per replicate (see replicate_sums), keys of the groups, incident count per group,
+           number of incidents, names of the measures per group
+    Returns: dictionary with the replicates x interventions delta sums, the replicates x groups x measures sums,
+             the group keys and counts, the number of incidents and the names of the measures
+    """
+    groups = np.zeros((len(sums), len(keys), len(measures)))
+    for i, replicate in enumerate(sums):
+        groups[i, :len(replicate['groups'])] = replicate['groups']
+    return {'replicates': len(sums), 'deltas': np.stack([replicate['deltas'] for replicate in sums]), 'groups': groups,
+            'keys': keys, 'counts': counts, 'n': n, 'measures': measures}
+
+def bootstrap_deltas(model, X, y, colnums, values, report, df_groups, dimensions, measures, replicates=100, time_budget=None, n_jobs=-1, seed=0,
+                     sample_weight=None):
+    """ bootstrap of the in-memory analysis: every replicate is fitted and evaluated in a worker process
+    Input: fitted model (the hyperparameters are reused), X, y, interventions (column numbers and values),
+           report: interventions that are summed per group, dataframe with the group dimensions per incident (rows of X),
+           dimensions, names of the measures per group (predicted dissatisfaction + report), number of replicates,
+           time budget in seconds, number of processes, seed, weight per incident (optional, as the fit of the model)
+    Returns: bootstrap samples (see bootstrap_samples)
+    """
+    params = model.get_params()
+    codes, keys = group_codes(df_groups, dimensions)
+    tasks = [delayed(_fit_and_sum)(params, X, y, s, sample_weight, colnums, values, report, codes, len(keys)) for s in replicate_seeds(replicates, seed)]
+    sums = run_in_rounds(tasks, n_jobs, time_budget)
+    return bootstrap_samples(sums, keys, np.bincount(codes, minlength=len(keys)), len(y), measures)
+
+def fit_replicates(model, X, y, replicates=100, time_budget=None, n_jobs=-1, seed=0, sample_weight=None):
+    """ fit the replicates in worker processes (the out-of-core analysis evaluates them per batch, see evaluate_replicates)
+    Returns: list of flattened trees
+    """
+    params = model.get_params()
+    return run_in_rounds([delayed(fit_replicate)(params, X, y, s, sample_weight) for s in replicate_seeds(replicates, seed)], n_jobs, time_budget)
+
+def evaluate_replicates(trees, X, colnums, values, report, codes, n_groups, n_jobs=-1):
+    """ evaluate every replicate on a batch of incidents (see replicate_sums) in worker processes
+    Returns: list with the sums per replicate
+    """
+    return Parallel(n_jobs=n_jobs)(delayed(replicate_sums)(tree, X, colnums, values, report, codes, n_groups) for tree in trees)
+
+def percentile_interval(samples, confidence=0.9):
+    """ percentile interval over the replicates (axis 0)
+    Returns: lower and upper bound
+    """
+    return np.percentile(samples, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+
+def delta_intervals(samples, confidence=0.9):
+    """ interval of the predicted dissatisfaction delta of every intervention (mean over all incidents)
+    Returns: lower and upper bound per intervention
+    """
+    return percentile_interval(samples['deltas'] / samples['n'], confidence)
+
+def group_intervals(samples, index_group, confidence=0.9):
+    """ interval of the mean predicted dissatisfaction and the mean deltas per value of the index group (e.g. per company)
+    Input: bootstrap samples, index_group: dimensions of the groups (as cube.rollup), confidence
+    Returns: dataframe indexed by index_group with the columns '<measure> low' and '<measure> high'
+    """
+    level_codes, level_keys = pd.MultiIndex.from_arrays([samples['keys'].get_level_values(dim) for dim in index_group], names=index_group).factorize()
+    counts = np.bincount(level_codes, weights=samples['counts'], minlength=len(level_keys))
+    sums = np.zeros((samples['replicates'], len(level_keys), len(samples['measures'])))
+    np.add.at(sums, (slice(None), level_codes), samples['groups'])
+    low, high = percentile_interval(sums / np.maximum(counts, 1)[None, :, None], confidence)
+    index = level_keys.set_names(index_group) if len(index_group) > 1 else pd.Index(level_keys.get_level_values(0), name=index_group[0])
+    df_intervals = pd.DataFrame(index=index)
+    for i, measure in enumerate(samples['measures']):
+        df_intervals[f"{measure} low"] = low[:, i]
+        df_intervals[f"{measure} high"] = high[:, i]
+    return df_intervals
+
+def add_delta_intervals(df_factor_values, samples, confidence=0.9):
+    """ add the interval of the predicted dissatisfaction delta to the factor values (in the order of the interventions of the bootstrap)
+    Returns: modified dataframe with the columns predicted_dissatisfaction_delta_low and predicted_dissatisfaction_delta_high
+    """
+    df_factor_values['predicted_dissatisfaction_delta_low'], df_factor_values['predicted_dissatisfaction_delta_high'] = delta_intervals(samples, confidence)
+    return df_factor_values
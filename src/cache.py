@@ -0,0 +1,67 @@
+""" cache:
+    On-disk cache for the results of the analysis (transformed incidents, factors, models, prediction deltas)
+    so that the reports can be recreated without reprocessing unchanged input files
+    The results are stored in a pickle file per key, the key is a hash of the input files and of the source code
+Input:
+    - input files, source code folder
+    - dictionary with the results (artifacts)
+Output:
+    - cache folder with one file per key, the least recently used files are removed
+"""
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+def fingerprint(files, version=""):
+    """ compute a hash over the content of the given files and the code / configuration version
+    Input: list of files, version string
+    Returns: hexadecimal hash (key of the cache)
+    """
+    h = hashlib.sha256(version.encode())
+    for file in files:
+        h.update(Path(file).name.encode())
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+def code_version(src_dir):
+    """ compute a hash over the python files in the source folder: changing the code invalidates the cache
+    Input: source folder
+    Returns: hexadecimal hash
+    """
+    return fingerprint(sorted(Path(src_dir).glob("*.py")))
+
+def load_artifacts(cache_dir, key):
+    """ load the cached artifacts for the given key
+    Input: cache folder, key
+    Returns: dictionary with the artifacts, None when there are no cached artifacts for the key
+    """
+    cache_file = Path(cache_dir) / f"{key}.pkl"
+    if not cache_file.exists():
+        return None
+    with open(cache_file, 'rb') as f:
+        artifacts = pickle.load(f)
+    os.utime(cache_file) # mark as recently used
+    return artifacts
+
+def store_artifacts(cache_dir, key, artifacts, max_entries=5):
+    """ store the artifacts for the given key and remove the least recently used entries
+    Input: cache folder, key, dictionary with the artifacts, maximum number of entries to keep
+    Returns: None
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # write to a temporary file first so that an interrupted run does not leave a corrupt entry
+    cache_file = cache_dir / f"{key}.pkl"
+    tmp_file = cache_dir / f"{key}.tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(artifacts, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+
+    # evict the least recently used entries
+    entries = sorted(cache_dir.glob("*.pkl"), key=lambda file: file.stat().st_mtime, reverse=True)
+    for entry in entries[max_entries:]:
+        entry.unlink()
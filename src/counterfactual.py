@@ -0,0 +1,46 @@
+""" counterfactual:
+    Predict how user dissatisfaction would change if a given factor value would be enforced on all incidents
+    e.g. predict the dissatisfaction if no incident would be reopened, if all incidents would be resolved the same day, ...
+Input:
+    - fitted model, X (factor values per incident)
+    - factor - value combinations (interventions): column number in X and the value to enforce
+Output:
+    - predicted dissatisfaction per incident
+    - delta matrix: predicted change in dissatisfaction per incident (rows) and intervention (columns)
+"""
+import pandas as pd
+
+from flat_tree import predict_overrides
+
+def predict_deltas(model, X, colnums, values):
+    """ predict the change in dissatisfaction for every incident and every intervention in a single batch
+        the interventions are evaluated as column overrides of the flattened tree (see flat_tree.predict_overrides):
+        only the incidents whose decision path tests the factor of an intervention are evaluated again
+    Input:
+        model: fitted decision tree (or flattened tree, see flat_tree.flatten)
+        X: factor values per incident
+        colnums: column number in X for every intervention
+        values: value to enforce for every intervention
+    Returns: predicted dissatisfaction per incident, delta matrix (incidents x interventions)
+    """
+    # row 0: the actual values, row i+1: intervention i applied
+    proba = predict_overrides(model, X, colnums, values)
+    deltas = (proba[1:] - proba[0]).T  # difference with the predicted dissatisfaction for the actual values
+
+    return proba[0], deltas
+
+def intervention_names(df_interventions):
+    """ name every intervention as 'pred_<factor>_<value>' (as used in the reports)
+    Input: dataframe with the columns 'factor' and 'value'
+    Returns: list with the intervention names
+    """
+    return ('pred_' + df_interventions['factor'] + '_' + df_interventions['value'].astype(str)).tolist()
+
+def add_delta_columns(df_incidents, deltas, names, columns):
+    """ add the deltas for the selected interventions as columns to the incidents
+        only the interventions needed for reporting are added, the full delta matrix remains a numpy array
+    Input: dataframe with incidents, delta matrix, names of the interventions (delta matrix columns), columns to add
+    Returns: modified dataframe with the incidents
+    """
+    df_deltas = pd.DataFrame(deltas[:, [names.index(col) for col in columns]], columns=columns, index=df_incidents.index)
+    return df_incidents.join(df_deltas)
@@ -0,0 +1,57 @@
+""" cube:
+    Pre-aggregated sums and counts of the incident measures per group
+    - the cube is computed with one groupby at the finest grain of a set of dimensions (e.g. company, group, application)
+    - every report on a subset of these dimensions is a rollup of the (small) cube instead of a pass over all incidents
+    - means are derived from the sums: mean = sum / count
+    - sums and counts are additive: the cubes of batches of incidents are added up (out-of-core analysis)
+Input:
+    - dataframe with incident tickets, dimensions and measures
+Output:
+    - sums and counts per combination of dimension values
+"""
+import pandas as pd
+
+# measures that are reported per group (see output.ordered_excel_data and output.ordered_plot_data)
+# and the squared error of the prediction (Brier score per group, see diagnostics.group_calibration)
+report_measures = ["user_dissatisfied","dissatisfaction_proba","pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0",
+                   "proba_squared_error"]
+
+def group_cube(df, dimensions, measures=report_measures):
+    """ sums and counts of the measures for every combination of dimension values (one groupby pass)
+    Input: dataframe with incident tickets, list of dimensions (columns),
+           list of measures (columns, measures that are not in the dataframe are skipped)
+    Returns: dataframe indexed by the dimensions with a column 'count' and the sum of every measure
+    """
+    measures = [measure for measure in measures if measure in df.columns]
+    # missing dimension values are kept: they are only excluded from the rollups on that dimension
+    grouped = df.groupby(dimensions, observed=True, sort=True, dropna=False)
+    cube = grouped[measures].sum()
+    cube.insert(0, 'count', grouped.size())
+    return cube
+
+def add_cubes(cube, added):
+    """ add the sums and counts of two cubes with the same dimensions (e.g. the cubes of two batches of incidents)
+    Input: cube (None for the first batch), cube to add
+    Returns: dataframe indexed by the dimensions with a column 'count' and the sum of every measure
+    """
+    if cube is None:
+        return added
+    # the categories of the dimensions differ per batch: the values are combined as plain values
+    return pd.concat([cube, added]).groupby(level=list(range(cube.index.nlevels)), observed=True, sort=True, dropna=False).sum()
+
+def rollup(cube, index_group):
+    """ aggregate the cube to the given index group
+    Input: cube (see group_cube), index_group: list of dimensions of the cube
+    Returns: dataframe indexed by index_group with a column 'count' and the sum of every measure
+    """
+    return cube.groupby(level=index_group, observed=True, sort=True).sum()
+
+def group_means(cube, index_group):
+    """ counts and means of the measures per value of the index group (the means are weighted by the counts)
+    Input: cube (see group_cube), index_group: list of dimensions of the cube
+    Returns: dataframe indexed by index_group with columns 'count', the sum ('<measure> sum') and the mean of every measure
+    """
+    sums = rollup(cube, index_group)
+    measures = [col for col in sums.columns if col != 'count']
+    means = sums[measures].div(sums['count'], axis=0)
+    return pd.concat([sums[['count']], sums[measures].add_suffix(' sum'), means], axis=1)
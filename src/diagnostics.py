@@ -0,0 +1,130 @@
+""" diagnostics:
+    Calibration of the predicted dissatisfaction: does the predicted ratio match the actual ratio of dissatisfied responses?
+    - decile calibration error: the incidents are split in 10 groups on the dense percentile rank of their prediction,
+      per group the (weighted) sum of the predictions is compared with the (weighted) number of dissatisfied responses:
+      the mean absolute difference is the error, its inverse the score of the hyperparameter search (see model.DecisionTree)
+    - the error is computed with bincount on arrays (no dataframes): it is called for every candidate and fold of the search
+    - calibration table: weights, dissatisfied, predicted and squared error sums per unique prediction (the leaves of the trees),
+      of the out of fold predictions (see model.cross_validated_proba): the reliability curve, Brier score and decile calibration error
+      are derived from it (the tables of batches of incidents are added with cube.add_cubes)
+    - a tree is calibrated per leaf on the incidents it is fitted on: out of fold predictions show the calibration on unseen incidents
+    - calibration per company and group: observed and predicted ratio and Brier score from the cube per company, group and application
+    - all functions accept sample weights (None: every incident weighs 1)
+Input:
+    - actual responses and predicted dissatisfaction (arrays), or the calibration table and the cube per company, group and application
+Output:
+    - calibration error / score, Brier score, reliability curve and calibration per company and group ("15 Calibration.xlsx", "16 Group Calibration.xlsx")
+"""
+import numpy as np
+import pandas as pd
+
+from cube import rollup
+
+deciles = 10
+
+def _weights(sample_weight, n):
+    """ the sample weights as float array (ones when None) """
+    return np.ones(n) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+
+def decile_ranks(dense_rank, n_unique):
+    """ decile (0..10) of every dense rank of the predictions: round((rank + 1) / number of unique predictions * 10) """
+    return np.round((np.asarray(dense_rank).reshape(-1) + 1) / n_unique * deciles).astype(np.intp)
+
+def decile_calibration_error(y_true, y_pred, sample_weight=None):
+    """ mean absolute difference between the predicted and the actual number of dissatisfied responses per decile of the predictions
+    Input: actual responses (0/1), predicted dissatisfaction, sample weights (optional)
+    Returns: error (lower is better)
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    unique_pred, dense_rank = np.unique(y_pred, return_inverse=True)
+    rank = decile_ranks(dense_rank, len(unique_pred))
+
+    weight = None if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    actual = np.bincount(rank, weights=y_true if weight is None else y_true * weight, minlength=deciles + 1)
+    prob = np.bincount(rank, weights=y_pred if weight is None else y_pred * weight, minlength=deciles + 1)
+    present = np.bincount(rank, minlength=deciles + 1) > 0
+    return np.abs(prob[present] - actual[present]).mean()
+
+def decile_calibration_score(y_true, y_pred, sample_weight=None):
+    """ custom score function to select the hyperparameters that provide the least differences across
+        the full range of actual dissatisfaction ratios
+        the performance is determined by testing against 10 percentile ranges
+    Input:
+        y_true: the actual user dissatisfaction
+        y_pred: predicted user dissatisfaction
+        sample_weight: weight per incident (optional)
+    Returns: a score which is higher for better fits
+    """
+    return 1 / decile_calibration_error(y_true, y_pred, sample_weight)  # 1/x  to return a higher score when the sum of the absolute differences is lower
+
+def brier_score(y_true, y_pred, sample_weight=None):
+    """ (weighted) mean squared difference between the predicted dissatisfaction and the actual response (lower is better) """
+    squared_error = (np.asarray(y_pred, dtype=np.float64) - np.asarray(y_true, dtype=np.float64))**2
+    return np.average(squared_error, weights=sample_weight)
+
+def calibration_table(y_true, y_pred, sample_weight=None):
+    """ sums per unique prediction (for a tree: per leaf), the tables of batches of incidents are added with cube.add_cubes
+    Input: actual responses, predicted dissatisfaction, sample weights (optional)
+    Returns: dataframe indexed by the prediction with the columns weight, dissatisfied, predicted and squared_error (sums)
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    weight = _weights(sample_weight, len(y_true))
+    unique_pred, codes = np.unique(y_pred, return_inverse=True)
+    codes = codes.reshape(-1)
+    table = pd.DataFrame(index=pd.Index(unique_pred, name='prediction'))
+    for col, values in [('weight', weight), ('dissatisfied', y_true * weight), ('predicted', y_pred * weight),
+                        ('squared_error', (y_pred - y_true)**2 * weight)]:
+        table[col] = np.bincount(codes, weights=values, minlength=len(unique_pred))
+    return table
+
+def reliability_curve(table):
+    """ predicted and actual dissatisfaction ratio per decile of the predictions (as decile_calibration_error)
+    Input: calibration table (see calibration_table)
+    Returns: dataframe with a row per decile: weight, predicted and actual ratio, difference of the sums and Brier score
+    """
+    table = table.sort_index()
+    sums = table.groupby(decile_ranks(np.arange(len(table)), len(table))).sum()
+    curve = pd.DataFrame({'decile': sums.index, 'weight': sums['weight'],
+                          'predicted dissatisfaction%': sums['predicted'] / sums['weight'],
+                          'actual dissatisfaction%': sums['dissatisfied'] / sums['weight'],
+                          'difference': sums['predicted'] - sums['dissatisfied'],
+                          'brier': sums['squared_error'] / sums['weight']})
+    return curve.reset_index(drop=True)
+
+def calibration_summary(table):
+    """ reliability curve with a total row: the Brier score and the decile calibration error of all incidents
+    Input: calibration table (see calibration_table)
+    Returns: dataframe (see reliability_curve), the total row has the decile calibration error in the column 'difference'
+    """
+    curve = reliability_curve(table)
+    total = table.sum()
+    curve.loc[len(curve)] = {'decile': 'all', 'weight': total['weight'],
+                             'predicted dissatisfaction%': total['predicted'] / total['weight'],
+                             'actual dissatisfaction%': total['dissatisfied'] / total['weight'],
+                             'difference': curve['difference'].abs().mean(),
+                             'brier': total['squared_error'] / total['weight']}
+    return curve
+
+def group_calibration(cube, levels=(["company"], ["company","group"])):
+    """ calibration per company and group: actual and predicted ratio, difference and Brier score
+    Input: cube per company, group and application with the sums of user_dissatisfied, dissatisfaction_proba and proba_squared_error
+           (see cube.group_cube, predictions of the model fitted on all incidents), levels of the group hierarchy
+    Returns: dataframe with a row per level value, the largest differences (predicted - actual dissatisfied count) first
+    """
+    calibration = []
+    for level in levels:
+        sums = rollup(cube[['count','user_dissatisfied','dissatisfaction_proba','proba_squared_error']], level)
+        df = sums.index.to_frame(index=False)
+        df.insert(0, 'level', level[-1])
+        df['count'] = sums['count'].to_numpy()
+        df['actual dissatisfaction%'] = (sums['user_dissatisfied'] / sums['count']).to_numpy()
+        df['predicted dissatisfaction%'] = (sums['dissatisfaction_proba'] / sums['count']).to_numpy()
+        df['difference'] = (sums['dissatisfaction_proba'] - sums['user_dissatisfied']).to_numpy()
+        df['brier'] = (sums['proba_squared_error'] / sums['count']).to_numpy()
+        calibration.append(df)
+    df_calibration = pd.concat(calibration, ignore_index=True)
+    dimensions = list(levels[-1])
+    df_calibration = df_calibration[['level'] + dimensions + [col for col in df_calibration.columns if col not in ['level'] + dimensions]]
+    return df_calibration.sort_values(by='difference', key=np.abs, ascending=False).reset_index(drop=True)
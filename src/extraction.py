@@ -0,0 +1,229 @@
+""" extraction:
+    Concurrent extraction of the independent queries: the incidents with a survey response and all incidents (see incidents_from_odbc.py)
+    - a small pool of connections: a connection is opened when no idle connection is available (at most pool_size),
+      reused by the next query and closed when the extraction ends. A connection on which a query failed is closed, not reused
+    - the queries run in a thread pool: the driver blocks in the database calls (pyodbc releases the GIL while it waits),
+      every query streams its batches through the transforms into its store as the sequential extraction does
+    - a query that fails with a transient database error (DB-API OperationalError / InterfaceError, timeouts) is retried
+      on another connection after a delay that doubles per retry. Timeouts: login and query timeout of the connection
+      (see incidents_from_odbc.connect) and the wait for a free connection of the pool
+    - the result of a query is passed on as soon as it arrives (e.g. the store is read and typed) while the other query still runs
+    - the companies, groups and applications of both queries are anonymised with the same mapping tables (see pseudonymise.py),
+      written once when both queries are stored
+    - local DB stand-in: a sqlite database with the table dm_incidentcube of the data lake (see stand_in_connect, stand_in_incidents)
+
+    to run against the stand-in: python extraction.py create incidents.db, python extraction.py extract incidents.db
+Input:
+    - function that opens a connection (default: ODBC connection to the data lake), csv files of the stores
+Output:
+    - stored incidents (see incident_store.py), dataframes with the incidents
+"""
+import argparse
+import queue
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from incidents_from_odbc import connect, get_incidents_from_db, get_all_incidents_from_db
+from incremental import refresh_incidents, refresh_all_incidents
+from incident_store import read_incidents
+from pseudonymise import pseudonyms_file, read_pseudonyms, write_pseudonyms
+
+pool_size = 2          # connections and threads: one per independent query
+acquire_timeout = 600  # seconds to wait for a free connection of the pool
+retries = 2            # retries of a query after a transient error
+retry_delay = 10       # seconds before the first retry (doubled for every next retry)
+
+def create_pool(connect=connect, size=pool_size):
+    """ pool of at most 'size' connections, opened when needed
+    Input: function that opens a connection, maximum number of connections
+    Returns: dictionary with the idle connections, the open connections and a semaphore with a slot per connection
+    """
+    return {'connect': connect, 'idle': queue.LifoQueue(), 'open': [], 'slots': threading.BoundedSemaphore(size), 'lock': threading.Lock()}
+
+def discard_connection(pool, conn):
+    """ close a connection and remove it from the pool (errors on close are ignored: the connection may be broken) """
+    with pool['lock']:
+        if conn in pool['open']:
+            pool['open'].remove(conn)
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def close_pool(pool):
+    """ close all connections of the pool """
+    for conn in list(pool['open']):
+        discard_connection(pool, conn)
+
+@contextmanager
+def pooled_connection(pool, timeout=acquire_timeout):
+    """ borrow a connection of the pool: an idle connection or a new one when there is none
+        the connection is returned to the pool when the block ends, closed when the block raises an error
+    Input: pool (see create_pool), seconds to wait for a free connection
+    Returns: connection (TimeoutError when no connection is free within the timeout)
+    """
+    if not pool['slots'].acquire(timeout=timeout):
+        raise TimeoutError(f"no free connection within {timeout} seconds")
+    try:
+        try:
+            conn = pool['idle'].get_nowait()
+        except queue.Empty:
+            conn = pool['connect']()
+            with pool['lock']:
+                pool['open'].append(conn)
+        try:
+            yield conn
+        except BaseException:
+            discard_connection(pool, conn)
+            raise
+        pool['idle'].put(conn)
+    finally:
+        pool['slots'].release()
+
+def transient(error):
+    """ True for the errors after which a query is retried: connection failures and timeouts
+        (the DB-API exceptions of pyodbc and sqlite3 have no common base class: they are recognised by their DB-API name)
+    """
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in ('OperationalError', 'InterfaceError')
+
+def run_query(pool, task, retries=retries, delay=retry_delay):
+    """ run a task on a connection of the pool, retry it on another connection after a transient error
+    Input: pool, task (function of a connection), number of retries, seconds before the first retry
+    Returns: result of the task
+    """
+    for attempt in range(retries + 1):
+        try:
+            with pooled_connection(pool) as conn:
+                return task(conn)
+        except Exception as error:
+            if attempt == retries or not transient(error):
+                raise
+            print(f"Query failed ({error}), retry in {delay * 2**attempt} seconds")
+            time.sleep(delay * 2**attempt)
+
+def run_concurrently(tasks, on_result=None, connect=connect, size=pool_size, retries=retries, delay=retry_delay):
+    """ run independent tasks concurrently on a pool of connections
+    Input: dictionary name -> task (function of a connection), on_result: function (name, result) called in this thread
+           as soon as a task completes, function that opens a connection, pool size, retries and delay (see run_query)
+    Returns: dictionary name -> result of on_result (result of the task without on_result)
+    """
+    pool = create_pool(connect, size)
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            futures = {executor.submit(run_query, pool, task, retries, delay): name for name, task in tasks.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                results[name] = future.result() if on_result is None else on_result(name, future.result())
+    finally:
+        close_pool(pool)
+    return results
+
+def extract_incidents(incident_file, all_incidents_file, connect=connect, read=True):
+    """ retrieve the incidents with a survey response and all incidents concurrently and store them (see incidents_from_odbc)
+        each store is read as soon as its query is stored
+    Input: csv files of the stores, function that opens a connection, read: return the stored incidents (False: only store them)
+    Returns: dataframes with the incidents with a survey response and all incidents (None when not read)
+    """
+    files = {'incidents': incident_file, 'all_incidents': all_incidents_file}
+    pseudonyms = read_pseudonyms(pseudonyms_file(incident_file)) # shared by both queries
+    tasks = {'incidents': lambda conn: get_incidents_from_db(incident_file, conn, read=False, pseudonyms=pseudonyms),
+             'all_incidents': lambda conn: get_all_incidents_from_db(all_incidents_file, conn, read=False, pseudonyms=pseudonyms)}
+    results = run_concurrently(tasks, lambda name, result: read_incidents(files[name]) if read else None, connect)
+    for file in {pseudonyms_file(incident_file), pseudonyms_file(all_incidents_file)}:
+        write_pseudonyms(file, pseudonyms)
+    return results['incidents'], results['all_incidents']
+
+def refresh_concurrently(incident_file, all_incidents_file, connect=connect, window_days=365, read=True):
+    """ refresh both stores concurrently with the incidents resolved since their previous refresh (see incremental.py)
+    Input: csv files of the stores, function that opens a connection, number of days that incidents are kept,
+           read: return the refreshed incidents (False: only refresh the stores)
+    Returns: dataframes with the incidents with a survey response and all incidents (None when not read)
+    """
+    pseudonyms = read_pseudonyms(pseudonyms_file(incident_file))
+    tasks = {'incidents': lambda conn: refresh_incidents(conn, incident_file, window_days, pseudonyms, read),
+             'all_incidents': lambda conn: refresh_all_incidents(conn, all_incidents_file, window_days, pseudonyms, read)}
+    results = run_concurrently(tasks, connect=connect)
+    for file in {pseudonyms_file(incident_file), pseudonyms_file(all_incidents_file)}:
+        write_pseudonyms(file, pseudonyms)
+    return results['incidents'], results['all_incidents']
+
+def stand_in_connect(db_file):
+    """ function that opens a connection to the local stand-in of the data lake:
+        a sqlite database file with the table dm_incidentcube, attached as datamart_core (the schema of the queries)
+    """
+    def connect_stand_in():
+        conn = sqlite3.connect(":memory:", check_same_thread=False) # the pool hands the connection to other threads
+        conn.execute("attach database ? as datamart_core", (str(db_file),))
+        return conn
+    return connect_stand_in
+
+def stand_in_incidents(n=20000, seed=0):
+    """ random incidents with the fields of dm_incidentcube that the queries select and filter on (for the stand-in)
+    Input: number of incidents, seed of the random generator
+    Returns: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    choice = lambda values, p=None: rng.choice(np.array(values, dtype=object), size=n, p=p)
+    now = datetime.utcnow()
+    return pd.DataFrame({
+        'incident_number': [f"INC{i:08d}" for i in range(n)],
+        'close_code': choice(['Information Provided / Training', 'No Resolution Action', 'Data Correction', 'Security Modification',
+                              'Reboot / Restart', 'Software Correction', 'Environmental Restoration', 'Hardware Correction']),
+        'breached_reason_code': choice([None, 'No Activity- Autoclosed', 'Complex Resolution', 'Received late or Breached']),
+        'contact_type': choice(['self-service', 'chat', 'phone', 'Event Management']),
+        'self_service': rng.integers(0, 2, n),
+        'incident_reopened_flag': rng.integers(0, 2, n),
+        'sla_result': choice(['Breached', 'Met']),
+        'sla_priority': choice(['Priority 4', 'Priority 3', 'Priority 2']),
+        'am_ttr': rng.exponential(3 * 24 * 3600, n),
+        'incident_has_ka_related_flag': rng.integers(0, 2, n),
+        'reassignment_count': rng.poisson(1, n),
+        'appl_tier': choice([None, 'Gold', 'Silver', 'Bronze']),
+        'caller_vip': rng.integers(0, 2, n),
+        'caller_employee_type': choice(['employees', 'contractors']),
+        'survey_response_value': choice([0, 1, 2, 3, 4, 5], p=[0.7, 0.03, 0.02, 0.03, 0.07, 0.15]),
+        'ci_name': [f"application {i}" for i in rng.integers(0, 300, n)],
+        'assignment_group_company': [f"company {i}" for i in rng.integers(0, 10, n)],
+        'assignment_group_name': [f"group {i}" for i in rng.integers(0, 100, n)],
+        'kcs_solution': choice([None, 'KB000010100058', 'KB000010078242']),
+        'assignment_group_parent': choice(['PARENT APP MAINTENANCE', 'PARENT APP SERVICES SUPPORT', 'PARENT INFRASTRUCTURE']),
+        'resolved_date_utc': [(now - timedelta(seconds=int(s))).strftime('%Y-%m-%d %H:%M:%S') for s in rng.integers(0, 400 * 24 * 3600, n)],
+    })
+
+def write_stand_in(db_file, df):
+    """ write the incidents to the table dm_incidentcube of the stand-in (replaces the table) """
+    with sqlite3.connect(db_file) as conn:
+        df.to_sql('dm_incidentcube', conn, if_exists='replace', index=False)
+    conn.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Concurrent extraction from a local stand-in of the data lake", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    create_parser = commands.add_parser('create', help="create a sqlite stand-in with random incidents")
+    create_parser.add_argument('db', help="sqlite database file")
+    create_parser.add_argument('--incidents', type=int, default=20000, help="number of incidents")
+    create_parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+    extract_parser = commands.add_parser('extract', help="extract the incidents from the stand-in (as main.py -d)")
+    extract_parser.add_argument('db', help="sqlite database file")
+    extract_parser.add_argument('--output', default=str(Path(__file__).parent.parent / "data" / "stand_in"), help="folder to which the csv and Parquet files are written")
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        write_stand_in(args.db, stand_in_incidents(args.incidents, args.seed))
+        print(args.incidents, "incidents written to", args.db)
+    else:
+        output_dir = Path(args.output)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        df_incidents, df_all_incidents = extract_incidents(output_dir / "incident_tickets.csv", output_dir / "all_incidents.csv", stand_in_connect(args.db))
+        print(len(df_incidents), "incidents with a survey response,", len(df_all_incidents), "incidents stored in", output_dir,
+              f"({time.perf_counter() - start:.1f} s)")
@@ -0,0 +1,67 @@
+""" factors:
+    Registry of the factors (columns of the incidents) and their attributes
+    - a dictionary factor -> attributes: variable_type, dtype, unique_values, chi, p, colnum, feature_importance
+      and predicted_dissatisfaction_delta (the attributes are added by the stages of the analysis)
+    - the attributes of a factor are read and updated by name (no scan of all factors),
+      the registry is materialized as a dataframe for the Excel files only
+    - variable_type: analyse (factor of the model), analyse2 (secondary analysis), ignore, one_hot_encoded (replaced by dummy columns),
+      encoded (shrunk ratio of a factor with many values, factor of the model without interventions, see shrinkage.py), response, date and key
+Input:
+    - columns of the incidents
+Output:
+    - factors dataframe (see factor_frame) and factor values with the attributes of their factor (see factor_values_frame)
+"""
+import numpy as np
+import pandas as pd
+
+# attributes of the factors in the order of the Excel files
+factor_columns = ['factor','colnum','variable_type','dtype','unique_values','chi','p','feature_importance','predicted_dissatisfaction_delta']
+
+def create_factors(df, unique_values=None, response='user_dissatisfied', date_columns=(), key_columns=()):
+    """ register the columns of the incidents as factors
+    Input: dataframe with the incidents, unique_values: number of unique values per column (default: counted in df),
+           response column, columns with dates and columns that identify the incident (not analysed)
+    Returns: dictionary factor -> attributes
+    """
+    if unique_values is None:
+        unique_values = df.nunique().to_dict()
+    factors = {}
+    for fct, dtype in df.dtypes.items():
+        variable_type = 'response' if fct == response else 'date' if fct in date_columns else 'key' if fct in key_columns else 'analyse'
+        factors[fct] = {'variable_type': variable_type, 'dtype': dtype, 'unique_values': unique_values.get(fct, np.nan)}
+    return factors
+
+def set_variable_type(factors, fct, variable_type):
+    """ change the variable type of a factor (factors that are not registered are ignored) """
+    if fct in factors:
+        factors[fct]['variable_type'] = variable_type
+
+def factors_of_type(factors, variable_type):
+    """ factors with the given variable type (in the order of the registry) """
+    return [fct for fct, attributes in factors.items() if attributes['variable_type'] == variable_type]
+
+def by_chi(factors, names):
+    """ the given factors ordered by descending chi (the most differentiating factors first, factors without chi last) """
+    return sorted(names, key=lambda fct: -np.nan_to_num(factors[fct].get('chi', np.nan), nan=-np.inf))
+
+def factor_frame(factors, sort_by=None, ascending=True):
+    """ materialize the registry as a dataframe with a row per factor
+    Input: dictionary with the factors, optional sort columns and order (as DataFrame.sort_values)
+    Returns: dataframe with the attributes that are set for at least one factor (in the order of factor_columns)
+    """
+    df_factors = pd.DataFrame([{'factor': fct, **attributes} for fct, attributes in factors.items()])
+    df_factors = df_factors[[col for col in factor_columns if col in df_factors.columns]]
+    if sort_by is not None:
+        df_factors.sort_values(by=sort_by, ascending=ascending, inplace=True)
+    return df_factors
+
+def factor_values_frame(factors, df_values):
+    """ add the attributes of their factor in front of the factor values (the attributes that are set for at least one factor)
+    Input: dictionary with the factors, dataframe with a row per factor value (column 'factor')
+    Returns: new dataframe
+    """
+    attributes = [col for col in factor_columns[1:] if any(col in fct_attributes for fct_attributes in factors.values())]
+    df_factor_values = df_values[['factor']].copy()
+    for attribute in attributes:
+        df_factor_values[attribute] = [factors[fct].get(attribute, np.nan) for fct in df_values['factor']]
+    return pd.concat([df_factor_values, df_values.drop(columns='factor')], axis=1)
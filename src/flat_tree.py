@@ -0,0 +1,151 @@
+""" flat_tree:
+    Bulk inference of a fitted decision tree (DecisionTreeClassifier) without the overhead of predict_proba
+    - the tree is flattened once into contiguous arrays: feature, threshold, left/right child, missing value direction
+      and the probability of dissatisfaction per node
+    - a batch is evaluated level by level: all rows move down one level at a time with vectorised lookups,
+      the input is converted once and not validated on every call
+    - column overrides (e.g. all incidents not reopened) are evaluated against the same base matrix X:
+      only the rows whose decision path tests the overridden column can get a different prediction and are evaluated again
+    - X can be a compact integer matrix (kept as is) or a scipy.sparse matrix: only the columns that are tested by the tree are densified
+Input:
+    - fitted DecisionTreeClassifier, X (dense or sparse, compared as float32 values as in predict_proba), column overrides
+Output:
+    - predicted probability of dissatisfaction (per row, per depth or per override)
+"""
+import numpy as np
+import scipy.sparse
+
+def flatten(clf):
+    """ flatten a fitted decision tree into contiguous arrays (a flattened tree is returned as is)
+        a leaf is its own child (and tests feature 0), so that every row can move down max_depth levels without tests for leaves
+    Input: fitted DecisionTreeClassifier with classes 0 and 1 (or a flattened tree)
+    Returns: dictionary with an array per node attribute
+    """
+    if isinstance(clf, dict):
+        return clf
+    t = clf.tree_
+    is_leaf = t.children_left == -1
+    nodes = np.arange(t.node_count)
+    value = t.value[:,0,:]
+    missing_go_to_left = getattr(t, 'missing_go_to_left', np.zeros(t.node_count, dtype=bool)).astype(bool) & ~is_leaf
+
+    # features tested on the path from the root to every node
+    path_features = np.zeros((t.node_count, t.n_features), dtype=bool)
+    for node in nodes[~is_leaf]: # the children have higher node numbers than their parent
+        path_features[node, t.feature[node]] = True
+        path_features[[t.children_left[node], t.children_right[node]]] = path_features[node]
+
+    return {
+        'feature': np.where(is_leaf, 0, t.feature).astype(np.intp),
+        'threshold': np.where(is_leaf, np.inf, t.threshold),
+        'children': np.ascontiguousarray(np.stack([np.where(is_leaf, nodes, t.children_left),
+                                                   np.where(is_leaf, nodes, t.children_right)], axis=1).astype(np.intp).ravel()),  # left: 2*node, right: 2*node+1
+        'is_leaf': is_leaf,
+        'missing_go_to_left': missing_go_to_left if missing_go_to_left.any() else None, # missing values go right by default
+        'proba': value[:,1] / value.sum(axis=1), # same normalisation as predict_proba
+        'path_features': path_features,
+        'max_depth': t.max_depth,
+    }
+
+def as_matrix(X):
+    """ X as a C-ordered matrix: the tree compares float32 values with its (float64) thresholds, as predict_proba
+        flags and small integers are exact in float32 and keep their compact data type (see transform_attributes.feature_matrix)
+    """
+    X = np.asarray(X)
+    if X.dtype == bool:
+        return np.ascontiguousarray(X).view(np.uint8)
+    if X.dtype.kind in 'iu' and X.dtype.itemsize <= 2:
+        return np.ascontiguousarray(X)
+    return np.ascontiguousarray(X, dtype=np.float32)
+
+def _tested_columns(tree, X):
+    """ X as a dense matrix (see as_matrix), a sparse X is not densified as a whole: only the columns that are tested by the tree
+    Input: flattened tree, X (dense or scipy.sparse)
+    Returns: tree with the features renumbered to the columns of the dense matrix, dense matrix,
+             column numbers of the dense matrix in X (None for a dense X)
+    """
+    if not scipy.sparse.issparse(X):
+        return tree, as_matrix(X), None
+    columns = np.unique(tree['feature'])
+    return dict(tree, feature=np.searchsorted(columns, tree['feature'])), as_matrix(X.tocsc()[:, columns].toarray()), columns
+
+def _holds(dtype, values):
+    """ True when the data type of the matrix holds the values exactly """
+    if dtype.kind == 'f':
+        return True
+    info = np.iinfo(dtype)
+    return bool(np.all((values == np.round(values)) & (values >= info.min) & (values <= info.max)))
+
+def _step(tree, X_flat, offsets, node):
+    """ move every row one level down: to the child for the value of the split feature of its node
+    Input: flattened tree, X as a flat array, offset of every row in X_flat, current node per row
+    Returns: child node per row
+    """
+    x = X_flat[offsets + tree['feature'][node]]
+    go_right = ~(x <= tree['threshold'][node]) # missing values (nan) go right
+    if tree['missing_go_to_left'] is not None:
+        go_right &= ~(np.isnan(x) & tree['missing_go_to_left'][node])
+    return tree['children'][2*node + go_right]
+
+def apply(tree, X):
+    """ leaf of every row
+    Input: flattened tree, X (see as_matrix)
+    Returns: node number of the leaf per row
+    """
+    X_flat = X.ravel()
+    offsets = np.arange(X.shape[0], dtype=np.intp) * X.shape[1]
+    node = np.zeros(X.shape[0], dtype=np.intp)
+    for depth in range(tree['max_depth']):
+        node = _step(tree, X_flat, offsets, node)
+    return node
+
+def predict(tree, X):
+    """ predicted probability of dissatisfaction (same as predict_proba(X)[:,1])
+    Input: flattened tree (or fitted classifier), X
+    Returns: array with the probability per row
+    """
+    tree, X, columns = _tested_columns(flatten(tree), X)
+    return tree['proba'][apply(tree, X)]
+
+def predict_overrides(tree, X, colnums, values):
+    """ predicted probability of dissatisfaction for the actual values and for every column override
+        an override of column c can only change the prediction of the rows whose decision path tests c:
+        only these rows are evaluated again (with the value of column c replaced), in one batch for all overrides,
+        the other rows keep the base prediction
+    Input: flattened tree (or fitted classifier), X, colnums: column per override, values: value per override
+    Returns: matrix (1 + overrides) x rows: row 0 for the actual values, row i+1 for override i
+    """
+    tree, X, columns = _tested_columns(flatten(tree), X)
+    colnums = np.asarray(colnums, dtype=np.intp)
+    values = np.asarray(values, dtype=np.float32)
+
+    leaf = apply(tree, X)
+    proba = np.tile(tree['proba'][leaf], (len(colnums)+1, 1))
+
+    # the (override, row) pairs for which the decision path of the row tests the overridden column (path_features: columns of X)
+    override, rows = np.nonzero(tree['path_features'][leaf][:, colnums].T)
+    Z = X[rows]
+    if not _holds(Z.dtype, values[override]):
+        Z = Z.astype(np.float32)
+    Z[np.arange(len(rows)), (colnums if columns is None else np.searchsorted(columns, colnums))[override]] = values[override]
+    proba[override+1, rows] = tree['proba'][apply(tree, Z)]
+    return proba
+
+def depth_probas(tree, X, depths):
+    """ predicted probability of dissatisfaction as if the tree was pruned to each of the given depths
+        the nodes of a tree contain the class distribution of their samples, so the prediction at depth d
+        is the node at depth d on the decision path (or the leaf when the path is shorter)
+    Input: flattened tree (or fitted classifier), X, list of depths
+    Returns: dictionary depth -> predicted probability of dissatisfaction
+    """
+    tree, X, columns = _tested_columns(flatten(tree), X)
+    X_flat = X.ravel()
+    offsets = np.arange(X.shape[0], dtype=np.intp) * X.shape[1]
+    node = np.zeros(X.shape[0], dtype=np.intp)
+    probas = {}
+    for depth in range(max(depths)+1):
+        if depth in depths:
+            probas[depth] = tree['proba'][node]
+        if depth < tree['max_depth']:
+            node = _step(tree, X_flat, offsets, node)
+    return probas
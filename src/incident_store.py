@@ -0,0 +1,221 @@
+""" incident_store:
+    Typed columnar storage (Parquet) of the incident tickets
+    - the text columns are stored as categories, the 0/1 flags and days_to_resolve as small integers
+    - the csv files remain available as import / export format: a csv file that is newer than its Parquet file is imported
+    - the incidents can be read in batches (row groups of the Parquet file) for the out-of-core analysis
+    - a refresh (see incremental.py) does not rewrite the store: the added incidents and the incidents that they replace or
+      that expire are written as a change part (<store>.changes/<part>.added.parquet, <part>.removed.parquet).
+      The parts are applied when the store is read, a full write of the store (compaction) removes them
+Input:
+    - csv file with incidents (the Parquet file is stored next to it with the .parquet suffix)
+Output:
+    - dataframe with typed columns (or batches of incidents)
+"""
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+from stats import key_columns
+
+# data types of the incident columns (columns that are not listed keep the type determined by pandas)
+incident_dtypes = {
+    'close_code': 'category',
+    'breached_reason_code': 'category',
+    'contact_type': 'category',
+    'appl_tier': 'category',
+    'kcs_solution': 'category',
+    'company': 'category',
+    'group': 'category',
+    'application': 'category',
+    'self_service': 'int8',
+    'reopened': 'int8',
+    'has_knowledge_article': 'int8',
+    'caller_vip': 'int8',
+    'days_to_resolve': 'int8',  # truncated to 15 days
+    'user_dissatisfied': 'int8',
+    'user_responded': 'int8',
+    'sla_breached': 'int8',
+    'caller_is_employee': 'int8',
+    'priority_is_4': 'int8',
+    'no resolution': 'int8',
+    'reassignment_count': 'float32', # may contain missing values
+    'resolved_date_utc': 'datetime64[ns]',
+}
+
+# Parquet types of the incident columns (see write_incident_batches)
+arrow_types = {'category': pa.string(), 'int8': pa.int8(), 'float32': pa.float32(), 'datetime64[ns]': pa.timestamp('ns')}
+
+def store_file(csv_file):
+    """ Parquet file that corresponds with the csv file """
+    return Path(csv_file).with_suffix('.parquet')
+
+def changes_dir(csv_file):
+    """ folder with the change parts of the store """
+    return Path(csv_file).with_suffix('.changes')
+
+def change_parts(csv_file):
+    """ numbers of the change parts of the store, in the order in which they were written """
+    folder = changes_dir(csv_file)
+    if not folder.exists():
+        return []
+    return sorted({int(file.name.split('.')[0]) for file in folder.glob("*.parquet")})
+
+def part_file(csv_file, part, kind):
+    """ Parquet file with the added or removed incidents (kind) of a change part """
+    return changes_dir(csv_file) / f"{part:05d}.{kind}.parquet"
+
+def change_files(csv_file):
+    """ files of the change parts of the store (e.g. for the key of the cache) """
+    return [file for part in change_parts(csv_file) for kind in ['added', 'removed'] if (file := part_file(csv_file, part, kind)).exists()]
+
+def read_part(csv_file, part, kind, columns=None):
+    """ read the added or removed incidents of a change part
+    Input: csv file, number of the part, kind ('added', 'removed'), columns to read (default: all columns)
+    Returns: dataframe with typed columns, None when the part has no such incidents
+    """
+    file = part_file(csv_file, part, kind)
+    return typed_incidents(pd.read_parquet(file, columns=columns)) if file.exists() else None
+
+def write_changes(df_added, df_removed, csv_file):
+    """ write the added incidents and the incidents that they replace or that expire as the next change part of the store
+    Input: dataframes with the added and the removed incidents (empty dataframes are not written), csv file
+    Returns: number of the part (None when there are no changes)
+    """
+    if len(df_added) == 0 and len(df_removed) == 0:
+        return None
+    parts = change_parts(csv_file)
+    part = parts[-1] + 1 if parts else 1
+    changes_dir(csv_file).mkdir(exist_ok=True)
+    for df, kind in [(df_added, 'added'), (df_removed, 'removed')]:
+        if len(df) > 0:
+            typed_incidents(df).to_parquet(part_file(csv_file, part, kind), index=False)
+    return part
+
+def clear_changes(csv_file):
+    """ remove the change parts of the store (when the store is written in full) """
+    shutil.rmtree(changes_dir(csv_file), ignore_errors=True)
+
+def removed_keys(csv_file, parts):
+    """ incident numbers that are removed after every part: the incidents of a part (0: the Parquet file) that are replaced
+        or expired by a later part are not read
+    Input: csv file, numbers of the change parts
+    Returns: dictionary part -> incident numbers removed by the later parts
+    """
+    key = key_columns[0]
+    removed, keys = {}, pd.Index([])
+    for part in reversed(parts):
+        removed[part] = keys
+        df = read_part(csv_file, part, 'removed', [key])
+        if df is not None:
+            keys = keys.append(pd.Index(df[key].astype(str)))
+    removed[0] = keys
+    return removed
+
+def typed_incidents(df):
+    """ convert the incident columns to their compact data type
+    Input: dataframe with incidents
+    Returns: dataframe with typed columns
+    """
+    return df.astype({col: dtype for col, dtype in incident_dtypes.items() if col in df.columns})
+
+def write_incidents(df, csv_file, csv=True):
+    """ write the incidents to the Parquet store and (optionally) export them to csv
+    Input: dataframe with incidents, csv file, csv: also export to csv
+    Returns: dataframe with typed columns
+    """
+    df = typed_incidents(df)
+    if csv:
+        df.to_csv(csv_file, index=False)
+    df.to_parquet(store_file(csv_file), index=False)
+    clear_changes(csv_file)
+    return df
+
+def write_incident_batches(batches, csv_file, csv=True):
+    """ write batches of incidents incrementally to the Parquet store and (optionally) to csv
+        only one batch is held in memory: the Parquet file is written per row group, the csv file is appended
+    Input: iterable with dataframes (same columns), csv file, csv: also export to csv
+    Returns: number of incidents written
+    """
+    writer = None
+    count = 0
+    try:
+        for df in batches:
+            df = typed_incidents(df)
+            # the categories differ per batch: the text columns are stored as strings (dictionary encoded by Parquet)
+            df = df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+            if writer is None:
+                fields = [pa.field(col, arrow_types[incident_dtypes[col]]) if col in incident_dtypes 
+                          else pa.Schema.from_pandas(df[[col]], preserve_index=False).field(col) for col in df.columns]
+                schema = pa.schema(fields)
+                writer = pq.ParquetWriter(store_file(csv_file), schema)
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            if csv:
+                df.to_csv(csv_file, index=False, mode='w' if count == 0 else 'a', header=(count == 0))
+            count += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    clear_changes(csv_file)
+
+    return count
+
+def read_incidents(csv_file):
+    """ read the incidents from the Parquet store (with its change parts)
+        the csv file is (re-)imported into the store when there is no store yet or when the csv file is more recent
+    Input: csv file
+    Returns: dataframe with typed columns
+    """
+    csv_file = Path(csv_file)
+    parquet_file = store_file(csv_file)
+    if parquet_file.exists() and (not csv_file.exists() or parquet_file.stat().st_mtime >= csv_file.stat().st_mtime):
+        parts = change_parts(csv_file)
+        if not parts:
+            return typed_incidents(pd.read_parquet(parquet_file))
+        removed = removed_keys(csv_file, parts)
+        dfs = [(0, pd.read_parquet(parquet_file))] + [(part, read_part(csv_file, part, 'added')) for part in parts]
+        key = key_columns[0]
+        return typed_incidents(pd.concat([df[~df[key].astype(str).isin(removed[part])] for part, df in dfs if df is not None], ignore_index=True))
+
+    df = pd.read_csv(csv_file, dtype={col: dtype for col, dtype in incident_dtypes.items() if dtype == 'category'})
+    return write_incidents(df, csv_file, csv=False)
+
+def import_incidents(csv_file, batch_size=1_000_000):
+    """ import the csv file into the Parquet store in batches (when there is no store yet or when the csv file is more recent)
+        only one batch of the csv file is held in memory
+    Input: csv file, number of incidents per batch
+    Returns: Parquet file
+    """
+    csv_file = Path(csv_file)
+    parquet_file = store_file(csv_file)
+    if not parquet_file.exists() or (csv_file.exists() and parquet_file.stat().st_mtime < csv_file.stat().st_mtime):
+        batches = pd.read_csv(csv_file, chunksize=batch_size, dtype={col: dtype for col, dtype in incident_dtypes.items() if dtype == 'category'})
+        write_incident_batches(batches, csv_file, csv=False)
+    return parquet_file
+
+def store_columns(csv_file, batch_size=1_000_000):
+    """ columns of the Parquet store (the csv file is imported first when needed, see import_incidents) """
+    return pq.ParquetFile(import_incidents(csv_file, batch_size)).schema_arrow.names
+
+def read_incident_batches(csv_file, batch_size=1_000_000, columns=None):
+    """ read the incidents from the Parquet store in batches (the csv file is imported first when needed, see import_incidents)
+        the incidents of the change parts are read after the incidents of the Parquet file
+    Input: csv file, number of incidents per batch, columns to read (default: all columns)
+    Returns: iterator over dataframes with typed columns (the categories differ per batch)
+    """
+    parquet_file = import_incidents(csv_file, batch_size)
+    parts = change_parts(csv_file)
+    removed = removed_keys(csv_file, parts)
+    key = key_columns[0]
+    # the incident numbers are read to skip the removed incidents
+    read_columns = columns if columns is None or not parts or key in columns else list(columns) + [key]
+    files = [(0, parquet_file)] + [(part, part_file(csv_file, part, 'added')) for part in parts]
+    for part, file in files:
+        if not file.exists():
+            continue
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=read_columns):
+            df = batch.to_pandas()
+            if len(removed[part]) > 0:
+                df = df[~df[key].astype(str).isin(removed[part])].reset_index(drop=True)
+            yield typed_incidents(df if read_columns is columns else df.drop(columns=key))
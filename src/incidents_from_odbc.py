@@ -1,105 +1,201 @@
-""" 
+"""
 Read incident tickets containing survey resonses for the last 365 days from Enterprise Data Lake
-Write these tickets to a csv file
+Write these tickets to a Parquet file (typed columns) and a csv file
 Return the tickets as a dataframe
+
+The result sets are streamed: the rows are fetched in batches (fetchmany), every batch is transformed
+and appended to the output files before the next batch is fetched
+The two queries are independent: main.py runs them concurrently on a pool of connections (see extraction.py)
 """
 # Load data with Pyodbc
 import pandas as pd
 import numpy as np
-import pyodbc
+from datetime import datetime, timedelta
 from transform_attributes import transform_df_upon_db_retrieval, transform_all_incidents_upon_db_retrieval
+from incident_store import write_incident_batches, read_incidents
+from pseudonymise import pseudonyms_file, read_pseudonyms, write_pseudonyms
+
+# number of rows fetched from the database at once
+batch_size = 10000
+
+# timeouts of the ODBC connection in seconds
+login_timeout = 60     # to connect to the data lake
+query_timeout = 3600   # per execute / fetch of a query (0: no timeout)
 
-# Return cursor result as a dataframe
-def as_pandas_DataFrame(cursor):
-    "function to return cursor data to a dataframe"
+# fields that may be correlated with the survey response, retrieved for the incidents with a survey response and for all incidents
+# (the same factors for both: one model scores all incidents, see propensity.py), the incident number identifies the incident in the stores
+incident_fields = """incident_number,
+    close_code,
+    breached_reason_code,
+    contact_type, self_service, incident_reopened_flag reopened,
+    sla_result, sla_priority,
+    am_ttr,
+    incident_has_ka_related_flag has_knowledge_article,
+    reassignment_count,
+    appl_tier,
+    caller_vip, caller_employee_type,
+    survey_response_value,
+    ci_name, assignment_group_company, assignment_group_name, kcs_solution,
+    resolved_date_utc"""
+
+def connect():
+    "function to connect through ODBC as defined on the machine where this code is run, with the login and query timeouts"
+    import pyodbc # imported here so that the other functions can be used with another DB-API connection (e.g. sqlite3)
+    conn = pyodbc.connect(f'DSN=ODBC Impala', autocommit=True, timeout=login_timeout)
+    conn.timeout = query_timeout
+    return conn
+
+def resolved_since(days=365):
+    "function to return the (UTC) start of the period for which the incidents are retrieved, as a timestamp literal"
+    return (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+# Return cursor result as a sequence of dataframes
+def fetch_batches(cursor, size=batch_size):
+    "function to return cursor data as dataframes of at most 'size' rows, built column by column"
     names = [metadata[0] for metadata in cursor.description]
-    return pd.DataFrame([dict(zip(names, row)) for row in cursor], columns=names)
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        columns = list(zip(*rows)) # transpose the rows into columns
+        yield pd.DataFrame(dict(zip(names, columns)), columns=names)
 
 
-def get_incidents_from_db(
-    incident_file: str,
-) -> pd.DataFrame:
-    """ Retrieve the Incidents that contain a customer survey resonse from the data lake
-        Create connection to EDL through ODBC
+def incident_batches(conn, since, pseudonyms=None):
+    """ Retrieve the Incidents that contain a customer survey resonse and that are resolved after 'since'
     Input:
-        - File to which to store the retrieved data
+        - Connection to the data lake
+        - Timestamp (UTC) after which the incidents are resolved
+        - Mapping tables to anonymise companies, groups and applications (see transform_df_upon_db_retrieval)
     Output:
-        - Dataframe with the data retrieved from the data lake
+        - Transformed dataframes, one per batch
     """
 
-    # Connect through ODBC as defined on the machine where this code is run
-    conn = pyodbc.connect(f'DSN=ODBC Impala', autocommit=True)
-
     # Get cursor to interact with the SQL engine
     cursor = conn.cursor()
 
-    # Select incident tickets for the last year where the user provided a survey response
+    # Select incident tickets where the user provided a survey response
     # retrieve fields that may be correlated with the survey response
-    Query = """
-    select close_code, 
-    breached_reason_code,
-    contact_type, self_service, incident_reopened_flag reopened, 
-    sla_result, sla_priority, 
-    am_ttr,
-    incident_has_ka_related_flag has_knowledge_article,
-    reassignment_count,
-    appl_tier, 
-    caller_vip, caller_employee_type, 
-    survey_response_value,
-    ci_name, assignment_group_company, assignment_group_name, kcs_solution
+    Query = f"""
+    select {incident_fields}
     from datamart_core.dm_incidentcube
     where survey_response_value > 0
     and am_ttr > 0
     and assignment_group_parent in ('PARENT APP MAINTENANCE', 'PARENT APP SERVICES SUPPORT')
-    and resolved_date_utc > date_sub(now(),365)"""
+    and resolved_date_utc > '{since}'"""
 
     cursor.execute(Query)
-    df = as_pandas_DataFrame(cursor) # Convert result set into pandas DataFrame
 
-    # Transform the dataframe
-    df = transform_df_upon_db_retrieval (df)
+    # the mapping tables are shared by the batches so that companies, groups and applications are anonymised consistently
+    if pseudonyms is None:
+        pseudonyms = {}
+    for df in fetch_batches(cursor):
+        yield transform_df_upon_db_retrieval(df, pseudonyms)
 
-    # Write result set to Excel
-    df.to_csv(incident_file, index=False)
 
-    return df
-
-
-def get_all_incidents_from_db(
-    incident_file: str,
-) -> pd.DataFrame:
-    """ Retrieve all Incidents (not just those for which users entered a satisfaction ratio) from the data lake
-        Create connection to EDL through ODBC
-        write to csv file
+def all_incident_batches(conn, since, pseudonyms=None):
+    """ Retrieve all Incidents (not just those for which users entered a satisfaction ratio) that are resolved after 'since'
     Input:
-        - csv File to which to store the retrieved data
+        - Connection to the data lake
+        - Timestamp (UTC) after which the incidents are resolved
+        - Mapping tables to anonymise companies, groups and applications (shared with the incidents with a survey response)
     Output:
-        - Dataframe with the data retrieved from the data lake
+        - Transformed dataframes, one per batch
     """
 
-    # Connect through ODBC as defined on the machine where this code is run
-    conn = pyodbc.connect(f'DSN=ODBC Impala', autocommit=True)
-
     # Get cursor to interact with the SQL engine
     cursor = conn.cursor()
 
-    # Select incident tickets for the last year
-    # retrieve fields are correlated with the survey response
-    Query = """
-    select incident_reopened_flag reopened, am_ttr, close_code, survey_response_value
+    # Select incident tickets
+    # retrieve the same fields as for the incidents with a survey response
+    Query = f"""
+    select {incident_fields}
     from datamart_core.dm_incidentcube
-    where contact_type not in ("Event Management") 
+    where contact_type not in ("Event Management")
     and am_ttr > 0
     and assignment_group_parent in ('PARENT APP MAINTENANCE', 'PARENT APP SERVICES SUPPORT')
-    and resolved_date_utc > date_sub(now(),365)"""
+    and resolved_date_utc > '{since}'"""
 
     cursor.execute(Query)
-    df = as_pandas_DataFrame(cursor) # Convert result set into pandas DataFrame
 
-    # Transform the dataframe
-    df = transform_all_incidents_upon_db_retrieval (df)
+    if pseudonyms is None:
+        pseudonyms = {}
+    for df in fetch_batches(cursor):
+        yield transform_all_incidents_upon_db_retrieval(df, pseudonyms)
 
-    # Write result set to csv format
-    df.to_csv(incident_file, index=False)
 
-    return df
+def get_incidents_from_db(
+    incident_file: str,
+    conn=None,
+    read=True,
+    pseudonyms=None,
+) -> pd.DataFrame:
+    """ Retrieve the Incidents of the last 365 days that contain a customer survey resonse from the data lake
+        Create connection to EDL through ODBC
+    Input:
+        - File to which to store the retrieved data
+        - Connection to use (default: ODBC connection to the data lake)
+        - read: return the stored incidents (False: only store them, for the out-of-core analysis)
+        - Mapping tables to anonymise companies, groups and applications (default: read from and written to the pseudonyms file)
+    Output:
+        - Dataframe with the data retrieved from the data lake (None when not read)
+    """
+
+    # Connect through ODBC as defined on the machine where this code is run
+    own_connection = conn is None
+    if own_connection:
+        conn = connect()
+
+    try:
+        # Transform every batch and write it to the typed columnar store and to csv
+        # the pseudonyms of previous extractions are reused
+        own_pseudonyms = pseudonyms is None
+        if own_pseudonyms:
+            pseudonyms = read_pseudonyms(pseudonyms_file(incident_file))
+        write_incident_batches(incident_batches(conn, resolved_since(), pseudonyms), incident_file)
+        if own_pseudonyms:
+            write_pseudonyms(pseudonyms_file(incident_file), pseudonyms)
+    finally:
+        if own_connection:
+            conn.close()
+
+    return read_incidents(incident_file) if read else None
+
+
+def get_all_incidents_from_db(
+    incident_file: str,
+    conn=None,
+    read=True,
+    pseudonyms=None,
+) -> pd.DataFrame:
+    """ Retrieve all Incidents of the last 365 days (not just those for which users entered a satisfaction ratio) from the data lake
+        Create connection to EDL through ODBC
+        write to csv file
+    Input:
+        - csv File to which to store the retrieved data
+        - Connection to use (default: ODBC connection to the data lake)
+        - read: return the stored incidents (False: only store them, for the out-of-core analysis)
+        - Mapping tables to anonymise companies, groups and applications (default: read from and written to the pseudonyms file)
+    Output:
+        - Dataframe with the data retrieved from the data lake (None when not read)
+    """
+
+    # Connect through ODBC as defined on the machine where this code is run
+    own_connection = conn is None
+    if own_connection:
+        conn = connect()
+
+    try:
+        # Transform every batch and write it to the typed columnar store and to csv
+        # the pseudonyms are shared with the incidents with a survey response
+        own_pseudonyms = pseudonyms is None
+        if own_pseudonyms:
+            pseudonyms = read_pseudonyms(pseudonyms_file(incident_file))
+        write_incident_batches(all_incident_batches(conn, resolved_since(), pseudonyms), incident_file)
+        if own_pseudonyms:
+            write_pseudonyms(pseudonyms_file(incident_file), pseudonyms)
+    finally:
+        if own_connection:
+            conn.close()
+
+    return read_incidents(incident_file) if read else None
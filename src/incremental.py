@@ -0,0 +1,161 @@
+""" incremental:
+    Daily refresh of the incident stores instead of a full extraction of the last 365 days
+    - only the incidents resolved after the last refresh (high-watermark) minus the survey response latency are retrieved:
+      a survey response arrives days after the resolution, the incidents of the lookback window are retrieved again
+    - the retrieved incidents replace the incidents in the store with the same incident number (upsert):
+      a later survey response or a reopened and again resolved incident is not added twice
+    - incidents resolved before the window (365 days) are expired from the store
+    - the store is not rewritten by a refresh: the added and removed incidents are written as a change part of the store
+      (see incident_store.py), the store and its csv file are written in full after max_change_parts refreshes (compaction)
+    - the contingency counts (counts per factor value and response) are updated with the added and expired incidents
+Input:
+    - connection to the data lake
+    - csv files of the stores (the Parquet files are stored next to them)
+Output:
+    - updated stores, state files (high-watermark) and counts files
+"""
+import json
+import pickle
+import pandas as pd
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from incidents_from_odbc import incident_batches, all_incident_batches, resolved_since
+from incident_store import store_file, store_columns, read_incidents, read_incident_batches, write_incidents, write_changes, change_parts
+from stats import contingency_tables, update_contingency_tables, key_columns
+from pseudonymise import pseudonyms_file, read_pseudonyms, write_pseudonyms
+
+# days after the resolution in which survey responses arrive: the incidents resolved in these days before the high-watermark are retrieved again
+response_latency_days = 14
+# refreshes (change parts of the store) after which the store is written in full again
+max_change_parts = 30
+
+def state_file(csv_file):
+    """ json file with the high-watermark of the store """
+    return Path(csv_file).with_suffix('.state.json')
+
+def counts_file(csv_file):
+    """ pickle file with the contingency counts of the store """
+    return Path(csv_file).with_suffix('.counts.pkl')
+
+def read_json(file, default=None):
+    """ read a json file, return default when the file does not exist """
+    if not Path(file).exists():
+        return default
+    with open(file) as f:
+        return json.load(f)
+
+def write_json(file, data):
+    """ write data to a json file """
+    with open(file, 'w') as f:
+        json.dump(data, f, indent=1)
+
+def read_counts(csv_file):
+    """ read the contingency counts of the store
+    Input: csv file of the store
+    Returns: dictionary with the contingency tables, None when there are no counts for the current content of the store
+    """
+    counts, parquet = counts_file(csv_file), store_file(csv_file)
+    if not counts.exists() or not parquet.exists() or counts.stat().st_mtime < parquet.stat().st_mtime:
+        return None
+    with open(counts, 'rb') as f:
+        return pickle.load(f)
+
+def refresh_store(batches_since, csv_file, response, window_days=365, latency_days=response_latency_days, read=True):
+    """ upsert the incidents resolved after the high-watermark minus the response latency in the store
+        and expire the incidents resolved before the window
+        the store is not rewritten: the retrieved incidents and the incidents that they replace or that expire are written
+        as a change part of the store (see incident_store.write_changes), the parts are compacted after max_change_parts refreshes
+        a full extraction is done when the store has no high-watermark (or no resolution dates or incident numbers)
+    Input:
+        batches_since: function that returns the transformed batches of incidents resolved after a given timestamp
+        csv_file: csv file of the store
+        response: response column of the contingency counts
+        window_days: number of days that incidents are kept
+        latency_days: number of days before the high-watermark that are retrieved again (late survey responses)
+        read: return the incidents in the store (False: only refresh the store)
+    Returns: dataframe with the incidents in the store (None when not read)
+    """
+    key = key_columns[0]
+    state = read_json(state_file(csv_file))
+    tables = read_counts(csv_file)
+    columns = store_columns(csv_file) if state is not None and store_file(csv_file).exists() else []
+    if tables is None or not {'resolved_date_utc', key}.issubset(columns):
+        print("Full extraction for", csv_file)
+        full, since = True, resolved_since(window_days)
+    else:
+        full, since = False, (pd.Timestamp(state['watermark']) - timedelta(days=latency_days)).strftime('%Y-%m-%d %H:%M:%S')
+        print("Retrieve incidents resolved after", since, "for", csv_file)
+
+    # retrieve the new incidents
+    batches = list(batches_since(since))
+    df_new = pd.concat(batches, ignore_index=True) if len(batches) > 0 else pd.DataFrame()
+    if 'resolved_date_utc' in df_new.columns:
+        df_new['resolved_date_utc'] = pd.to_datetime(df_new['resolved_date_utc'])
+    if key in df_new.columns:
+        df_new = df_new.drop_duplicates(subset=key, keep='last')
+    watermarks = [df_new['resolved_date_utc'].max()] if len(df_new) > 0 else []
+
+    if full:
+        write_incidents(df_new, csv_file)
+        tables = contingency_tables(df_new, response=response)
+        n_store, n_replaced, n_expired = len(df_new), 0, 0
+    else:
+        # expire the incidents resolved before the window, replace the incidents that are retrieved again (same incident number):
+        # the store is read in batches, only the removed incidents are kept
+        cutoff = datetime.utcnow() - timedelta(days=window_days)
+        new_keys = df_new[key].astype(str) if key in df_new.columns else pd.Series([], dtype=str)
+        removed, n_store, n_replaced, n_expired = [], len(df_new), 0, 0
+        for df in read_incident_batches(csv_file):
+            expired = df['resolved_date_utc'] <= cutoff
+            replaced = df[key].astype(str).isin(new_keys) & ~expired
+            removed.append(df[expired | replaced])
+            n_store += (~(expired | replaced)).sum()
+            n_replaced, n_expired = n_replaced + replaced.sum(), n_expired + expired.sum()
+            watermarks.append(df['resolved_date_utc'].max())
+        df_removed = pd.concat(removed, ignore_index=True) if removed else df_new.iloc[0:0]
+
+        # one change set for the store, the contingency counts and the trend counts (see trend.update_trends)
+        write_changes(df_new, df_removed, csv_file)
+        tables = update_contingency_tables(tables, df_new, df_removed, response=response)
+        if len(change_parts(csv_file)) >= max_change_parts: # compaction: the store and the csv file are written in full
+            write_incidents(read_incidents(csv_file), csv_file)
+    print(len(df_new) - n_replaced, "incidents added,", n_replaced, "incidents replaced,", n_expired, "incidents expired,",
+          n_store, "incidents in", csv_file)
+
+    with open(counts_file(csv_file), 'wb') as f:
+        pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+    watermarks = [watermark for watermark in watermarks if pd.notna(watermark)]
+    if watermarks:
+        write_json(state_file(csv_file), {'watermark': max(watermarks).strftime('%Y-%m-%d %H:%M:%S')})
+
+    return read_incidents(csv_file) if read else None
+
+def refresh_incidents(conn, incident_file, window_days=365, pseudonyms=None, read=True):
+    """ refresh the store with the incidents that have a survey response
+    Input: connection, csv file of the store, number of days that incidents are kept,
+           mapping tables (default: read from and written to the pseudonyms file), read: return the incidents in the store
+    Returns: dataframe with the incidents (None when not read)
+    """
+    # the pseudonyms are kept so that the added incidents are anonymised in the same way as the incidents in the store
+    own_pseudonyms = pseudonyms is None
+    if own_pseudonyms:
+        pseudonyms = read_pseudonyms(pseudonyms_file(incident_file))
+    df = refresh_store(lambda since: incident_batches(conn, since, pseudonyms), incident_file, 'user_dissatisfied', window_days, read=read)
+    if own_pseudonyms:
+        write_pseudonyms(pseudonyms_file(incident_file), pseudonyms)
+    return df
+
+def refresh_all_incidents(conn, incident_file, window_days=365, pseudonyms=None, read=True):
+    """ refresh the store with all incidents, the counts give the survey response ratios
+    Input: connection, csv file of the store, number of days that incidents are kept,
+           mapping tables (default: read from and written to the pseudonyms file), read: return the incidents in the store
+    Returns: dataframe with the incidents (None when not read)
+    """
+    own_pseudonyms = pseudonyms is None
+    if own_pseudonyms:
+        pseudonyms = read_pseudonyms(pseudonyms_file(incident_file))
+    df = refresh_store(lambda since: all_incident_batches(conn, since, pseudonyms), incident_file, 'user_responded', window_days, read=read)
+    if own_pseudonyms:
+        write_pseudonyms(pseudonyms_file(incident_file), pseudonyms)
+    return df
@@ -3,33 +3,53 @@
     - Determines statisical correlation between user dissatisfaction and incident attributes
     - Builds regression model: determines expected dissatisfaction ratio against the combination of incident attributes
     - Applies the model to the tickets with and without survey responses
+    - the stages of the analysis and the reports are in pipeline.py, main.py reads the incidents, caches the results and runs the stages
     
     to run: python main.py
 
 Attributes:
     - -d to retrieve tickets from the data lake (and create a new csv file for subsequent use)
+    - -i to only retrieve the tickets resolved since the previous retrieval from the data lake (and update the csv file)
     - filename of the excel file
+    - --no-cache to neither use nor store cached results, --rebuild to recompute and refresh the cached results
+    - --format, --dpi to choose the format and resolution of the graphs, --jobs for the number of rendering processes
+    - --profile to record the time and memory per stage, --cprofile STAGE to run a stage under cProfile
+    - --export-model to export the model for the scoring of new tickets (see scoring.py)
+    - --chunked to analyse the incidents in batches (out-of-core: for ticket sets that do not fit in memory),
+      --batch-size for the number of incidents per batch, --max-model-rows to fit the models on a sample
+    - --sparse to fit and predict on a sparse feature matrix (instead of a dense matrix in a compact data type)
+    - --target-encoding to add the shrunk dissatisfaction ratios of the company, group and application to the model
+    - --bootstrap N for confidence intervals of the predicted dissatisfaction deltas (N refits of the model on bootstrap samples),
+      --bootstrap-time for the time budget of the refits, --jobs for the number of processes
+    - --reweight to weight the survey incidents by their inverse propensity to respond and to score all incidents with the same model
+      (when all incidents are retrieved with the factors of the model)
+    - --fdr to flag the relevant companies, groups and applications on p-values adjusted for multiple testing
+    - the review of the factors and values and the barcharts are rules in rules.toml (see rules.py)
 
 Input:
     - Datalake : incidents (when -d attribute is provided)
-    - Default Input File: incident_tickets.xlsx (alternative data source when -d is not provided )
+    - Default Input File: incident_tickets.csv, imported into incident_tickets.parquet (alternative data source when -d is not provided )
     
 Output:
-    - Several Excel files in the 'out' folder: factors, factor_values, support company, support group, application
+    - Several Excel files in the 'out' folder: factors, factor_values, support company, support group, application,
+      weekly and monthly trend alerts (when the incidents have resolution dates), calibration of the model (total and per company, group)
     - Several png files (graphs) in the 'out' folder
 """
 
-import pandas as pd
-import numpy as np
 import sys
 from pathlib import Path
 import argparse
 
-from incidents_from_odbc import get_incidents_from_db, get_all_incidents_from_db
-from stats import chi2_stats, ratio_stats, binom_stats
-from output import plot_factor_values, create_ordered_excel, write_ordered_plot, write_response_ratio_plot
-from transform_attributes import transform_df_upon_chi2, transform_df_upon_review_values, df_create_dummies, create_Xy
-from model import DecisionTree
+from cache import code_version, fingerprint, load_artifacts, store_artifacts
+
+from extraction import extract_incidents, refresh_concurrently
+from incremental import read_counts
+from incident_store import read_incidents, read_incident_batches, store_columns, change_files
+from pipeline import analyse_incidents, analyse_all_incidents, score_all_incidents, analyse_incidents_chunked, analyse_all_incidents_chunked, score_all_incidents_chunked, write_reports
+from rules import default_rules, analysis_rules, rules_version
+from profiler import create_profiler, stage, measure, write_profile
+from scoring import export_model, default_model_file
+from trend import update_trends
 
 
 def get_project_root() -> Path:
@@ -45,174 +65,111 @@ if __name__ == "__main__":
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-incidents_fname', default="incident_tickets", help="CSV file with Incident data", )
     parser.add_argument('-d', '--db', help="read incident data from database", action='store_true')
+    parser.add_argument('-i', '--incremental', help="only read the incidents resolved since the last refresh from the database", action='store_true')
+    parser.add_argument('--no-cache', help="do not use or store cached results", action='store_true')
+    parser.add_argument('--rebuild', help="ignore cached results and recompute (the cache is refreshed)", action='store_true')
+    parser.add_argument('--cache-size', type=int, default=5, help="number of cached results to keep")
+    parser.add_argument('--format', default="png", help="format of the graphs (png, svg, pdf, ...)")
+    parser.add_argument('--dpi', type=int, default=300, help="resolution of the graphs")
+    parser.add_argument('--jobs', type=int, default=-1, help="number of processes that render the Excel files and graphs and fit the bootstrap replicates (-1: one per CPU)")
+    parser.add_argument('--profile', help="record the time and memory per stage in out/profile.json and out/profile.csv", action='store_true')
+    parser.add_argument('--cprofile', metavar='STAGE', help="run the given stage (e.g. chi2, model, counterfactual, render) under cProfile, written to out/STAGE.prof")
+    parser.add_argument('--export-model', nargs='?', const=str(default_model_file), metavar='FILE', help="export the model to score new tickets (see scoring.py)")
+    parser.add_argument('--chunked', help="analyse the incidents in batches read from the Parquet store (out-of-core, bounded memory)", action='store_true')
+    parser.add_argument('--batch-size', type=int, default=1_000_000, help="number of incidents per batch (with --chunked)")
+    parser.add_argument('--max-model-rows', type=int, default=None, help="fit the models on a random sample of about this number of incidents (with --chunked)")
+    parser.add_argument('--sparse', help="fit and predict on a sparse feature matrix (for one hot encoded factors with many values)", action='store_true')
+    parser.add_argument('--target-encoding', help="add the shrunk dissatisfaction ratios of the company, group and application (out of fold) to the model", action='store_true')
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='N', help="bootstrap intervals of the predicted dissatisfaction deltas with N refits of the model (0: no intervals)")
+    parser.add_argument('--bootstrap-time', type=float, default=None, metavar='SECONDS', help="time budget of the bootstrap refits (no new refits are started when the budget would be exceeded)")
+    parser.add_argument('--reweight', help="weight the survey incidents by their inverse propensity to respond and score all incidents with the same model", action='store_true')
+    parser.add_argument('--fdr', help="correct the p-values of the companies, groups and applications for multiple testing (Benjamini-Hochberg)", action='store_true')
     args = parser.parse_args()
 
     # Define the paths to be used
     project_path = get_project_root()
     data_dir = project_path / "data"
     output_dir = project_path / "out"
+    cache_dir = project_path / "cache"
 
-    factors_data_file = output_dir / f"00 factors.xlsx"
-    factor_values_data_file = output_dir / f"01 factor_values.xlsx"
-    factor_values_data_file_initial = output_dir / f"01 initial_factor_values.xlsx"
+    # Record the time and memory per stage when requested
+    profiler = create_profiler(args.cprofile, output_dir) if (args.profile or args.cprofile) else None
 
     # Create dataframe with the incidents either from the database or Excel file
+    # (the queries of the incidents with a survey response and of all incidents run concurrently, see extraction.py)
     incident_data_file = data_dir / f"{args.incidents_fname}.csv"
     all_incidents_data_file = data_dir / f"all_incidents.csv"
     
     if (args.db): 
-        print("Read incidents from database and store in", incident_data_file)
-        df_incidents = get_incidents_from_db(incident_data_file)
-        df_all_incidents = get_all_incidents_from_db(all_incidents_data_file)
+        with stage(profiler, "extract"):
+            print("Read incidents from database and store in", incident_data_file, "and", all_incidents_data_file)
+            # the out-of-core analysis reads the stored incidents in batches
+            df_incidents, df_all_incidents = extract_incidents(incident_data_file, all_incidents_data_file, read=not args.chunked)
+    elif (args.incremental):
+        with stage(profiler, "extract"):
+            print("Refresh incidents from database and store in", incident_data_file, "and", all_incidents_data_file)
+            df_incidents, df_all_incidents = refresh_concurrently(incident_data_file, all_incidents_data_file, read=not args.chunked)
+
+    # The survey incidents can only be reweighted when all incidents have their factors (as retrieved from the data lake)
+    reweight = args.reweight and set(store_columns(incident_data_file, args.batch_size)) <= set(store_columns(all_incidents_data_file, args.batch_size))
+    if args.reweight and not reweight:
+        print("All incidents do not have the factors of the model (retrieve them with -d): all incidents are scored with the simplified model")
+
+    # The results are cached for the given input files, source code and the rules that affect the analysis
+    # (a change of the report rules only recreates the reports, see rules.analysis_rules)
+    with stage(profiler, "cache_load"):
+        mode = f"chunked {args.max_model_rows}" if args.chunked else "" # the out-of-core analysis caches other artifacts
+        mode += " sparse" if args.sparse else ""
+        mode += " target_encoding" if args.target_encoding else ""
+        mode += f" bootstrap {args.bootstrap} {args.bootstrap_time}" if args.bootstrap else ""
+        mode += " reweight" if reweight else ""
+        mode += " rules " + rules_version(analysis_rules(default_rules, store_columns(incident_data_file, args.batch_size), args.chunked))
+        key = fingerprint([incident_data_file, all_incidents_data_file] + change_files(incident_data_file) + change_files(all_incidents_data_file), code_version(Path(__file__).parent) + mode)
+        artifacts = None
+        if not (args.no_cache or args.rebuild):
+            artifacts = load_artifacts(cache_dir, key)
+
+    if artifacts is None and args.chunked:
+        # out-of-core analysis: every pass reads the incidents in batches from the Parquet store
+        all_batches = lambda: read_incident_batches(all_incidents_data_file, args.batch_size)
+        artifacts = analyse_incidents_chunked(lambda: read_incident_batches(incident_data_file, args.batch_size), args.max_model_rows, profiler=profiler, sparse=args.sparse, target_encoding=args.target_encoding,
+                                              bootstrap=args.bootstrap, time_budget=args.bootstrap_time, n_jobs=args.jobs, all_batches=all_batches if reweight else None)
+        if reweight: # one model for the survey incidents and all incidents
+            artifacts.update(score_all_incidents_chunked(all_batches, artifacts, args.sparse, profiler))
+        else:
+            artifacts.update(analyse_all_incidents_chunked(all_batches, args.max_model_rows, profiler=profiler))
+        if not (args.no_cache):
+            with stage(profiler, "cache_store"):
+                store_artifacts(cache_dir, key, artifacts, args.cache_size)
+    elif artifacts is None:
+        if not (args.db or args.incremental):
+            with stage(profiler, "read") as record:
+                print("Read incidents from ", incident_data_file)
+                df_incidents = read_incidents(incident_data_file)
+                df_all_incidents = read_incidents(all_incidents_data_file)
+                measure(record, df_incidents=df_incidents, df_all_incidents=df_all_incidents)
+
+        # the contingency counts that are maintained by the incremental refresh are reused
+        artifacts = analyse_incidents(df_incidents, read_counts(incident_data_file), profiler, args.sparse, args.target_encoding,
+                                      args.bootstrap, args.bootstrap_time, args.jobs, df_all_incidents if reweight else None)
+        if reweight: # one model for the survey incidents and all incidents
+            artifacts.update(score_all_incidents(artifacts, read_counts(all_incidents_data_file), args.sparse, profiler))
+        else:
+            artifacts.update(analyse_all_incidents(df_all_incidents, read_counts(all_incidents_data_file), profiler))
+        if not (args.no_cache):
+            with stage(profiler, "cache_store"):
+                store_artifacts(cache_dir, key, artifacts, args.cache_size)
     else:
-        print("Read incidents from ", incident_data_file)
-        df_incidents = pd.read_csv(incident_data_file)
-        df_all_incidents = pd.read_csv(all_incidents_data_file)
-        
-    # Perfrom chi2 test to identify the relevant factors (columns) and write the factors to an excel file for further manual analysis
-    df_factors = chi2_stats(df_incidents)
-    df_factors.to_excel(factors_data_file,index=False)
-
-    # Transform the data based on a manual review of the factors file
-    df_factors = transform_df_upon_chi2 (df_factors)
-    df_factors.to_excel(factors_data_file,index=False)
-
-    # List the individual values for each factor along with their correlation with user dissatisfaction and write to "01 initial_factor_values.xlsx"
-    df_factor_values = ratio_stats(df_incidents, df_factors)
-    df_factor_values = pd.merge(df_factors, df_factor_values, on = 'factor', how='right')
-    df_factor_values.sort_values(by=['chi', 'factor','value'],ascending=[False,True,True],inplace=True)
-    df_factor_values.to_excel(factor_values_data_file_initial, index=False)
-
-    # Transform the incident data upon review of "01 factor_values.xlsx":
-    df_incidents, df_factors = transform_df_upon_review_values(df_incidents, df_factors)
-
-    # For every value, determine the correlation with customer dissatisfaction after transformation, write ordered df to "01 initial_factor_values.xlsx"
-    df_factor_values = ratio_stats(df_incidents, df_factors)
-    df_factor_values = pd.merge(df_factors, df_factor_values, on = 'factor', how='right')
-    df_factor_values.sort_values(by=['chi', 'factor','value'],ascending=[False,True,True],inplace=True)
-    df_factor_values.to_excel(factor_values_data_file, index=False)   
-
-    # Create dummies for the fields containing multiple categorical values, write ordered df to factor.xlsx
-    df_incidents, df_factors = df_create_dummies(df_incidents, df_factors)
-    df_factors.to_excel(factors_data_file,index=False)
-
-    # Create X and y with maximum of Z factors and apply to DecisionTree (used as regression model)
-    X, y, X_columns = create_Xy(df_incidents, df_factors)
-    df_factors_num = pd.DataFrame({'factor': X_columns, 'colnum': range(len(X_columns))})
-    df_factors = pd.merge(df_factors_num, df_factors, on = 'factor', how='right') #add column number as attribute
-
-    # Create DecisionTree model based on X and y
-    model = DecisionTree(X,y)
-    print(model)
-
-    # add the model feature importances to df_factors and write to factors.xlsx
-    df_model_features = pd.DataFrame(data={'factor': X_columns, 'feature_importance': model.feature_importances_})
-    df_factors = pd.merge(df_factors, df_model_features, on = 'factor', how='left')
-    df_factors.sort_values(by=['feature_importance','chi','p'],ascending=[False,False,True],inplace=True)
-
-    df_factors.to_excel(factors_data_file,index=False)
-
-    # For every value, determine the correlation with customer dissatisfaction after transformation, write ordered df to "01 factor_values.xlsx"
-    df_factor_values = ratio_stats(df_incidents, df_factors)
-    df_factor_values = pd.merge(df_factors, df_factor_values, on = 'factor', how='right')
-
-    # Compute the predicted satisfaction rating across all incident records
-    df_incidents['dissatisfaction_proba'] = model.predict_proba(X)[:,1]
-    avg_dissatisfaction = df_incidents['dissatisfaction_proba'].mean()
-    print(avg_dissatisfaction)
-
-    # For every factor - value combination: compute the predicted satisfaction rating if this value would have been enforced
-    # e.g predict how much customer satisfaction would change if all incidents would be resolved the same day, in 1 day, in 2 days, ...
-
-    df_factor_values['predicted_dissatisfaction'] = avg_dissatisfaction
-    df_factor_values['predicted_dissatisfaction_delta'] = 0
-
-    for index, row in df_factor_values.iterrows():
-        Z = np.copy(X)
-        Z[:,int(row['colnum'])] = row['value'] # replace the actual value with the value for which we want to predict the effect
-        new_col = 'pred_'+ row['factor'] + '_' + str(row['value']) 
-        df_incidents[new_col] = model.predict_proba(Z)[:,1] # predict
-        df_factor_values.loc[index,'predicted_dissatisfaction_delta']=df_incidents[new_col].mean() - avg_dissatisfaction # calculate the difference in satisfaction rating
-        df_incidents[new_col] = df_incidents[new_col] - df_incidents['dissatisfaction_proba'] # replace with the predicted satisfaction with the difference in satisfaction
-
-    df_factor_values["factor_value"] =  df_factor_values["factor"] + ": " + df_factor_values["value"].astype(str) # factor value: combination for reporting purposes
-    df_factor_values.sort_values(by=['feature_importance','chi', 'factor','value'],ascending=[False,False,True,True],inplace=True)
+        print("Use cached results for ", incident_data_file)
 
-    
-    # Write the predicted values to Excel and plot for analysis purposes
-    df_factor_values.to_excel(factor_values_data_file, index=False)   
-    plot_factor_values(df_factor_values, avg_dissatisfaction, output_dir)
-
-    # Create an ordered list of the most impactful factors
-    # "predicted_dissatisfaction_delta" is the predicted reduction in disatisfaction if the factor is eliminated (value associated with the factor = 0)
-    # we are interested in factors that increase dissatisfaction: so look for negative values and eliminate the - sign these for reporting
-    df_most_impactful_factors = df_factor_values[(df_factor_values["predicted_dissatisfaction_delta"]<0) & (df_factor_values["value"]==0)].copy()
-    df_most_impactful_factors["predicted_dissatisfaction_delta"] = df_most_impactful_factors["predicted_dissatisfaction_delta"].apply(lambda x: x*-1)
-    df_most_impactful_factors.sort_values(by="predicted_dissatisfaction_delta", ascending=False, inplace=True)
-
-    # Merge "predicted_dissatisfaction_delta" with the factors
-    df_factors = pd.merge(df_factors, df_most_impactful_factors[["factor","predicted_dissatisfaction_delta"]], on = 'factor', how='left')
-    df_factors.sort_values(by=['predicted_dissatisfaction_delta','feature_importance','chi','p'],ascending=[False,False,False,True],inplace=True)
-    df_factors.to_excel(factors_data_file,index=False)
-
-    # Write Excel files for Company, Company+Group, Company+Group+Application ordered by statistical relevance 
-    create_ordered_excel(df_incidents, ["company"], avg_dissatisfaction, output_dir / f"10 Support Company Dissatisfaction.xlsx")
-    create_ordered_excel(df_incidents, ["company","group"], avg_dissatisfaction, output_dir / f"11 Support Group Dissatisfaction.xlsx")
-    create_ordered_excel(df_incidents, ["company","group","application"], avg_dissatisfaction, output_dir / f"12 Application Dissatisfaction.xlsx")
-
-    # Write barcharts for company, group and application
-    write_ordered_plot(df_incidents, ["company"], avg_dissatisfaction, output_dir / f"51 Support Company Dissatisfaction.png","Companies",1000)
-    write_ordered_plot(df_incidents, ["group"], avg_dissatisfaction, output_dir / f"52 Support Group Dissatisfaction.png","Groups",200)
-    write_ordered_plot(df_incidents, ["application"], avg_dissatisfaction, output_dir / f"53 Support App Dissatisfaction.png","Applications",150)    
-
-    # Plot barcharts for each of the differentiating attributes 
-    write_ordered_plot(df_incidents, ["close_code_Information Provided / Training"], avg_dissatisfaction, output_dir / f"20 Information Provided Dissatisfaction.png","Close Code: Information Provided?",150)    
-    write_ordered_plot(df_incidents, ["reassignment_count"], avg_dissatisfaction, output_dir / f"21 Reassignment Dissatisfaction.png","Ticket Reassignment Count",150)    
-    write_ordered_plot(df_incidents, ["caller_is_employee"], avg_dissatisfaction, output_dir / f"22 Employee Dissatisfaction.png","Reported by Employee? (vs. External)",150)
-    write_ordered_plot(df_incidents, ["has_knowledge_article"], avg_dissatisfaction, output_dir / f"23 Knowledge Article Dissatisfaction.png","Ticket has knowledge article?",150)
-    write_ordered_plot(df_incidents, ["close_code_Data Correction"], avg_dissatisfaction, output_dir / f"24 Data Correction Dissatisfaction.png","Close Code: Data Correction?",150)
-    write_ordered_plot(df_incidents, ["sla_breached"], avg_dissatisfaction, output_dir / f"25 SLA Breached Dissatisfaction.png","SLA Breached?",150)
-    write_ordered_plot(df_incidents, ["self_service"], avg_dissatisfaction, output_dir / f"26 Self Service Dissatisfaction.png","Self Service?",150)
-    write_ordered_plot(df_incidents, ["priority_is_4"], avg_dissatisfaction, output_dir / f"27 Priority 4 Dissatisfaction.png","Priority 4 (versus 1, 2 or 3)",150)
-    write_ordered_plot(df_incidents, ["close_code_Reboot / Restart"], avg_dissatisfaction, output_dir / f"28 Reboot Dissatisfaction.png","Close Code: Reboot, Restart",150)
-    write_ordered_plot(df_incidents, ["close_code_Security Modification"], avg_dissatisfaction, output_dir / f"29 Security Modification Dissatisfaction.png","Close Code: Security Modification",150)
-    write_ordered_plot(df_incidents, ["close_code_Software Correction"], avg_dissatisfaction, output_dir / f"30 Software Correction Dissatisfaction.png","Close Code: Software Correction",150)
-    write_ordered_plot(df_incidents, ["close_code_Environmental Restoration"], avg_dissatisfaction, output_dir / f"31 Environmental Restoration Dissatisfaction.png","Close Code: Environmental Restoration",150)    
-
-    # Read all of the incidents (those with and those without survey responses)
-    # Create a new simplified DecisionTree model (only based on the 3 most determining factors)
-    df_all_incidents_responded = df_all_incidents[df_all_incidents["user_responded"]==1]
-    X = np.array(df_all_incidents_responded[["reopened","days_to_resolve","no resolution"]])
-    y = np.array (df_all_incidents_responded["user_dissatisfied"]).squeeze()
-    model_all_incidents = DecisionTree(X,y)
-    print(model_all_incidents)
-
-    # Apply the simplified model on all incident tickets
-    X = np.array(df_all_incidents[["reopened","days_to_resolve","no resolution"]])
-    df_all_incidents["dissatisfied_proba"] = model_all_incidents.predict_proba(X)[:,1]
-
-    # Average predicted dissatisfaction
-    avg_pred_dissatisfaction_all = df_all_incidents['dissatisfied_proba'].mean()
-    print(avg_pred_dissatisfaction_all)
-
-    Z = np.copy(X)
-    Z[:,int(0)] = 0 # No tickets repened
-    df_all_incidents["pred_reopened_0.0"] = model_all_incidents.predict_proba(Z)[:,1] -  df_all_incidents['dissatisfied_proba']
-
-    Z = np.copy(X)
-    Z[:,int(1)] = 0 # Resolved on day 0
-    df_all_incidents["pred_days_to_resolve_0.0"] = model_all_incidents.predict_proba(Z)[:,1] - df_all_incidents['dissatisfied_proba']
-
-    Z = np.copy(X)
-    Z[:,int(2)] = 0 # no tickets without resolution
-    df_all_incidents["pred_close_code_No Resolution Action_0.0"] = model_all_incidents.predict_proba(Z)[:,1] - df_all_incidents['dissatisfied_proba']
-    
-    df_all_incidents["user_dissatisfied"] = df_all_incidents["dissatisfied_proba"] # We don't have actual dissatisfaction information - use predicted values
-    df_all_incidents["contact_type"] = 1 # Contact type is used to count the records in write_ordered_plot
+    # Counts per group and week / month for the trend alerts (when the incidents have resolution dates)
+    with stage(profiler, "trend"):
+        trends = update_trends(incident_data_file, batch_size=args.batch_size)
 
-    # Plot the result, differentiated by user_reponse
-    write_ordered_plot(df_all_incidents, ["user_responded"], avg_pred_dissatisfaction_all, output_dir / f"08 User Responded Dissatisfaction.png","Dissatisfaction% - User entered survey?",0) 
+    write_reports(artifacts, output_dir, args.fdr, args.format, args.dpi, args.jobs, profiler, trends)
 
-    # Plot the survey response ratios
-    write_response_ratio_plot(df_all_incidents, output_dir / f"07 Survey Response Ratio.png")
+    if args.export_model:
+        export_model(artifacts, args.export_model)
 
+    if profiler is not None:
+        write_profile(profiler, output_dir / "profile")
@@ -2,68 +2,99 @@
     model the ratio of dissatisfied responses with the available factors
     this model identifies the most important causal factors
 Input:
-    - X and y
+    - X (dense or scipy.sparse) and y
 Output:
     - regression model
 """
 import pandas as pd
 import numpy as np
+import scipy.sparse
 
 from sklearn import tree
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import GridSearchCV, ParameterGrid, check_cv, cross_val_predict
+from sklearn.experimental import enable_halving_search_cv # noqa: required to import HalvingGridSearchCV
+from sklearn.model_selection import HalvingGridSearchCV
 from sklearn.metrics import make_scorer
+from joblib import Parallel, delayed
 
-def DecisionTree(X,y):
+from flat_tree import depth_probas
+from diagnostics import decile_calibration_score
+
+# Hyperparameters for the model selection
+params = {
+    'max_depth': [5, 6, 7, 8, 9, 10],
+    'min_samples_leaf': [50, 60, 70, 80, 90, 100, 110, 120, 130],
+    'criterion': ["gini","entropy"]
+}
+
+def _score_pruned(X, y, train, test, criterion, min_samples_leaf, depths, sample_weight=None):
+    """ fit one deep tree on the train set and score it on the test set for every max_depth (weighted when sample weights are given)
+    Returns: list with the scores in the order of depths
+    """
+    clf = tree.DecisionTreeClassifier(criterion=criterion, min_samples_leaf=min_samples_leaf, max_depth=max(depths))
+    clf.fit(X[train], y[train], sample_weight=None if sample_weight is None else sample_weight[train])
+    probas = depth_probas(clf, X[test], depths)
+    test_weight = None if sample_weight is None else sample_weight[test]
+    return [decile_calibration_score(y[test], probas[depth], test_weight) for depth in depths]
+
+def DecisionTree(X,y,search="pruned",sample_weight=None):
     """ build decision tree that predicts user dissatisfaction ratios based on causal factors
     Use a score that evaluate the correctness of the predicted dissatisfaction % across the entire range of satisfaction scores
     Do this instead of trying to correctly predict the satisfaction response for individual tickets
-    Input: 
-        X: available contribution factors  
+    Input:
+        X: available contribution factors
         y: actual user dissatisfaction responses
+        search: hyperparameter search
+            "pruned": evaluate all hyperparameters, with one deep tree per criterion, min_samples_leaf and fold
+                      that is pruned to each max_depth (same selection as "grid" at a fraction of the fits)
+            "grid": exhaustive GridSearchCV
+            "halving": successive halving (HalvingGridSearchCV), the candidates are evaluated on increasing sample sizes
+        sample_weight: weight per incident (e.g. inverse propensity weights, see propensity.py), optional
+            the fits are weighted, the scores of the "pruned" search as well ("grid" and "halving" score unweighted)
     Returns: the model
     """
-    
-    def score_func(y_true, y_pred):
-        """ custom score function to select the hyperparameters that provide the least differences across
-            the full range of actual dissatisfaction ratios 
-            the performance is determined by testing against 10 percentile ranges
-        Input: 
-            y_true: the actual user dissatisfaction
-            y_pred: predicted user dissatisfaction
-        Returns: a score which is higher for better fits
-        """
-        d = {'actual': y_true, 'prob': y_pred}
-
-        # split the data in 10 groups based on the dissatisfaction prediction score
-        # for each of these groups: test to what extent the predicted score for the groups is different from the actual dissatisfaction%
-        df_test = pd.DataFrame(data=d)
-        df_test['dissatisfaction_rank'] = df_test['prob'].rank(pct=True, method='dense')
-        df_test['dissatisfaction_rank'] = df_test['dissatisfaction_rank']*10
-        df_test['dissatisfaction_rank'] = df_test['dissatisfaction_rank'].round(0)
-        df_test['dissatisfaction_rank'] = df_test['dissatisfaction_rank'].astype('int')
-
-        pivot_test = pd.pivot_table(df_test,index=['dissatisfaction_rank',],values=['actual','prob'],aggfunc='sum')
-        pivot_test['diff']=(pivot_test['prob']-pivot_test['actual']).abs()
-
-        return (1/(pivot_test['diff'].mean()))  # 1/x  to return a higher score when the sum of the absolue differences is lower
 
     # we are looking to match the probability across a range of tickets, rather than seeking to predict user dissatisfaction on a per ticket basis
-    score = make_scorer(score_func, greater_is_better=True, needs_proba=True)  
+    score = make_scorer(decile_calibration_score, greater_is_better=True, needs_proba=True)
 
     clf = tree.DecisionTreeClassifier()
 
-    # Hyperparameters for GridSearchCV
-    params = {
-        'max_depth': [5, 6, 7, 8, 9, 10],
-        'min_samples_leaf': [50, 60, 70, 80, 90, 100, 110, 120, 130],
-        'criterion': ["gini","entropy"]
-    }
+    if search == "grid":
+        grid_search = GridSearchCV( estimator=clf,
+                                    param_grid=params,
+                                    n_jobs=-1, verbose=1, cv=5, scoring = score)
+    elif search == "halving":
+        grid_search = HalvingGridSearchCV( estimator=clf,
+                                           param_grid=params,
+                                           n_jobs=-1, verbose=1, cv=5, scoring = score)
+    elif search == "pruned":
+        # convert once instead of on every fit (the trees use float32, a sparse X as CSC matrix)
+        X = scipy.sparse.csc_matrix(X, dtype=np.float32) if scipy.sparse.issparse(X) else np.asarray(X, dtype=np.float32)
+        y = np.asarray(y)
+        sample_weight = None if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+        depths = params['max_depth']
+        splits = list(check_cv(5, y, classifier=True).split(X, y)) # same folds as GridSearchCV
+        tasks = [(criterion, min_samples_leaf, train, test) for criterion in params['criterion']
+                                                             for min_samples_leaf in params['min_samples_leaf']
+                                                             for train, test in splits]
+        print(f"Fitting {len(splits)} folds for each of {len(tasks)//len(splits)} deep trees, pruned to {len(depths)} depths")
+        scores = Parallel(n_jobs=-1)(delayed(_score_pruned)(X, y, train, test, criterion, min_samples_leaf, depths, sample_weight)
+                                     for criterion, min_samples_leaf, train, test in tasks)
+
+        # average the scores over the folds and select the best hyperparameters (first one in ParameterGrid order on a tie, as GridSearchCV)
+        df_scores = pd.DataFrame([{'criterion': criterion, 'min_samples_leaf': min_samples_leaf, 'max_depth': depth, 'score': fold_scores[i]}
+                                  for (criterion, min_samples_leaf, train, test), fold_scores in zip(tasks, scores)
+                                  for i, depth in enumerate(depths)])
+        df_scores = df_scores.groupby(['criterion','max_depth','min_samples_leaf'], sort=False)['score'].mean()
+        candidates = list(ParameterGrid(params))
+        mean_scores = np.array([df_scores[(p['criterion'], p['max_depth'], p['min_samples_leaf'])] for p in candidates])
 
-    grid_search = GridSearchCV( estimator=clf, 
-                                param_grid=params, 
-                                n_jobs=-1, verbose=1, cv=5, scoring = score)
+        clf.set_params(**candidates[int(np.argmax(mean_scores))])
+        return clf.fit(X, y, sample_weight=sample_weight)
+    else:
+        raise ValueError(f"Unknown search: {search}")
 
-    grid_search.fit(X, y)
+    grid_search.fit(X, y, sample_weight=sample_weight)
 
     # Store the result for each of the Hyperparameter combinations
     # score_df = pd.DataFrame(grid_search.cv_results_)
@@ -73,3 +104,15 @@ def DecisionTree(X,y):
     clf_best = grid_search.best_estimator_
 
     return clf_best
+
+def cross_validated_proba(model, X, y, cv=5, sample_weight=None):
+    """ out of fold predicted dissatisfaction: every incident is predicted by a tree (with the hyperparameters of the model)
+        that is fitted on the other folds (the same folds as the hyperparameter search), for an honest calibration (see diagnostics.py)
+    Input: fitted model, X, y, number of folds, weight per incident (optional, as the fit of the model)
+    Returns: array with the predicted dissatisfaction per incident
+    """
+    X = scipy.sparse.csc_matrix(X, dtype=np.float32) if scipy.sparse.issparse(X) else np.asarray(X, dtype=np.float32)
+    y = np.asarray(y)
+    fit_params = None if sample_weight is None else {'sample_weight': np.asarray(sample_weight, dtype=np.float64)}
+    return cross_val_predict(tree.DecisionTreeClassifier(**model.get_params()), X, y, cv=check_cv(cv, y, classifier=True),
+                             method='predict_proba', fit_params=fit_params)[:, 1]
@@ -1,147 +1,186 @@
+""" output:
+    Excel files and charts of the analysis
+    - the data of every chart and Excel file is prepared (aggregated) by the caller
+    - the charts and Excel files are independent jobs that are rendered in a process pool (see render)
+Input:
+    - pre-aggregated dataframes
+Output:
+    - .xlsx files and charts (png by default, other matplotlib formats such as svg or pdf are supported)
+"""
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
-from stats import chi2_stats, ratio_stats, binom_stats
+from joblib import Parallel, delayed
+from stats import chi2_stats, ratio_stats, binom_stats, contingency_tables
+from cube import group_means
+from shrinkage import hierarchical_ratios
+
+def render_job(function, *args):
+    """ run one chart or Excel job, starting from the default matplotlib settings
+        the settings changed by the job (e.g. sns.set) are restored so that the result does not depend on the previous jobs
+    """
+    with plt.rc_context():
+        function(*args)
+
+def render(jobs, n_jobs=-1):
+    """ render independent chart and Excel jobs in a process pool
+    Input:  jobs: list of tuples (function, arguments...), every job only gets its (pre-aggregated) data
+            n_jobs: number of processes (-1: one per CPU, 1: render in this process)
+    Returns: None
+    """
+    Parallel(n_jobs=n_jobs)(delayed(render_job)(*job) for job in jobs)
+
+def write_excel(df, output_file, index=False):
+    """ write a dataframe to an Excel file """
+    df.to_excel(output_file, index=index)
 
-def plot_factor_values(df_factor_values, avg_dissatisfaction, output_dir):
+def plot_dissatisfaction_ratio(df_factor_values, avg_dissatisfaction, output_file, dpi=300):
+    """ Create horizontal barchart with the dissatisfaction ratio per factor value
+    Input:  dataframe with the factor values, average dissatisfaction (vertical line), file to be created, resolution
+    Returns: None
+    """
     #create horizontal bar chart
     fig, ax = plt.subplots(figsize=(10, 10))
-    sns.barplot(x=100*df_factor_values.dissatisfied_ratio, y=df_factor_values.factor_value, orient='h')
-    plt.axvline(avg_dissatisfaction)
-    plt.title('Dissatisfaction Ratio')
-    plt.xlabel('Dissatisfaction %')
-    plt.ylabel('Factor + Value')
-    ax.bar_label(ax.containers[0], fmt='%.1f%%', padding=3)
-    plt.tight_layout()
-    dissatisfaction_ratio_file = output_dir / f"05 Dissatisfaction Ratio.png"    
-    plt.savefig(dissatisfaction_ratio_file, dpi=300)
-    # plt.show()
-
+    try:
+        sns.barplot(x=100*df_factor_values.dissatisfied_ratio, y=df_factor_values.factor_value, orient='h')
+        plt.axvline(avg_dissatisfaction)
+        plt.title('Dissatisfaction Ratio')
+        plt.xlabel('Dissatisfaction %')
+        plt.ylabel('Factor + Value')
+        ax.bar_label(ax.containers[0], fmt='%.1f%%', padding=3)
+        plt.tight_layout()
+        plt.savefig(output_file, dpi=dpi)
+    finally:
+        plt.close(fig)
+
+def plot_dissatisfaction_delta(df_factor_values, output_file, dpi=300):
+    """ Create horizontal barchart with the predicted difference in dissatisfaction when a factor value would be applied
+    Input:  dataframe with the factor values, file to be created, resolution
+    Returns: None
+    """
     fig, ax = plt.subplots(figsize=(10, 10))
-    sns.barplot(x=100*df_factor_values.predicted_dissatisfaction_delta, y=df_factor_values.factor_value, orient='h')
-    plt.axvline(0)
-    plt.axvline(-10, color="white")
-    plt.axvline(70, color="white")
-    plt.title('Difference in satisfaction when this value would be applied')
-    plt.xlabel('Dissatisfaction Delta %')
-    plt.ylabel('Factor + Value')
-    ax.bar_label(ax.containers[0], fmt='%.1f%%', padding=3)
-    plt.tight_layout()
-    dissatisfaction_dissatisfaction_delta_file = output_dir / f"06 Predicted dissatisfaction_delta.png"    
-    plt.savefig(dissatisfaction_dissatisfaction_delta_file, dpi=300)
-
-
-def create_ordered_excel(df_incidents, index_group, avg_dissatisfaction, output_file):
-    """ Create Excel with a comparison of user dissatisfaction per application and corresponding causal factors
-    Sort by statical relevance and flag the most relevant ones
-    Input:  dataframe with incident tickets
-            index_group: variables to be used as index (rows) in the pivot_table
+    try:
+        sns.barplot(x=100*df_factor_values.predicted_dissatisfaction_delta, y=df_factor_values.factor_value, orient='h')
+        plt.axvline(0)
+        plt.axvline(-10, color="white")
+        plt.axvline(70, color="white")
+        plt.title('Difference in satisfaction when this value would be applied')
+        plt.xlabel('Dissatisfaction Delta %')
+        plt.ylabel('Factor + Value')
+        ax.bar_label(ax.containers[0], fmt='%.1f%%', padding=3)
+        plt.tight_layout()
+        plt.savefig(output_file, dpi=dpi)
+    finally:
+        plt.close(fig)
+
+
+def plot_reliability_curve(df_reliability, output_file, dpi=300):
+    """ Create a reliability curve: actual versus predicted dissatisfaction per decile of the predictions (diagonal: perfect calibration)
+    Input:  reliability curve (see diagnostics.reliability_curve), file to be created, resolution
     Returns: None
     """
-    org_names = ["contact_type","dissatisfied count","user_dissatisfied","dissatisfaction_proba","pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0"] 
-    org_names = index_group + org_names
+    fig, ax = plt.subplots(figsize=(8, 8))
+    try:
+        predicted, actual = 100*df_reliability['predicted dissatisfaction%'], 100*df_reliability['actual dissatisfaction%']
+        limit = max(predicted.max(), actual.max()) * 1.05
+        plt.plot([0, limit], [0, limit], color="grey", linestyle="--")
+        plt.plot(predicted, actual, marker="o")
+        plt.title('Reliability curve (per decile of the predicted dissatisfaction)')
+        plt.xlabel('Predicted Dissatisfaction %')
+        plt.ylabel('Actual Dissatisfaction %')
+        plt.tight_layout()
+        plt.savefig(output_file, dpi=dpi)
+    finally:
+        plt.close(fig)
+
+def ordered_excel_data(cube, index_group, avg_dissatisfaction, fdr=False, intervals=None):
+    """ Comparison of user dissatisfaction per application and corresponding causal factors
+    Sort by statical relevance and flag the most relevant ones
+    Input:  cube with the sums and counts of the incident tickets (see cube.group_cube)
+            index_group: dimensions of the cube to be used as index (rows): first levels of company, group, application
+            fdr: flag the relevant rows on the Benjamini-Hochberg adjusted p-values (see stats.binom_stats)
+            intervals: bootstrap intervals of the predicted dissatisfaction and deltas (see bootstrap.group_intervals, optional)
+    Returns: sorted dataframe (to be written with write_excel, index=True)
+    """
+    org_names = ["count","user_dissatisfied sum","user_dissatisfied","dissatisfaction_proba","pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0"] 
     new_names = ["total count","dissatisfied count","dissatisfaction%","dissatisfaction_proba","reopened","resolution_time","no_resolution"] 
-    new_names = index_group + new_names
-
-    application_analysis_avg = pd.pivot_table(
-                        data=df_incidents, 
-                        index=index_group,
-                        values=["user_dissatisfied","dissatisfaction_proba","pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0"],
-                        aggfunc='mean'
-                        )
-    application_analysis_avg.reset_index(inplace=True)
-
-    application_analysis_count = pd.pivot_table(
-                        data=df_incidents, 
-                        index=index_group, 
-                        values=["contact_type"],
-                        aggfunc='count'
-                        )
-    application_analysis_count.reset_index(inplace=True)
-    application_analysis = pd.merge(application_analysis_count, application_analysis_avg)
-    application_analysis["dissatisfied count"] = application_analysis["contact_type"]*application_analysis["user_dissatisfied"]
-    application_analysis = application_analysis[org_names]
+
+    application_analysis = group_means(cube, index_group)[org_names]
     application_analysis.columns=new_names
 
+    # dissatisfaction% shrunk to the company (of a group) and group (of an application): reliable for groups with few tickets
+    application_analysis.insert(3, "shrunk dissatisfaction%", hierarchical_ratios(cube, index_group))
+
+    # bootstrap intervals: indexed by the dimension values as strings (a missing value is 'nan')
+    if intervals is not None:
+        keys = application_analysis.index.to_frame(index=False).astype(str)
+        keys = pd.MultiIndex.from_frame(keys) if len(index_group) > 1 else pd.Index(keys[index_group[0]])
+        for col, values in intervals.reindex(keys).items():
+            application_analysis[col] = values.to_numpy()
+    application_analysis.reset_index(inplace=True)
+
     #identify pvalue for satisfaction rating = 1/2 of overall average, relevance level = 5%, clip to min 5 dissatisfied
-    application_analysis = binom_stats(application_analysis, avg_dissatisfaction/2,0.05,5) 
+    application_analysis = binom_stats(application_analysis, avg_dissatisfaction/2,0.05,5,fdr) 
 
-    #write sorted file
+    #sort
     application_analysis.sort_values(by=["relevant","pvalue","dissatisfied count","total count"], ascending=[False,True, False, True], inplace=True)
-    application_analysis.to_excel(output_file)
+    return application_analysis
+
+def ordered_plot_data(cube, index_group, limit):
+    """ Dissatisfaction and predicted deltas (in %) per given index_group, sorted on the dissatisfaction
+    Input:  cube with the sums and counts of the incident tickets (see cube.group_cube)
+            index_group: dimensions of the cube to be used as index (rows)
+            limit: only keep those factor-value combination that have more than the 'limit' number of tickets
+    Returns: dataframe indexed by index_group (see write_ordered_plot)
+    """
+    org_names = ["user_dissatisfied","pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0"]
+    new_names = ["dissatisfaction%","reopened","resolution_time","no_resolution"]
 
-def write_ordered_plot(df_incidents, index_group, avg_dissatisfaction, output_file, title, limit):
+    company_analysis = group_means(cube, index_group)
+    company_analysis = company_analysis[company_analysis["count"]>limit]
+    company_analysis = company_analysis[org_names]*100
+    company_analysis.columns=new_names
+    company_analysis.sort_values(by="dissatisfaction%", inplace=True, ascending=False)
+    return company_analysis
+
+def write_ordered_plot(company_analysis, avg_dissatisfaction, output_file, title, dpi=300):
     """ Create horizontal barchart with a comparison of user dissatisfaction per given index_group and corresponding attributes
-        Limit to support companies with more than 1000 survey responses
-    Input:  dataframe with incident tickets
-            index_group: variables to be used as index (rows) in the pivot_table
+    Input:  company_analysis: dissatisfaction and deltas per value of the index_group (see ordered_plot_data)
             avg_dissatisfaction: draw vertical line on horizontal barplot with the average dissatisfaction
             output_file: file to be created
             title: to be displayed on top of the bargraph
-            limit: only show those factor-value combination that have more than the 'limit' number of tickets
+            dpi: resolution
     Returns: None
     """
-    org_names = ["user_dissatisfied","pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0"]
-    org_names = index_group + org_names
-    new_names = ["dissatisfaction%","reopened","resolution_time","no_resolution"]
-    new_names = index_group + new_names
-    company_analysis_avg = pd.pivot_table(data=df_incidents, 
-                        index=index_group, 
-                        values=["user_dissatisfied","pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0"],
-                        aggfunc='mean'
-                        )
-    company_analysis_avg.reset_index(inplace=True)
-
-    company_analysis_count = pd.pivot_table(data=df_incidents, 
-                        index=index_group, 
-                        values=["contact_type"],
-                        aggfunc='count'
-                        )
-    company_analysis_count.reset_index(inplace=True)
-
-    company_analysis = pd.merge(company_analysis_count, company_analysis_avg)
-    company_analysis = company_analysis[company_analysis["contact_type"]>limit]
-    company_analysis = company_analysis[org_names]
-    company_analysis.columns=new_names
-    company_analysis = company_analysis.set_index(index_group)
-    company_analysis["dissatisfaction%"] *= 100
-    company_analysis["reopened"] *= 100
-    company_analysis["resolution_time"] *= 100
-    company_analysis["no_resolution"] *= 100
-    company_analysis.sort_values(by="dissatisfaction%", inplace=True, ascending=False)
-
     #create horizontal bar chart
     sns.set(style='white')
-    plt.subplots(figsize=(10, 10))
     ax = company_analysis.plot(kind='barh', stacked=True )
-    plt.axvline(avg_dissatisfaction*100, color='r')
-    plt.axvline(0, color='grey')
-    ax.bar_label(ax.containers[0], label_type='center', fmt='%.0f%%', padding=3, size=6)
-    ax.bar_label(ax.containers[1], label_type='center', fmt='%.0f%%', padding=3, size=6)
-    ax.bar_label(ax.containers[2], label_type='center', fmt='%.0f%%', padding=3, size=6)
-    # ax.bar_label(ax.containers[3], label_type='center', fmt='%.0f%%', padding=3, size=6)
-    plt.title(title)
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
-    plt.close()
-
-def write_response_ratio_plot(df_incidents, output_file):
-    """ Create horizontal barchart with a comparison of survey response rates per given index_group and values
+    try:
+        plt.axvline(avg_dissatisfaction*100, color='r')
+        plt.axvline(0, color='grey')
+        ax.bar_label(ax.containers[0], label_type='center', fmt='%.0f%%', padding=3, size=6)
+        ax.bar_label(ax.containers[1], label_type='center', fmt='%.0f%%', padding=3, size=6)
+        ax.bar_label(ax.containers[2], label_type='center', fmt='%.0f%%', padding=3, size=6)
+        # ax.bar_label(ax.containers[3], label_type='center', fmt='%.0f%%', padding=3, size=6)
+        plt.title(title)
+        plt.tight_layout()
+        plt.savefig(output_file, dpi=dpi)
+    finally:
+        plt.close(ax.figure)
+
+def response_ratios(df_incidents, tables=None):
+    """ Survey response rates per value of the factors reopened, days_to_resolve and no resolution
     Input:  dataframe with incident tickets
-            output_file: file to be created
-    Returns: None
+            tables: contingency tables of the survey responses (see stats.contingency_tables), counted when not provided
+    Returns: dataframe with the response ratio (in %) per factor value (see write_response_ratio_plot)
     """
-    avg_response_ratio = df_incidents['user_responded'].mean()*100
-
     crosstab = pd.DataFrame()
+    tables = contingency_tables(df_incidents, ["reopened","days_to_resolve","no resolution"], tables, response="user_responded")
 
     for factor in ["reopened","days_to_resolve","no resolution"]:
-            crosstab_reopened= pd.crosstab(
-                index=df_incidents[factor],
-                columns=df_incidents["user_responded"],
-                normalize = 'index')
+            crosstab_reopened = tables[factor].div(tables[factor].sum(axis=1), axis=0) # ratio per factor value
             crosstab_reopened["factor"]=factor
             crosstab_reopened["response_ratio"]=crosstab_reopened[1]
             crosstab_reopened.reset_index(inplace=True)
@@ -152,16 +191,27 @@ def write_response_ratio_plot(df_incidents, output_file):
     crosstab = crosstab[['factor','value','response_ratio']].copy()
     crosstab['factor_value'] = crosstab['factor'] + ": " + crosstab['value'].astype(str)
     crosstab['response_ratio'] = crosstab['response_ratio'].mul(100).round(1)
+    return crosstab
 
+def write_response_ratio_plot(crosstab, avg_response_ratio, output_file, dpi=300):
+    """ Create horizontal barchart with a comparison of survey response rates per given index_group and values
+    Input:  crosstab: response ratio per factor value (see response_ratios)
+            avg_response_ratio: average response ratio in % (vertical line)
+            output_file: file to be created
+            dpi: resolution
+    Returns: None
+    """
     #create horizontal bar chart
+    sns.set(style='white')
     fig, ax = plt.subplots(figsize=(10, 10))
-    sns.barplot(x=crosstab.response_ratio, y=crosstab.factor_value, orient='h')
-    plt.axvline(avg_response_ratio, color='g')
-    plt.title('Survey Reponse Ratio - correlation with factor-value combinations')
-    plt.xlabel('Response %')
-    plt.ylabel('Factor + Value')
-    ax.bar_label(ax.containers[0], fmt='%.1f%%', padding=3)
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300)
-
-
+    try:
+        sns.barplot(x=crosstab.response_ratio, y=crosstab.factor_value, orient='h')
+        plt.axvline(avg_response_ratio, color='g')
+        plt.title('Survey Reponse Ratio - correlation with factor-value combinations')
+        plt.xlabel('Response %')
+        plt.ylabel('Factor + Value')
+        ax.bar_label(ax.containers[0], fmt='%.1f%%', padding=3)
+        plt.tight_layout()
+        plt.savefig(output_file, dpi=dpi)
+    finally:
+        plt.close(fig)
@@ -0,0 +1,580 @@
+""" pipeline:
+    Stages of the analysis and of the reports (run by main.py, timed per stage by benchmark.py)
+    - analyse_incidents: statistics, transformations, model and counterfactual predictions of the incidents with a survey response
+    - analyse_all_incidents / score_all_incidents: predictions for all incidents (simplified model, or the model of the survey incidents
+      with --reweight)
+    - analyse_incidents_chunked, analyse_all_incidents_chunked, score_all_incidents_chunked: the same stages out-of-core,
+      on batches of incidents (sums and counts are added up per batch)
+    - write_reports: the Excel files and graphs, rolled up from the cubes per company, group, application and attribute
+Input:
+    - dataframes (or batches) with the incidents, contingency counts, profiler (optional)
+Output:
+    - dictionary with the artifacts of the analysis (cached by main.py), Excel files and graphs in the output folder
+"""
+import numpy as np
+import scipy.sparse
+
+from stats import chi2_stats, ratio_stats, contingency_tables, add_contingency_tables, table_unique_values
+from output import render, write_excel, plot_dissatisfaction_ratio, plot_dissatisfaction_delta, plot_reliability_curve, ordered_excel_data, ordered_plot_data, write_ordered_plot, response_ratios, write_response_ratio_plot
+from transform_attributes import transform_df_upon_chi2, transform_df_upon_review_values, df_create_dummies, create_Xy
+from transform_attributes import transform_incidents_upon_review_values, transform_factors_upon_review_values, merged_close_codes, create_dummies, add_dummy_factors, feature_matrix, add_encoded_factors, model_columns
+from factors import factor_frame, factor_values_frame
+from model import DecisionTree, cross_validated_proba
+from shrinkage import assign_folds, encoding_counts, create_encoder, encode
+from propensity import fit_propensity, response_weights, weighted_ratio, effective_size
+from flat_tree import flatten
+from counterfactual import predict_deltas, intervention_names, add_delta_columns
+from diagnostics import calibration_table, calibration_summary, reliability_curve, group_calibration
+from bootstrap import bootstrap_deltas, fit_replicates, evaluate_replicates, group_codes, add_sums, bootstrap_samples, add_delta_intervals, group_intervals
+from rules import default_rules
+from cube import group_cube, add_cubes
+from profiler import stage, measure
+from trend import trend_alerts
+
+# the prediction deltas per incident that are used in the reports
+report_deltas = ["pred_reopened_0.0","pred_days_to_resolve_0.0","pred_close_code_No Resolution Action_0.0"]
+
+# the factors of the survey response ratios ("07 Survey Response Ratio") and of the simplified model of all incidents
+response_factors = ["reopened","days_to_resolve","no resolution"]
+
+# the measures per company, group and application with a bootstrap interval: the predicted dissatisfaction and the report deltas
+# (named as in the Excel files, see output.ordered_excel_data)
+bootstrap_measures = ["dissatisfaction_proba","reopened","resolution_time","no_resolution"]
+
+# order of the factors in "00 factors.xlsx": by their predicted impact on the dissatisfaction
+factor_report_order = (['predicted_dissatisfaction_delta','feature_importance','chi','p'], [False,False,False,True])
+
+# Differentiating attributes: column, barchart file (without extension), title and limit (see rules.toml [reports])
+attribute_plots = default_rules['reports']['attribute_plots']
+
+# dimensions of the cubes from which the Excel files and barcharts per company, group, application and attribute are rolled up
+org_dimensions = ["company","group","application"]
+attribute_dimensions = [plot['column'] for plot in attribute_plots]
+
+def add_feature_importances(factors, X_columns, model):
+    """ add the column number in X and the model feature importance to the factors
+    Input: factors registry, columns of X (see create_Xy), fitted model
+    Returns: modified factors registry
+    """
+    for colnum, (fct, importance) in enumerate(zip(X_columns, model.feature_importances_)):
+        factors[fct]['colnum'] = colnum
+        factors[fct]['feature_importance'] = importance
+    return factors
+
+def rank_factors(factors, df_factor_values):
+    """ order the factor values by their predicted impact on the dissatisfaction and add the impact to the factors
+    Input: factors registry and dataframe with the factor values (with the predicted dissatisfaction delta)
+    Returns: modified factors registry and dataframe
+    """
+    df_factor_values["factor_value"] =  df_factor_values["factor"] + ": " + df_factor_values["value"].astype(str) # factor value: combination for reporting purposes
+    df_factor_values.sort_values(by=['feature_importance','chi', 'factor','value'],ascending=[False,False,True,True],inplace=True)
+
+    # Create an ordered list of the most impactful factors
+    # "predicted_dissatisfaction_delta" is the predicted reduction in disatisfaction if the factor is eliminated (value associated with the factor = 0)
+    # we are interested in factors that increase dissatisfaction: so look for negative values and eliminate the - sign these for reporting
+    df_most_impactful_factors = df_factor_values[(df_factor_values["predicted_dissatisfaction_delta"]<0) & (df_factor_values["value"]==0)].copy()
+    df_most_impactful_factors["predicted_dissatisfaction_delta"] = df_most_impactful_factors["predicted_dissatisfaction_delta"].apply(lambda x: x*-1)
+
+    # Add "predicted_dissatisfaction_delta" to the factors
+    for fct, delta in zip(df_most_impactful_factors["factor"], df_most_impactful_factors["predicted_dissatisfaction_delta"]):
+        factors[fct]['predicted_dissatisfaction_delta'] = delta
+
+    return factors, df_factor_values
+
+def report_interventions(df_factor_values):
+    """ column numbers in X and values of the interventions that are used in the reports (see report_deltas)
+    Input: dataframe with the factor values
+    Returns: arrays with the column numbers and the values, in the order of report_deltas
+    """
+    names = intervention_names(df_factor_values)
+    rows = [names.index(name) for name in report_deltas]
+    return df_factor_values['colnum'].to_numpy()[rows], df_factor_values['value'].to_numpy()[rows]
+
+def weigh_responses(propensity, X, y):
+    """ inverse propensity weights of the survey incidents (see propensity.py), None without propensity model """
+    if propensity is None:
+        return None
+    weights = response_weights(propensity, X)
+    print(f"weighted dissatisfaction {weighted_ratio(y, weights)}, effective sample size {effective_size(weights):.0f} of {len(weights)}")
+    return weights
+
+def analyse_incidents(df_incidents, tables=None, profiler=None, sparse=False, target_encoding=False, bootstrap=0, time_budget=None, n_jobs=-1,
+                      df_all_incidents=None):
+    """ determine the factors that correlate with user dissatisfaction, build the model and predict the effect of every factor value
+    Input: dataframe with the incidents that have a survey response, contingency counts of the incidents (when available),
+           profiler (see profiler.create_profiler, optional), sparse: fit and predict on a sparse X (see transform_attributes.feature_matrix),
+           target_encoding: add the out of fold shrunk ratios of the company, group and application to the model (see shrinkage.py),
+           bootstrap: number of bootstrap replicates for the intervals of the deltas (0: no intervals, see bootstrap.py),
+           time_budget: time budget of the replicates in seconds (None: no limit), n_jobs: number of processes of the replicates,
+           df_all_incidents: all incidents with the factors of the model: the survey incidents are weighted by their inverse propensity
+           to respond (see propensity.py, None: no weights)
+    Returns: dictionary with the artifacts: transformed incidents, factors, factor values, model, prediction deltas, bootstrap samples,
+             propensity model and the transformed incidents of df_all_incidents (to be scored with score_all_incidents)
+    """
+    with stage(profiler, "chi2") as record:
+        # Perfrom chi2 test to identify the relevant factors (columns)
+        # The contingency tables (counts per factor value and response) are cached in 'tables' and reused by the subsequent statistics
+        if tables is None:
+            tables = {}
+        factors = chi2_stats(df_incidents, tables)
+        measure(record, df_incidents=df_incidents)
+
+    with stage(profiler, "initial_factor_values") as record:
+        # Transform the data based on a manual review of the factors file
+        factors = transform_df_upon_chi2 (factors)
+
+        # List the individual values for each factor along with their correlation with user dissatisfaction ("01 initial_factor_values.xlsx")
+        df_factor_values_initial = factor_values_frame(factors, ratio_stats(df_incidents, factors, tables))
+        df_factor_values_initial.sort_values(by=['chi', 'factor','value'],ascending=[False,True,True],inplace=True)
+        measure(record, df_factor_values_initial=df_factor_values_initial)
+
+    with stage(profiler, "transform") as record:
+        # Transform the incident data upon review of "01 factor_values.xlsx":
+        df_incidents, factors = transform_df_upon_review_values(df_incidents, factors)
+        tables = {} # the incident values have changed: the cached contingency tables are no longer valid
+
+        # Create dummies for the fields containing multiple categorical values
+        df_incidents, factors = df_create_dummies(df_incidents, factors, tables)
+
+        # Encode the companies, groups and applications as their shrunk dissatisfaction ratio (out of fold)
+        encoder = None
+        if target_encoding:
+            fold = assign_folds(len(df_incidents))
+            encoder = create_encoder(encoding_counts(df_incidents, fold))
+            df_incidents, factors = add_encoded_factors(df_incidents, factors, encode(encoder, df_incidents, fold))
+        measure(record, df_incidents=df_incidents)
+
+    propensity = None
+    if df_all_incidents is not None:
+        with stage(profiler, "propensity") as record:
+            # Model the survey response on all incidents with the factors of the model (see propensity.py)
+            # all incidents are transformed as the survey incidents (the companies, groups and applications are encoded on all survey incidents)
+            df_all_incidents = transform_incidents_upon_review_values(df_all_incidents)
+            if encoder is not None:
+                df_all_incidents, factors = add_encoded_factors(df_all_incidents, factors, encode(encoder, df_all_incidents))
+            propensity = fit_propensity(feature_matrix(df_all_incidents, factors, model_columns(factors), sparse), df_all_incidents['user_responded'])
+            measure(record, df_all_incidents=df_all_incidents)
+
+    with stage(profiler, "model") as record:
+        # Create X and y with maximum of Z factors and apply to DecisionTree (used as regression model)
+        X, y, X_columns = create_Xy(df_incidents, factors, sparse)
+
+        # Weigh the survey incidents by their inverse propensity to respond (when all incidents are scored with this model)
+        weights = weigh_responses(propensity, X, y)
+
+        # Create DecisionTree model based on X and y
+        model = DecisionTree(X,y,sample_weight=weights)
+        print(model)
+
+        factors = add_feature_importances(factors, X_columns, model)
+
+        # calibration of the model on out of fold predictions (see diagnostics.py)
+        calibration = calibration_table(y, cross_validated_proba(model, X, y, sample_weight=weights), weights)
+        measure(record, X=X)
+
+    with stage(profiler, "factor_values") as record:
+        # For every value, determine the correlation with customer dissatisfaction after transformation ("01 factor_values.xlsx")
+        df_factor_values = factor_values_frame(factors, ratio_stats(df_incidents, factors, tables))
+        measure(record, df_factor_values=df_factor_values)
+
+    with stage(profiler, "counterfactual") as record:
+        # Compute the predicted satisfaction rating across all incident records
+        # For every factor - value combination: compute the predicted satisfaction rating if this value would have been enforced
+        # e.g predict how much customer satisfaction would change if all incidents would be resolved the same day, in 1 day, in 2 days, ...
+        df_incidents['dissatisfaction_proba'], deltas = predict_deltas(model, X, df_factor_values['colnum'], df_factor_values['value'])
+        avg_dissatisfaction = df_incidents['dissatisfaction_proba'].mean()
+        print(avg_dissatisfaction)
+
+        # squared error of the prediction per incident (Brier score per company and group, see diagnostics.group_calibration)
+        df_incidents['proba_squared_error'] = (df_incidents['dissatisfaction_proba'] - df_incidents['user_dissatisfied'])**2
+
+        df_factor_values['predicted_dissatisfaction'] = avg_dissatisfaction
+        df_factor_values['predicted_dissatisfaction_delta'] = deltas.mean(axis=0) # difference in satisfaction rating
+
+        # keep the per incident differences in satisfaction that are used in the reports
+        names = intervention_names(df_factor_values)
+        df_incidents = add_delta_columns(df_incidents, deltas, names, report_deltas)
+        measure(record, df_incidents=df_incidents, deltas=deltas)
+
+    samples = None
+    if bootstrap:
+        with stage(profiler, "bootstrap") as record:
+            # Refit the model on bootstrap samples of the incidents and repeat the counterfactual predictions:
+            # percentile intervals of the deltas per factor value and per company, group and application
+            samples = bootstrap_deltas(model, X, y, df_factor_values['colnum'], df_factor_values['value'], [names.index(col) for col in report_deltas],
+                                       df_incidents, org_dimensions, bootstrap_measures, bootstrap, time_budget, n_jobs, sample_weight=weights)
+            df_factor_values = add_delta_intervals(df_factor_values, samples)
+            print(f"{samples['replicates']} bootstrap replicates")
+            measure(record, groups=samples['groups'])
+
+    factors, df_factor_values = rank_factors(factors, df_factor_values)
+
+    return {'df_incidents': df_incidents, 'factors': factors, 'df_factor_values_initial': df_factor_values_initial,
+            'df_factor_values': df_factor_values, 'model': model, 'encoder': encoder, 'deltas': deltas, 'avg_dissatisfaction': avg_dissatisfaction,
+            'calibration': calibration, 'bootstrap': samples, 'propensity': propensity, 'df_all_incidents': df_all_incidents}
+
+def analyse_all_incidents(df_all_incidents, tables=None, profiler=None):
+    """ predict the dissatisfaction for all incidents (those with and those without survey responses)
+    Input: dataframe with all incidents, contingency counts of the survey responses (when available),
+           profiler (see profiler.create_profiler, optional)
+    Returns: dictionary with the artifacts: incidents with predictions, model and prediction deltas
+    """
+    with stage(profiler, "all_incidents_model") as record:
+        # Count the survey responses for the factors of the model (to determine the survey response ratios)
+        response_tables = contingency_tables(df_all_incidents, ["reopened","days_to_resolve","no resolution"], tables, response='user_responded')
+
+        # Create a new simplified DecisionTree model (only based on the 3 most determining factors)
+        df_all_incidents_responded = df_all_incidents[df_all_incidents["user_responded"]==1]
+        X = np.array(df_all_incidents_responded[["reopened","days_to_resolve","no resolution"]])
+        y = np.array (df_all_incidents_responded["user_dissatisfied"]).squeeze()
+        model_all_incidents = DecisionTree(X,y)
+        print(model_all_incidents)
+        measure(record, df_all_incidents=df_all_incidents)
+
+    with stage(profiler, "all_incidents_counterfactual") as record:
+        # Apply the simplified model on all incident tickets
+        # and predict the difference in satisfaction for: no tickets reopened, resolved on day 0, no tickets without resolution
+        X = np.array(df_all_incidents[["reopened","days_to_resolve","no resolution"]])
+        df_all_incidents["dissatisfied_proba"], deltas = predict_deltas(model_all_incidents, X, [0,1,2], [0,0,0])
+
+        # Average predicted dissatisfaction
+        avg_pred_dissatisfaction_all = df_all_incidents['dissatisfied_proba'].mean()
+        print(avg_pred_dissatisfaction_all)
+
+        df_all_incidents = add_delta_columns(df_all_incidents, deltas, report_deltas, report_deltas)
+    
+        df_all_incidents["user_dissatisfied"] = df_all_incidents["dissatisfied_proba"] # We don't have actual dissatisfaction information - use predicted values
+        measure(record, df_all_incidents=df_all_incidents, deltas=deltas)
+
+    return {'df_all_incidents': df_all_incidents, 'model_all_incidents': model_all_incidents, 'deltas_all_incidents': deltas,
+            'avg_pred_dissatisfaction_all': avg_pred_dissatisfaction_all, 'response_tables': response_tables}
+
+def score_all_incidents(artifacts, tables=None, sparse=False, profiler=None):
+    """ predict the dissatisfaction for all incidents with the model of the survey incidents (fitted with inverse propensity weights)
+        instead of a second, simplified model (see analyse_all_incidents): all incidents have the factors of the model
+    Input: artifacts of analyse_incidents (with the transformed incidents df_all_incidents), contingency counts of the survey responses
+           (when available), sparse: predict on a sparse X, profiler (see profiler.create_profiler, optional)
+    Returns: dictionary with the artifacts: all incidents with predictions, prediction deltas and survey response counts
+    """
+    df_all_incidents, factors = artifacts['df_all_incidents'], artifacts['factors']
+    with stage(profiler, "all_incidents_counterfactual") as record:
+        # Count the survey responses (to determine the survey response ratios)
+        response_tables = contingency_tables(df_all_incidents, response_factors, tables, response='user_responded')
+
+        # Apply the model on all incident tickets
+        # and predict the difference in satisfaction for: no tickets reopened, resolved on day 0, no tickets without resolution
+        colnums, values = report_interventions(artifacts['df_factor_values'])
+        X = feature_matrix(df_all_incidents, factors, model_columns(factors), sparse)
+        df_all_incidents["dissatisfied_proba"], deltas = predict_deltas(artifacts['model'], X, colnums, values)
+
+        # Average predicted dissatisfaction
+        avg_pred_dissatisfaction_all = df_all_incidents['dissatisfied_proba'].mean()
+        print(avg_pred_dissatisfaction_all)
+
+        df_all_incidents = add_delta_columns(df_all_incidents, deltas, report_deltas, report_deltas)
+        df_all_incidents["user_dissatisfied"] = df_all_incidents["dissatisfied_proba"] # We don't have actual dissatisfaction information - use predicted values
+        measure(record, df_all_incidents=df_all_incidents, deltas=deltas)
+
+    return {'df_all_incidents': df_all_incidents, 'deltas_all_incidents': deltas,
+            'avg_pred_dissatisfaction_all': avg_pred_dissatisfaction_all, 'response_tables': response_tables}
+
+def report_cubes(df_incidents, df_all_incidents):
+    """ sums and counts per company, group and application, per combination of the differentiating attributes
+        and per survey response: every Excel file and barchart per group is a rollup of these cubes
+    Input: incidents with predictions (see analyse_incidents), all incidents with predictions (see analyse_all_incidents)
+    Returns: dictionary with the cubes (see cube.group_cube)
+    """
+    return {'org_cube': group_cube(df_incidents, org_dimensions),
+            'attribute_cube': group_cube(df_incidents, attribute_dimensions),
+            'response_cube': group_cube(df_all_incidents, ["user_responded"])}
+
+def transformed_batches(batches, close_codes, encoder=None, factors=None, out_of_fold=True):
+    """ transform every batch of incidents as analyse_incidents transforms all incidents (review of the values, dummy columns,
+        out of fold encoded ratios when an encoder is given)
+    Input: function that returns an iterator over the batches of incidents, all close codes (after the merge of the rare close codes),
+           encoder (see shrinkage.create_encoder, optional), factors registry (for the encoded factors),
+           out_of_fold: encode the survey incidents out of fold (False: with the ratios of all survey incidents, for all incidents)
+    Returns: iterator over the transformed batches
+    """
+    start = 0 # position of the first incident of the batch (for the folds)
+    for df in batches():
+        df = create_dummies(transform_incidents_upon_review_values(df), close_codes)
+        if encoder is not None:
+            df, factors = add_encoded_factors(df, factors, encode(encoder, df, assign_folds(len(df), start) if out_of_fold else None))
+        start += len(df)
+        yield df
+
+def sample_batch(df, fraction, rng):
+    """ random sample of a batch of incidents (for the model fit on a bounded number of incidents) """
+    return df if fraction >= 1 else df[rng.random(len(df)) < fraction]
+
+def analyse_incidents_chunked(batches, max_model_rows=None, seed=0, profiler=None, sparse=False, target_encoding=False, bootstrap=0, time_budget=None, n_jobs=-1,
+                              all_batches=None):
+    """ out-of-core variant of analyse_incidents: the incidents are read in batches in every pass and are never held in memory at once
+        - the contingency tables are summed over the batches, the chi2 statistics and ratios are computed on these tables
+        - the model is fitted on X and y only (on a random sample of about max_model_rows incidents when provided)
+        - the predictions and deltas are aggregated on the fly: sums per company, group and application, per attribute (cubes)
+          and per factor value, the deltas per incident are not kept
+        - the bootstrap replicates are fitted on the X and y of the model, every batch is evaluated with all replicates (only sums are kept)
+    Input: batches: function that returns an iterator over the batches of incidents (called once per pass, see incident_store.read_incident_batches),
+           max_model_rows: maximum number of incidents for the model fit (default: all incidents), seed of the sample,
+           profiler (see profiler.create_profiler, optional), sparse: fit and predict on a sparse X,
+           target_encoding: add the out of fold shrunk ratios of the company, group and application to the model,
+           bootstrap: number of bootstrap replicates (0: no intervals), time_budget: time budget of the fits in seconds, n_jobs: number of processes,
+           all_batches: function that returns an iterator over the batches of all incidents (with the factors of the model):
+           the survey incidents are weighted by their inverse propensity to respond (None: no weights)
+    Returns: dictionary with the artifacts: factors, factor values, model, the cubes for the reports (see report_cubes), bootstrap samples
+             and propensity model
+    """
+    with stage(profiler, "chi2") as record:
+        # first pass: the contingency tables of all factors, summed over the batches
+        tables, n_incidents, df_columns = {}, 0, None
+        for df in batches():
+            tables = add_contingency_tables(tables, contingency_tables(df))
+            n_incidents += len(df)
+            df_columns = df.head(0) if df_columns is None else df_columns # the columns and data types, without incidents
+        factors = chi2_stats(df_columns, tables, table_unique_values(tables))
+
+    with stage(profiler, "initial_factor_values") as record:
+        factors = transform_df_upon_chi2 (factors)
+        df_factor_values_initial = factor_values_frame(factors, ratio_stats(df_columns, factors, tables))
+        df_factor_values_initial.sort_values(by=['chi', 'factor','value'],ascending=[False,True,True],inplace=True)
+        measure(record, df_factor_values_initial=df_factor_values_initial)
+
+    with stage(profiler, "transform") as record:
+        # second pass: the contingency tables of the transformed incidents (with the dummy columns)
+        factors = transform_factors_upon_review_values(factors)
+        close_codes = merged_close_codes(tables['close_code'].index)
+        tables, df_columns, encoding_cube, start = {}, None, None, 0
+        for df in transformed_batches(batches, close_codes):
+            tables = add_contingency_tables(tables, contingency_tables(df))
+            df_columns = df.head(0) if df_columns is None else df_columns
+            if target_encoding: # the counts per company, group, application and fold
+                encoding_cube = add_cubes(encoding_cube, encoding_counts(df, assign_folds(len(df), start)))
+                start += len(df)
+        factors = add_dummy_factors(factors, chi2_stats(df_columns, tables, table_unique_values(tables)))
+        encoder = None
+        if target_encoding:
+            encoder = create_encoder(encoding_cube)
+            df_columns, factors = add_encoded_factors(df_columns, factors, encode(encoder, df_columns))
+
+    propensity = None
+    if all_batches is not None:
+        with stage(profiler, "propensity") as record:
+            # X and user_responded of (a sample of) all incidents, transformed as the survey incidents
+            rng = np.random.default_rng(seed)
+            fraction = 1 if max_model_rows is None else max_model_rows / sum(len(df) for df in all_batches())
+            samples = [sample_batch(df, fraction, rng) for df in transformed_batches(all_batches, None, encoder, factors, out_of_fold=False)]
+            Xs = [feature_matrix(df, factors, model_columns(factors), sparse) for df in samples]
+            X = scipy.sparse.vstack(Xs, format='csc') if sparse else np.concatenate(Xs)
+            propensity = fit_propensity(X, np.concatenate([df['user_responded'].to_numpy() for df in samples]))
+            measure(record, X=X)
+            del samples, Xs, X
+
+    with stage(profiler, "model") as record:
+        # third pass: X and y of (a sample of) the incidents
+        rng = np.random.default_rng(seed)
+        fraction = 1 if max_model_rows is None else max_model_rows / n_incidents
+        Xy = [create_Xy(sample_batch(df, fraction, rng), factors, sparse) for df in transformed_batches(batches, close_codes, encoder, factors)]
+        X = scipy.sparse.vstack([X for X, y, X_columns in Xy], format='csc') if sparse else np.concatenate([X for X, y, X_columns in Xy])
+        y = np.concatenate([y for X, y, X_columns in Xy])
+        X_columns = Xy[0][2]
+        del Xy
+
+        weights = weigh_responses(propensity, X, y)
+        model = DecisionTree(X,y,sample_weight=weights)
+        print(model)
+        factors = add_feature_importances(factors, X_columns, model)
+        calibration = calibration_table(y, cross_validated_proba(model, X, y, sample_weight=weights), weights)
+        trees = fit_replicates(model, X, y, bootstrap, time_budget, n_jobs, sample_weight=weights) if bootstrap else []
+        measure(record, X=X)
+        del X, y
+
+    with stage(profiler, "factor_values") as record:
+        df_factor_values = factor_values_frame(factors, ratio_stats(df_columns, factors, tables))
+        measure(record, df_factor_values=df_factor_values)
+
+    with stage(profiler, "counterfactual") as record:
+        # fourth pass: predict the dissatisfaction and the deltas per batch, only their sums are kept
+        tree = flatten(model)
+        names = intervention_names(df_factor_values)
+        proba_sum, deltas_sum = 0.0, np.zeros(len(df_factor_values))
+        org_cube = attribute_cube = None
+        sums, keys, group_counts = None, None, np.zeros(0) # bootstrap sums per replicate, group keys and incidents per group
+        for df in transformed_batches(batches, close_codes, encoder, factors):
+            X = feature_matrix(df, factors, X_columns, sparse)
+            df['dissatisfaction_proba'], deltas = predict_deltas(tree, X, df_factor_values['colnum'], df_factor_values['value'])
+            proba_sum += df['dissatisfaction_proba'].sum()
+            deltas_sum += deltas.sum(axis=0)
+            df['proba_squared_error'] = (df['dissatisfaction_proba'] - df['user_dissatisfied'])**2
+            if trees:
+                codes, keys = group_codes(df, org_dimensions, keys)
+                group_counts = np.bincount(codes, minlength=len(keys)) + np.pad(group_counts, (0, len(keys) - len(group_counts)))
+                sums = add_sums(sums, evaluate_replicates(trees, X, df_factor_values['colnum'], df_factor_values['value'],
+                                                          [names.index(col) for col in report_deltas], codes, len(keys), n_jobs))
+            df = add_delta_columns(df, deltas, names, report_deltas)
+            org_cube = add_cubes(org_cube, group_cube(df, org_dimensions))
+            attribute_cube = add_cubes(attribute_cube, group_cube(df, attribute_dimensions))
+        avg_dissatisfaction = proba_sum / n_incidents
+        print(avg_dissatisfaction)
+
+        df_factor_values['predicted_dissatisfaction'] = avg_dissatisfaction
+        df_factor_values['predicted_dissatisfaction_delta'] = deltas_sum / n_incidents
+        samples = None
+        if trees:
+            samples = bootstrap_samples(sums, keys, group_counts, n_incidents, bootstrap_measures)
+            df_factor_values = add_delta_intervals(df_factor_values, samples)
+            print(f"{samples['replicates']} bootstrap replicates")
+        measure(record, org_cube=org_cube, attribute_cube=attribute_cube)
+
+    factors, df_factor_values = rank_factors(factors, df_factor_values)
+
+    return {'factors': factors, 'df_factor_values_initial': df_factor_values_initial, 'df_factor_values': df_factor_values,
+            'model': model, 'encoder': encoder, 'avg_dissatisfaction': avg_dissatisfaction, 'org_cube': org_cube, 'attribute_cube': attribute_cube,
+            'calibration': calibration, 'bootstrap': samples, 'propensity': propensity}
+
+def analyse_all_incidents_chunked(batches, max_model_rows=None, seed=0, profiler=None):
+    """ out-of-core variant of analyse_all_incidents (see analyse_incidents_chunked)
+    Input: function that returns an iterator over the batches of all incidents (called once per pass),
+           max_model_rows: maximum number of incidents with a survey response for the model fit (default: all), seed of the sample,
+           profiler (see profiler.create_profiler, optional)
+    Returns: dictionary with the artifacts: model, survey response counts and the cube per survey response (see report_cubes)
+    """
+    factors = ["reopened","days_to_resolve","no resolution"]
+    with stage(profiler, "all_incidents_model") as record:
+        # the survey response counts of the factors of the model, summed over the batches
+        response_tables, n_incidents = {}, 0
+        for df in batches():
+            response_tables = add_contingency_tables(response_tables, contingency_tables(df, factors, response='user_responded'))
+            n_incidents += len(df)
+        n_responded = response_tables[factors[0]][1].sum()
+
+        # X and y of (a sample of) the incidents with a survey response
+        rng = np.random.default_rng(seed)
+        fraction = 1 if max_model_rows is None else max_model_rows / n_responded
+        df_samples = [sample_batch(df[df["user_responded"]==1], fraction, rng)[factors + ["user_dissatisfied"]] for df in batches()]
+        X = np.concatenate([np.array(df[factors]) for df in df_samples])
+        y = np.concatenate([np.array(df["user_dissatisfied"]) for df in df_samples])
+        del df_samples
+        model_all_incidents = DecisionTree(X,y)
+        print(model_all_incidents)
+        measure(record, X=X)
+        del X, y
+
+    with stage(profiler, "all_incidents_counterfactual") as record:
+        # predict the dissatisfaction and the deltas per batch, only their sums per survey response are kept
+        tree = flatten(model_all_incidents)
+        proba_sum = 0.0
+        response_cube = None
+        for df in batches():
+            X = np.array(df[factors])
+            df["user_dissatisfied"], deltas = predict_deltas(tree, X, [0,1,2], [0,0,0]) # predicted values, as in analyse_all_incidents
+            proba_sum += df["user_dissatisfied"].sum()
+            df = add_delta_columns(df, deltas, report_deltas, report_deltas)
+            response_cube = add_cubes(response_cube, group_cube(df, ["user_responded"]))
+        avg_pred_dissatisfaction_all = proba_sum / n_incidents
+        print(avg_pred_dissatisfaction_all)
+        measure(record, response_cube=response_cube)
+
+    return {'model_all_incidents': model_all_incidents, 'avg_pred_dissatisfaction_all': avg_pred_dissatisfaction_all,
+            'response_tables': response_tables, 'response_cube': response_cube}
+
+def score_all_incidents_chunked(batches, artifacts, sparse=False, profiler=None):
+    """ out-of-core variant of score_all_incidents: one pass over all incidents, only the sums per survey response are kept
+    Input: function that returns an iterator over the batches of all incidents, artifacts of analyse_incidents_chunked,
+           sparse: predict on a sparse X, profiler (see profiler.create_profiler, optional)
+    Returns: dictionary with the artifacts: survey response counts and the cube per survey response (see report_cubes)
+    """
+    factors = artifacts['factors']
+    X_columns = model_columns(factors)
+    colnums, values = report_interventions(artifacts['df_factor_values'])
+    with stage(profiler, "all_incidents_counterfactual") as record:
+        tree = flatten(artifacts['model'])
+        response_tables, proba_sum, n_incidents = {}, 0.0, 0
+        response_cube = None
+        for df in transformed_batches(batches, None, artifacts['encoder'], factors, out_of_fold=False):
+            response_tables = add_contingency_tables(response_tables, contingency_tables(df, response_factors, response='user_responded'))
+            X = feature_matrix(df, factors, X_columns, sparse)
+            df["user_dissatisfied"], deltas = predict_deltas(tree, X, colnums, values) # predicted values, as in score_all_incidents
+            proba_sum += df["user_dissatisfied"].sum()
+            n_incidents += len(df)
+            df = add_delta_columns(df, deltas, report_deltas, report_deltas)
+            response_cube = add_cubes(response_cube, group_cube(df, ["user_responded"]))
+        avg_pred_dissatisfaction_all = proba_sum / n_incidents
+        print(avg_pred_dissatisfaction_all)
+        measure(record, response_cube=response_cube)
+
+    return {'avg_pred_dissatisfaction_all': avg_pred_dissatisfaction_all, 'response_tables': response_tables, 'response_cube': response_cube}
+
+def write_reports(artifacts, output_dir, fdr=False, fmt="png", dpi=300, n_jobs=-1, profiler=None, trends=None):
+    """ write the Excel files and the graphs to the output folder
+        the data of every file is prepared here, the files are rendered as independent jobs in a process pool
+    Input: dictionary with the artifacts from analyse_incidents and analyse_all_incidents, output folder,
+           fdr: flag the relevant companies, groups and applications on the Benjamini-Hochberg adjusted p-values
+           fmt, dpi: format (png, svg, pdf, ...) and resolution of the graphs
+           n_jobs: number of rendering processes (-1: one per CPU)
+           profiler (see profiler.create_profiler, optional)
+           trends: counts per group and period for the trend alerts (see trend.update_trends, optional)
+    Returns: None
+    """
+    df_factor_values = artifacts['df_factor_values']
+    avg_dissatisfaction = artifacts['avg_dissatisfaction']
+    avg_pred_dissatisfaction_all = artifacts['avg_pred_dissatisfaction_all']
+
+    def chart(name):
+        return output_dir / f"{name}.{fmt}"
+
+    with stage(profiler, "report_data") as record:
+        # Write the factors and factor values to Excel for further manual analysis
+        jobs = [(write_excel, factor_frame(artifacts['factors'], *factor_report_order), output_dir / f"00 factors.xlsx"),
+                (write_excel, artifacts['df_factor_values_initial'], output_dir / f"01 initial_factor_values.xlsx")]
+
+        # Write the predicted values to Excel and plot for analysis purposes
+        jobs += [(write_excel, df_factor_values, output_dir / f"01 factor_values.xlsx"),
+                 (plot_dissatisfaction_ratio, df_factor_values, avg_dissatisfaction, chart("05 Dissatisfaction Ratio"), dpi),
+                 (plot_dissatisfaction_delta, df_factor_values, chart("06 Predicted dissatisfaction_delta"), dpi)]
+
+        # Sums and counts per company, group and application, per combination of the differentiating attributes
+        # and per survey response: every Excel file and barchart below is a rollup of these cubes
+        # (the out-of-core analysis aggregates the cubes on the fly, see analyse_incidents_chunked)
+        cubes = report_cubes(artifacts['df_incidents'], artifacts['df_all_incidents']) if 'org_cube' not in artifacts else artifacts
+        org_cube, attribute_cube, response_cube = cubes['org_cube'], cubes['attribute_cube'], cubes['response_cube']
+
+        # Write Excel files for Company, Company+Group, Company+Group+Application ordered by statistical relevance
+        # (with the bootstrap intervals of the predicted dissatisfaction and deltas when available)
+        samples = artifacts.get('bootstrap')
+        jobs += [(write_excel, ordered_excel_data(org_cube, index_group, avg_dissatisfaction, fdr, group_intervals(samples, index_group) if samples else None), output_dir / f"{file}.xlsx", True)
+                 for index_group, file in [(["company"], "10 Support Company Dissatisfaction"), (["company","group"], "11 Support Group Dissatisfaction"),
+                                           (["company","group","application"], "12 Application Dissatisfaction")]]
+
+        # Write barcharts for company, group and application
+        # (only the values with more than 'limit' tickets, see rules.toml [reports])
+        jobs += [(write_ordered_plot, ordered_plot_data(org_cube, [plot['dimension']], plot['limit']), avg_dissatisfaction, chart(plot['file']), plot['title'], dpi)
+                 for plot in default_rules['reports']['org_plots']]
+
+        # Plot barcharts for each of the differentiating attributes 
+        jobs += [(write_ordered_plot, ordered_plot_data(attribute_cube, [plot['column']], plot['limit']), avg_dissatisfaction, chart(plot['file']), plot['title'], dpi)
+                 for plot in attribute_plots]
+
+        # Plot the result, differentiated by user_reponse
+        jobs += [(write_ordered_plot, ordered_plot_data(response_cube, ["user_responded"], 0), avg_pred_dissatisfaction_all, chart("08 User Responded Dissatisfaction"), "Dissatisfaction% - User entered survey?", dpi)]
+
+        # Plot the survey response ratios
+        response_count = response_cube['count']
+        avg_response_ratio = (response_count.index.get_level_values("user_responded") * response_count).sum() / response_count.sum() * 100
+        jobs += [(write_response_ratio_plot, response_ratios(None, artifacts['response_tables']), avg_response_ratio, chart("07 Survey Response Ratio"), dpi)]
+
+        # Calibration of the model: reliability curve per decile of the out of fold predictions with the Brier score and decile calibration error,
+        # predicted versus actual dissatisfaction per company and group (see diagnostics.py)
+        jobs += [(write_excel, calibration_summary(artifacts['calibration']), output_dir / f"15 Calibration.xlsx"),
+                 (write_excel, group_calibration(org_cube), output_dir / f"16 Group Calibration.xlsx"),
+                 (plot_reliability_curve, reliability_curve(artifacts['calibration']), chart("09 Reliability Curve"), dpi)]
+
+        # Write the alerts for abnormal increases of the dissatisfaction in the last week and month (tested against the average dissatisfaction)
+        if trends:
+            jobs += [(write_excel, trend_alerts(trends[freq], avg_dissatisfaction, fdr=fdr), output_dir / f"{file}.xlsx")
+                     for freq, file in [("W", "13 Weekly Trend Alerts"), ("M", "14 Monthly Trend Alerts")] if freq in trends]
+        measure(record, org_cube=org_cube, attribute_cube=attribute_cube)
+
+    with stage(profiler, "render"):
+        render(jobs, n_jobs)
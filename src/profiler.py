@@ -0,0 +1,132 @@
+""" profiler:
+    Per stage instrumentation of the analysis pipeline (see main.py)
+    - wall time, CPU time (of this process) and peak memory (RSS) per stage
+    - number of rows, columns and memory of the dataframes that are produced by a stage
+    - optional cProfile dump of one stage
+Input:
+    - stages of the pipeline: with stage(profiler, "name") as record: ...
+Output:
+    - profile.json and profile.csv with a record per stage, <stage>.prof (cProfile, read with pstats or snakeviz)
+"""
+import cProfile
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from contextlib import contextmanager
+from pathlib import Path
+
+def create_profiler(cprofile_stage=None, output_dir=None):
+    """ create the profiler that is passed to the stages (None: no instrumentation)
+    Input: name of the stage to run under cProfile (optional), folder of the cProfile dump
+    Returns: dictionary with the stage records and the settings
+    """
+    return {'records': [], 'cprofile_stage': cprofile_stage, 'output_dir': Path(output_dir or '.')}
+
+def _proc_status(field):
+    """ memory field of /proc/self/status in MB (Linux), None when not available """
+    try:
+        for line in Path('/proc/self/status').read_text().splitlines():
+            if line.startswith(field + ':'):
+                return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """ reset the peak RSS of the process (Linux), so that the peak is measured per stage """
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    """ peak RSS of the process in MB (since the last reset on Linux, since the start of the process otherwise) """
+    peak = _proc_status('VmHWM')
+    if peak is None:
+        try:
+            import resource # not available on Windows
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak = peak / 2**20 if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, kB on Linux
+        except ImportError:
+            return None
+    return round(peak, 1)
+
+def frame_size(df):
+    """ rows, columns and memory (MB, including the contents of object columns) of a dataframe, array or sparse matrix """
+    if isinstance(df, pd.DataFrame):
+        memory = df.memory_usage(deep=True).sum()
+    elif scipy.sparse.issparse(df):
+        memory = sum(getattr(df, part).nbytes for part in ['data', 'indices', 'indptr'] if hasattr(df, part))
+    else:
+        df = np.asarray(df)
+        memory = df.nbytes
+    return {'rows': df.shape[0], 'columns': df.shape[1] if df.ndim > 1 else 1, 'memory_mb': round(memory / 2**20, 3)}
+
+def measure(record, **frames):
+    """ record the size of dataframes in the stage record (no-op without profiler)
+    Input: record of the stage (see stage), dataframes as keyword arguments
+    """
+    if record is not None:
+        record['frames'].update({name: frame_size(df) for name, df in frames.items()})
+
+@contextmanager
+def stage(profiler, name):
+    """ instrument a stage of the pipeline
+    Input: profiler (see create_profiler, None: no instrumentation), name of the stage
+    Returns: record of the stage (None without profiler), to be used with measure
+    """
+    if profiler is None:
+        yield None
+        return
+
+    record = {'stage': name, 'frames': {}}
+    profile = cProfile.Profile() if name == profiler['cprofile_stage'] else None
+    reset_peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield record
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(profiler['output_dir'] / f"{name}.prof")
+        record['wall_s'] = round(time.perf_counter() - wall, 3)
+        record['cpu_s'] = round(time.process_time() - cpu, 3)
+        record['peak_rss_mb'] = peak_rss()
+        record['rss_mb'] = _proc_status('VmRSS')
+        profiler['records'].append(record)
+        print(f"[{name}] {record['wall_s']}s wall, {record['cpu_s']}s cpu, peak rss {record['peak_rss_mb']} MB")
+
+def profile_frame(profiler):
+    """ stage records as dataframe (one row per stage, with the dataframe sizes as columns)
+    Input: profiler
+    Returns: dataframe with a row per stage
+    """
+    rows = []
+    for record in profiler['records']:
+        row = {key: value for key, value in record.items() if key != 'frames'}
+        for frame, size in record['frames'].items():
+            row.update({f"{frame} {key}": value for key, value in size.items()})
+        rows.append(row)
+    df_profile = pd.DataFrame(rows)
+    counts = [col for col in df_profile.columns if col.endswith(' rows') or col.endswith(' columns')]
+    df_profile[counts] = df_profile[counts].astype('Int64') # the frames are not measured in every stage
+    return df_profile
+
+def write_profile(profiler, output_file):
+    """ export the stage records to json and csv (see profile_frame)
+    Input: profiler, output file (the .json and .csv suffixes are added)
+    Returns: dataframe with a row per stage
+    """
+    output_file = Path(output_file)
+    with open(output_file.with_suffix('.json'), 'w') as f:
+        json.dump({'pid': os.getpid(), 'stages': profiler['records']}, f, indent=1)
+
+    df_profile = profile_frame(profiler)
+    df_profile.to_csv(output_file.with_suffix('.csv'), index=False)
+    return df_profile
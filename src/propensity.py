@@ -0,0 +1,47 @@
+""" propensity:
+    Survey non-response reweighting (inverse propensity weighting)
+    - only some incidents get a survey response and the response ratio depends on the incident (see "07 Survey Response Ratio"):
+      the survey incidents are a biased sample of all incidents
+    - the propensity to respond is modelled on all incidents with the factors of the dissatisfaction model (decision tree on user_responded,
+      fixed hyperparameters with large leaves: stable propensities, no hyperparameter search)
+    - every survey incident weighs 1 / propensity (propensities clipped to min_propensity, weights normalised to an average of 1):
+      the weighted survey incidents represent all incidents
+    - the dissatisfaction model is fitted on the weighted survey incidents and scores all incidents (see main.score_all_incidents)
+Input:
+    - X and user_responded of all incidents, X of the survey incidents (same columns, see transform_attributes.feature_matrix)
+Output:
+    - propensity model, weight per survey incident, weighted (population) dissatisfaction ratio and effective sample size
+"""
+import numpy as np
+from sklearn.tree import DecisionTreeClassifier
+
+from flat_tree import predict
+
+# Hyperparameters of the propensity model
+propensity_params = {'max_depth': 8, 'min_samples_leaf': 500}
+
+# propensities are clipped to this minimum: a weight is at most 1 / min_propensity times the weight of an incident that always responds
+min_propensity = 0.01
+
+def fit_propensity(X, responded, params=propensity_params):
+    """ fit the propensity model: probability that an incident gets a survey response
+    Input: X of all incidents, user_responded per incident, hyperparameters of the tree
+    Returns: fitted DecisionTreeClassifier
+    """
+    return DecisionTreeClassifier(**params).fit(X, np.asarray(responded))
+
+def response_weights(model, X, minimum=min_propensity):
+    """ inverse propensity weight of every survey incident
+    Input: propensity model, X of the survey incidents, minimum propensity
+    Returns: array with the weight per incident (average 1)
+    """
+    weights = 1 / np.maximum(predict(model, X), minimum)
+    return weights / weights.mean()
+
+def weighted_ratio(y, weights):
+    """ weighted dissatisfaction ratio of the survey incidents: estimate of the dissatisfaction ratio of all incidents """
+    return np.average(y, weights=weights)
+
+def effective_size(weights):
+    """ effective sample size of the weighted incidents: (sum of the weights)^2 / sum of the squared weights """
+    return weights.sum()**2 / np.square(weights).sum()
@@ -0,0 +1,114 @@
+""" pseudonymise:
+    Anonymise companies, groups and applications with stable pseudonyms (prefix + 5 digits)
+    - the pseudonym of a name is derived from a keyed hash (HMAC-SHA256) of the name: it is the same in every extraction
+    - the pseudonyms are kept in a mapping table (name -> pseudonym) that guarantees that pseudonyms are unique:
+      when the hash of a new name collides with an existing pseudonym, the next hash (name + counter) is used.
+      There are 90000 pseudonyms per prefix: a ValueError is raised when the new names do not fit, or when no free pseudonym
+      is found within max_probes hashes
+    - the mapping tables can be shared by extractions that run concurrently (see extraction.py): new names are added under a lock
+    - the scoring of new tickets looks the names up without adding them to the mapping table (see scoring.py)
+Input:
+    - column with names, prefix, mapping table
+    - secret key: environment variable INCIDENT_PSEUDONYM_KEY or the key file in the data folder (created on first use)
+Output:
+    - column with the pseudonyms (categorical)
+"""
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+key_file = Path(__file__).parent.parent / "data" / "pseudonym.key"
+_key = None
+pseudonym_space = 90000 # pseudonyms per prefix: 10000..99999
+max_probes = 1000       # hashes of a new name that are tried before the collisions are reported
+_mapping_lock = threading.Lock() # the mapping tables are shared by the threads of a concurrent extraction
+
+def secret_key():
+    """ return the secret key of the keyed hash (read once) """
+    global _key
+    if _key is None:
+        if os.environ.get("INCIDENT_PSEUDONYM_KEY"):
+            _key = os.environ["INCIDENT_PSEUDONYM_KEY"].encode()
+        else:
+            if not key_file.exists():
+                key_file.write_text(secrets.token_hex(32))
+            _key = key_file.read_text().strip().encode()
+    return _key
+
+def pseudonyms_file(incident_file):
+    """ json file with the mapping tables, shared by the incident files in the same folder """
+    return Path(incident_file).parent / "pseudonyms.json"
+
+def read_pseudonyms(file):
+    """ read the mapping tables: dictionary column -> (dictionary name -> pseudonym) """
+    if not Path(file).exists():
+        return {}
+    with open(file) as f:
+        return json.load(f)
+
+def write_pseudonyms(file, pseudonyms):
+    """ write the mapping tables """
+    with open(file, 'w') as f:
+        json.dump(pseudonyms, f, indent=1)
+
+def pseudonym(name, prefix, counter=0):
+    """ pseudonym derived from the keyed hash of the name: prefix + 5 digits (10000..99999) """
+    digest = hmac.new(secret_key(), f"{name}|{counter}".encode(), hashlib.sha256).digest()
+    return prefix + str(10000 + int.from_bytes(digest[:8], 'big') % pseudonym_space)
+
+def free_pseudonym(name, prefix, used):
+    """ pseudonym of a new name: the first keyed hash (name + counter) that is not used by another name
+    Input: name, prefix, set with the used pseudonyms
+    Returns: pseudonym (ValueError when there is no free pseudonym within max_probes hashes)
+    """
+    for counter in range(max_probes):
+        if pseudonym(name, prefix, counter) not in used: # else: collision with the pseudonym of another name
+            return pseudonym(name, prefix, counter)
+    raise ValueError(f"no free pseudonym for {name!r} within {max_probes} hashes "
+                     f"({len(used)} of {pseudonym_space} pseudonyms of prefix {prefix} used)")
+
+def pseudonymise(names, prefix, mapping):
+    """ replace the names by their pseudonym
+        the names are factorized: only the distinct names that are not yet in the mapping table are hashed
+    Input: column with the names, prefix, mapping table name -> pseudonym (the new names are added)
+    Returns: categorical column with the pseudonyms (ValueError when there is no free pseudonym for a new name)
+    """
+    codes, uniques = pd.factorize(names.fillna("None"))
+
+    with _mapping_lock:
+        used = set(mapping.values())
+        new_names = [name for name in uniques if name not in mapping]
+        if len(used) + len(new_names) > pseudonym_space:
+            raise ValueError(f"{len(new_names)} new names do not fit in the {pseudonym_space - len(used)} free pseudonyms "
+                             f"of prefix {prefix} ({len(used)} of {pseudonym_space} used)")
+        for name in new_names:
+            mapping[name] = free_pseudonym(name, prefix, used)
+            used.add(mapping[name])
+        categories = [mapping[name] for name in uniques]
+
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+def lookup_pseudonyms(names, prefix, mapping):
+    """ replace the names by their pseudonym without adding the new names to the mapping table (e.g. to score new tickets)
+        a new name gets the pseudonym that the next extraction would give it (see free_pseudonym)
+    Input: column with the names, prefix, mapping table name -> pseudonym (not changed)
+    Returns: array with the pseudonyms
+    """
+    codes, uniques = pd.factorize(names.fillna("None"))
+
+    with _mapping_lock:
+        new_names = [name for name in uniques if name not in mapping]
+        used = set(mapping.values()) if new_names else set()
+        new_pseudonyms = {}
+        for name in new_names:
+            new_pseudonyms[name] = free_pseudonym(name, prefix, used)
+            used.add(new_pseudonyms[name])
+        categories = np.array([mapping[name] if name in mapping else new_pseudonyms[name] for name in uniques], dtype=object)
+
+    return categories[codes]
@@ -0,0 +1,74 @@
+""" rules:
+    Declarative rules of the analysis (rules.toml in the project folder) instead of review steps in the code
+    - [retrieval]: transformations when the incidents are retrieved from the data lake
+    - [factors]: thresholds of the chi2 review and the variable types upon review of the values (see transform_attributes.transform_df_upon_chi2)
+    - [[values]]: transformations of the incident values, compiled into vectorized column operations (see transform_attributes.value_operation)
+    - [reports]: barcharts per company, group, application and attribute
+    - every rule has the input columns it depends on: the analysis is cached on the rules that affect it and whose columns are
+      in the incidents (see analysis_rules), a change of the other rules (e.g. the reports) reuses the cached analysis
+Input:
+    - rules.toml
+Output:
+    - dictionary with the rules, the rules that affect the analysis and their version (hash)
+"""
+import hashlib
+import json
+import tomllib
+from pathlib import Path
+
+default_rules_file = Path(__file__).parent.parent / "rules.toml"
+
+# operations of the value rules (see transform_attributes.value_operation)
+value_operations = ("clip", "merge")
+
+def validate_rules(rules):
+    """ check the sections of the rules and that every value rule has a column and one operation
+    Input: dictionary with the rules
+    Returns: the rules (ValueError for invalid rules)
+    """
+    for section in ["retrieval", "factors", "values", "reports"]:
+        if section not in rules:
+            raise ValueError(f"the rules have no [{section}] section")
+    for rule in rules['values']:
+        if 'column' not in rule or sum(operation in rule for operation in value_operations) != 1:
+            raise ValueError(f"value rule '{rule.get('name', '')}': a column and one operation ({', '.join(value_operations)}) are required")
+    for plot in rules['reports'].get('attribute_plots', []) + rules['reports'].get('org_plots', []):
+        if not {'file', 'title', 'limit'} <= set(plot) or not ('column' in plot or 'dimension' in plot):
+            raise ValueError(f"report plot '{plot.get('file', '')}': a column (or dimension), file, title and limit are required")
+    return rules
+
+def load_rules(file=default_rules_file):
+    """ read and validate the rules (TOML) """
+    with open(file, 'rb') as f:
+        return validate_rules(tomllib.load(f))
+
+def rule_columns(rule):
+    """ input columns of a value rule or a plot """
+    return [rule['column']] if 'column' in rule else [rule['dimension']]
+
+def in_incidents(column, columns):
+    """ True when the column is one of the columns of the incidents or a dummy column of one of them (e.g. close_code_<value>) """
+    return column in columns or any(column.startswith(f"{col}_") for col in columns)
+
+def analysis_rules(rules, columns, chunked=False):
+    """ the rules that affect the results of the analysis (the cached artifacts)
+        - the thresholds of the factors (all columns), the variable types and the value rules of the columns of the incidents
+        - the columns of the attribute plots for the out-of-core analysis: the cube per attribute is aggregated during the analysis
+          (the in-memory analysis rolls up the cubes when the reports are written)
+    Input: dictionary with the rules, columns of the incidents, out-of-core analysis
+    Returns: dictionary with the rules that affect the analysis
+    """
+    factors = rules['factors']
+    dependent = {
+        'factors': {key: [col for col in value if in_incidents(col, columns)] if isinstance(value, list) else value for key, value in factors.items()},
+        'values': [rule for rule in rules['values'] if all(in_incidents(col, columns) for col in rule_columns(rule))],
+    }
+    if chunked:
+        dependent['attribute_columns'] = [plot['column'] for plot in rules['reports']['attribute_plots']]
+    return dependent
+
+def rules_version(rules):
+    """ hash of the rules (part of the cache key: a change of the rules invalidates the cached results) """
+    return hashlib.sha256(json.dumps(rules, sort_keys=True, default=str).encode()).hexdigest()
+
+default_rules = load_rules()
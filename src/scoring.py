@@ -0,0 +1,246 @@
+""" scoring:
+    Score new tickets with the dissatisfaction model of the last analysis (e.g. to flag likely dissatisfied tickets without survey response)
+    - the model artifact (model, features and interventions) is exported by main.py (--export-model)
+    - the tickets are given in the schema of the database query (see incidents_from_odbc.incident_batches),
+      the transformations of transform_attributes are applied to the features of the model, the company, group and application
+      are replaced by the pseudonyms of the extraction (mapping tables and keyed hash, see pseudonymise.py)
+    - for every ticket: the predicted dissatisfaction and the change in dissatisfaction for every intervention (see counterfactual)
+
+    to run: python scoring.py score tickets.jsonl (or .csv), python scoring.py serve (local HTTP stand-in: POST /score)
+Input:
+    - model artifact, mapping tables of the pseudonyms (data/pseudonyms.json), single tickets (dictionary) or micro-batches (list of dictionaries or dataframe)
+Output:
+    - predicted dissatisfaction and deltas per ticket
+"""
+import argparse
+import json
+import pickle
+import sys
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from counterfactual import predict_deltas, intervention_names
+from flat_tree import flatten
+from pseudonymise import pseudonyms_file, read_pseudonyms, lookup_pseudonyms
+from shrinkage import encode
+from transform_attributes import retrieval_features, anonymised_fields, value_operations
+
+default_model_file = Path(__file__).parent.parent / "models" / "dissatisfaction_model.pkl"
+default_pseudonyms_file = pseudonyms_file(Path(__file__).parent.parent / "data" / "incident_tickets.csv")
+
+def export_model(artifacts, model_file=default_model_file):
+    """ export the model and what is needed to score new tickets
+    Input: dictionary with the artifacts of main.analyse_incidents, file
+    Returns: None
+    """
+    factors = artifacts['factors']
+    df_factor_values = artifacts['df_factor_values']
+    features = sorted((fct for fct in factors if 'colnum' in factors[fct]), key=lambda fct: factors[fct]['colnum']) # columns of X (see create_Xy)
+    model_artifact = {
+        'model': artifacts['model'],
+        'features': features,
+        'interventions': intervention_names(df_factor_values),
+        'colnums': df_factor_values['colnum'].astype(int).tolist(),
+        'values': df_factor_values['value'].astype(float).tolist(),
+        'avg_dissatisfaction': artifacts['avg_dissatisfaction'],
+        'encoder': artifacts.get('encoder'), # shrunk ratios of the company, group and application (--target-encoding)
+        'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    model_file = Path(model_file)
+    model_file.parent.mkdir(exist_ok=True)
+    with open(model_file, 'wb') as f:
+        pickle.dump(model_artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    print("Model exported to", model_file)
+
+def load_model(model_file=default_model_file, pseudonyms_file=default_pseudonyms_file):
+    """ load the model artifact (once, before scoring), with the flattened tree (see flat_tree)
+        and the mapping tables of the pseudonyms of the extraction (for the encoded company, group and application)
+    """
+    with open(model_file, 'rb') as f:
+        model_artifact = pickle.load(f)
+    model_artifact['tree'] = flatten(model_artifact['model'])
+    model_artifact['pseudonyms'] = read_pseudonyms(pseudonyms_file)
+    return model_artifact
+
+def _number(values):
+    """ numeric values (missing values as nan) """
+    if values.dtype != object:
+        return values.astype(np.float64)
+    return np.array([np.nan if value is None or value == "" else float(value) for value in values], dtype=np.float64)
+
+def _reviewed(column, values):
+    """ values of a column after the value rules of the analysis (e.g. the merge of the rare close codes, see transform_incidents_upon_review_values) """
+    for rule_column, operation in value_operations():
+        if rule_column == column:
+            values = operation(values)
+    return values
+
+def _close_code(values):
+    """ close codes after the value rules """
+    return _reviewed('close_code', np.array(values, dtype=object))
+
+# features that are derived from a field of the database query as in transform_df_upon_db_retrieval (see transform_attributes.retrieval_features),
+# the reassignment count after the value rules (see transform_df_upon_review_values)
+derived_features = dict(retrieval_features)
+derived_features['reassignment_count'] = ('reassignment_count', lambda v: _reviewed('reassignment_count', v))
+numeric_fields = ['am_ttr', 'survey_response_value', 'reassignment_count'] # converted to numbers first (json or csv values)
+
+def ticket_columns(tickets):
+    """ columns of the tickets as arrays
+    Input: one ticket (dictionary field -> value), list of tickets or dataframe
+    Returns: dictionary field -> array, number of tickets
+    """
+    if isinstance(tickets, pd.DataFrame):
+        return {col: tickets[col].to_numpy() for col in tickets.columns}, len(tickets)
+    if isinstance(tickets, dict):
+        tickets = [tickets]
+    fields = {field for ticket in tickets for field in ticket}
+    columns = {}
+    for field in fields:
+        column = np.empty(len(tickets), dtype=object)
+        column[:] = [ticket.get(field) for ticket in tickets]
+        columns[field] = column
+    return columns, len(tickets)
+
+def ticket_dimensions(model_artifact, columns, dimensions, n):
+    """ pseudonymised company, group and application of the tickets, as in transform_df_upon_db_retrieval
+        the names of the database fields are replaced by the pseudonyms of the extraction (see pseudonymise.lookup_pseudonyms),
+        a column with pseudonyms (company, group, application) is used as it is
+    Input: model artifact (with the mapping tables), columns of the tickets (see ticket_columns), dimensions, number of tickets
+    Returns: dataframe with a column per dimension
+    """
+    df = pd.DataFrame(index=range(n))
+    pseudonyms = model_artifact.get('pseudonyms', {})
+    for field, (dimension, prefix) in anonymised_fields.items():
+        if dimension not in dimensions:
+            continue
+        if field in columns:
+            df[dimension] = lookup_pseudonyms(pd.Series(columns[field], dtype=object), prefix, pseudonyms.get(dimension, {}))
+        elif dimension in columns:
+            df[dimension] = columns[dimension]
+        else:
+            raise ValueError(f"the tickets do not contain the field {field} (or {dimension})")
+    return df
+
+def ticket_features(model_artifact, tickets):
+    """ feature matrix X of the tickets (same columns as the X the model was trained on)
+    Input: model artifact, tickets (see ticket_columns)
+    Returns: X (float32)
+    """
+    columns, n = ticket_columns(tickets)
+    X = np.empty((n, len(model_artifact['features'])), dtype=np.float32)
+    close_code = encoded = None
+    encoder = model_artifact.get('encoder')
+    for j, feature in enumerate(model_artifact['features']):
+        if encoder is not None and feature in [f"{dimension}_ratio" for dimension in encoder['dimensions']] and feature not in columns:
+            # shrunk ratio of the (pseudonymised) company, group and application of the tickets, see shrinkage.encode
+            if encoded is None:
+                encoded = encode(encoder, ticket_dimensions(model_artifact, columns, encoder['dimensions'], n))
+            X[:, j] = encoded[feature[:-len('_ratio')]]
+        elif feature in derived_features and derived_features[feature][0] in columns:
+            field, derive = derived_features[feature]
+            X[:, j] = derive(_number(columns[field]) if field in numeric_fields else columns[field])
+        elif feature.startswith('close_code_') and 'close_code' in columns:
+            if close_code is None:
+                close_code = _close_code(columns['close_code'])
+            X[:, j] = close_code == feature[len('close_code_'):]
+        elif feature in columns:  # flag as retrieved from the database (reopened, self_service, ...) or an already transformed value
+            X[:, j] = _number(columns[feature])
+        else:
+            raise ValueError(f"the tickets do not contain the field(s) for {feature}")
+    return X
+
+def score(model_artifact, tickets):
+    """ predict the dissatisfaction of the tickets and the change in dissatisfaction for every intervention
+    Input: model artifact, one ticket (dictionary) or micro-batch (list of dictionaries or dataframe)
+    Returns: list with a dictionary per ticket: dissatisfaction_proba and deltas (intervention -> delta)
+    """
+    X = ticket_features(model_artifact, tickets)
+    proba, deltas = predict_deltas(model_artifact.get('tree', model_artifact['model']), X, model_artifact['colnums'], model_artifact['values'])
+    names = model_artifact['interventions']
+    return [{'dissatisfaction_proba': float(p), 'deltas': dict(zip(names, d.tolist()))} for p, d in zip(proba, deltas)]
+
+def read_tickets(file):
+    """ read tickets from a csv file or a json lines file (one ticket per line, '-' for stdin) """
+    if str(file).endswith('.csv'):
+        return pd.read_csv(file)
+    lines = sys.stdin if str(file) == '-' else open(file)
+    return [json.loads(line) for line in lines if line.strip()]
+
+def scoring_handler(model_artifact):
+    """ request handler of the scoring service: POST /score with one ticket (json object) or a micro-batch (json list), GET /health
+        invalid tickets are answered with 400, a failure of the scoring with 500
+    """
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._reply(200, {'status': 'ok', 'model_created': model_artifact['created'], 'features': model_artifact['features']})
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self._reply(404, {'error': 'not found'})
+            try:
+                tickets = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not (isinstance(tickets, dict) or (isinstance(tickets, list) and len(tickets) > 0 and all(isinstance(ticket, dict) for ticket in tickets))):
+                    raise ValueError("the body is not a ticket (json object) or a list of tickets")
+                results = score(model_artifact, tickets)
+            except (ValueError, TypeError, KeyError, AttributeError) as e: # invalid json, tickets, fields or values
+                return self._reply(400, {'error': f"{type(e).__name__}: {e}"})
+            except Exception as e: # the scoring failed: the service keeps running
+                return self._reply(500, {'error': f"{type(e).__name__}: {e}"})
+            self._reply(200, results[0] if isinstance(tickets, dict) else results)
+
+        def log_message(self, format, *args):
+            pass # no logging per request
+
+    return ScoringHandler
+
+def serve(model_artifact, host="127.0.0.1", port=8000):
+    """ local HTTP stand-in of the scoring service (see scoring_handler) """
+    server = ThreadingHTTPServer((host, port), scoring_handler(model_artifact))
+    print(f"Scoring service on http://{host}:{port}/score")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Score tickets with the dissatisfaction model", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', default=str(default_model_file), help="model artifact exported by main.py --export-model")
+    parser.add_argument('--pseudonyms', default=str(default_pseudonyms_file), help="mapping tables of the pseudonyms of the extraction")
+    commands = parser.add_subparsers(dest='command', required=True)
+    score_parser = commands.add_parser('score', help="score the tickets of a file, write one json result per line")
+    score_parser.add_argument('tickets', help="csv file or json lines file with tickets in the schema of the database query ('-': stdin)")
+    serve_parser = commands.add_parser('serve', help="local HTTP stand-in of the scoring service")
+    serve_parser.add_argument('--host', default="127.0.0.1")
+    serve_parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    model_artifact = load_model(args.model, args.pseudonyms)
+    if args.command == 'score':
+        tickets = read_tickets(args.tickets)
+        start = time.perf_counter()
+        results = score(model_artifact, tickets)
+        elapsed = time.perf_counter() - start
+        for result in results:
+            print(json.dumps(result))
+        print(f"{len(results)} tickets scored in {elapsed*1000:.1f} ms", file=sys.stderr)
+    else:
+        serve(model_artifact, args.host, args.port)
@@ -0,0 +1,130 @@
+""" shrinkage:
+    Empirical Bayes dissatisfaction ratios for the factors with many values: company, group and application
+    - beta-binomial model: the ratio of every value varies around the ratio of its parent
+      (the average for a company, the company of a group, the group of an application)
+    - the prior strength (number of pseudo incidents) is estimated per level with the method of moments over all values of the level
+    - shrunk ratio = (dissatisfied + strength * parent ratio) / (total + strength): the values with few incidents move to their parent
+    - target encoding for the model: the shrunk ratio of the company, group and application of every incident,
+      computed out of fold (an incident is encoded with the counts of the other folds only: the model does not see its own response)
+    - everything is computed on counts per value and fold (additive, see cube.group_cube): one pass to count, one pass to encode
+Input:
+    - incidents with company, group, application and the response (or a cube with their counts)
+Output:
+    - shrunk ratio per company, group and application, encoded ratio per incident
+"""
+import numpy as np
+import pandas as pd
+
+from cube import group_cube, rollup
+
+hierarchy = ["company","group","application"]
+encoding_folds = 5
+
+def prior_strength(total, dissatisfied, prior):
+    """ method of moments estimate of the prior strength of a level
+        beta-binomial: Var(dissatisfied) = n p (1-p) (1 + (n-1) rho), with rho = 1 / (1 + strength)
+    Input: arrays with the total and dissatisfied count per value, ratio of the parent per value
+    Returns: strength (inf when the ratios do not vary more than by chance: the values get the ratio of their parent)
+    """
+    total, dissatisfied = np.asarray(total, dtype=np.float64), np.asarray(dissatisfied, dtype=np.float64)
+    prior = np.broadcast_to(np.asarray(prior, dtype=np.float64), total.shape)
+    valid = (total > 0) & (prior > 0) & (prior < 1)
+    n, d, p = total[valid], dissatisfied[valid], prior[valid]
+    pairs = np.sum(n * (n - 1))
+    if pairs <= 0:
+        return np.inf
+    rho = (np.sum((d - n * p)**2 / (p * (1 - p))) - np.sum(n)) / pairs
+    return max(1 / rho - 1, 0) if rho > 0 else np.inf
+
+def shrink(total, dissatisfied, prior, strength):
+    """ shrunk ratio: (dissatisfied + strength * prior) / (total + strength), the prior for values without incidents """
+    total, dissatisfied, prior = np.asarray(total, dtype=np.float64), np.asarray(dissatisfied, dtype=np.float64), np.asarray(prior, dtype=np.float64)
+    if np.isinf(strength):
+        return np.broadcast_to(prior, total.shape).copy()
+    return (dissatisfied + strength * prior) / np.maximum(total + strength, 1e-12)
+
+def hierarchical_ratios(cube, dimensions, response='user_dissatisfied'):
+    """ shrunk ratio for the values of the last dimension: every level is shrunk to the level above
+    Input: cube with 'count' and the sum of the response (see cube.group_cube), dimensions: first levels of the hierarchy
+    Returns: series indexed by the dimensions (as cube.rollup)
+    """
+    parent = cube[response].sum() / cube['count'].sum()
+    for level in range(1, len(dimensions) + 1):
+        counts = rollup(cube[['count', response]], dimensions[:level])
+        prior = parent if level == 1 else parent.reindex(counts.index.droplevel(-1)).to_numpy()
+        strength = prior_strength(counts['count'], counts[response], prior)
+        parent = pd.Series(shrink(counts['count'], counts[response], prior, strength), index=counts.index)
+    return parent
+
+def assign_folds(n, start=0, folds=encoding_folds):
+    """ fold per incident: round robin on the position of the incident (the same folds for all incidents and for their batches)
+    Input: number of incidents, position of the first incident (of a batch), number of folds
+    Returns: array with the fold per incident
+    """
+    return (start + np.arange(n)) % folds
+
+def _keys(df, dimensions):
+    """ dimension values as strings (a missing value is a value of its own) """
+    return df[dimensions].astype(str)
+
+def encoding_counts(df, fold, dimensions=hierarchy, response='user_dissatisfied'):
+    """ count the incidents and the dissatisfied responses per value of the hierarchy and fold
+        the counts of batches of incidents are added with cube.add_cubes
+    Input: dataframe with the incidents, fold per incident (see assign_folds), dimensions of the hierarchy
+    Returns: cube indexed by the dimensions and the fold
+    """
+    df_keys = _keys(df, dimensions)
+    df_keys['fold'] = fold
+    df_keys[response] = df[response].to_numpy()
+    return group_cube(df_keys, dimensions + ['fold'], [response])
+
+def create_encoder(counts, dimensions=hierarchy, folds=encoding_folds, response='user_dissatisfied'):
+    """ shrunk ratios per level of the hierarchy, on all incidents and out of fold
+        the out of fold ratio of fold f uses the counts of the other folds, shrunk to the out of fold ratio of the parent
+        (the prior strength of a level is estimated once, on all incidents)
+    Input: counts per value and fold (see encoding_counts), dimensions of the hierarchy, number of folds
+    Returns: dictionary with the dimensions, the prior strength per level and a table per level
+             (indexed by the dimensions of the level, column 'all' and a column per fold)
+    """
+    fold_totals = counts.groupby(level='fold').sum().reindex(range(folds), fill_value=0)
+    total, dissatisfied = fold_totals['count'].sum(), fold_totals[response].sum()
+    parent = pd.Series([dissatisfied / total] + list((dissatisfied - fold_totals[response]) / (total - fold_totals['count'])),
+                       index=['all'] + list(range(folds)))
+
+    levels, strengths = [], []
+    for level in range(1, len(dimensions) + 1):
+        level_counts = counts.groupby(level=dimensions[:level] + ['fold']).sum()
+        n = level_counts['count'].unstack('fold', fill_value=0).reindex(columns=range(folds), fill_value=0)
+        d = level_counts[response].unstack('fold', fill_value=0).reindex(columns=range(folds), fill_value=0)
+        n_all, d_all = n.sum(axis=1).to_numpy(), d.sum(axis=1).to_numpy()
+        prior = np.broadcast_to(parent.to_numpy(), (len(n), folds + 1)) if level == 1 else parent.reindex(n.index.droplevel(-1)).to_numpy()
+
+        strength = prior_strength(n_all, d_all, prior[:, 0])
+        table = pd.DataFrame(index=n.index)
+        table['all'] = shrink(n_all, d_all, prior[:, 0], strength)
+        for f in range(folds):
+            table[f] = shrink(n_all - n[f].to_numpy(), d_all - d[f].to_numpy(), prior[:, f+1], strength)
+        levels.append(table)
+        strengths.append(strength)
+        parent = table
+
+    return {'dimensions': dimensions, 'prior': float(dissatisfied / total), 'strengths': strengths, 'levels': levels}
+
+def encode(encoder, df, fold=None):
+    """ shrunk ratio of the company, group and application of every incident
+        values that are not in the encoder (e.g. new applications) get the ratio of their parent
+    Input: encoder (see create_encoder), dataframe with the incidents, fold per incident (out of fold ratios, None: ratios on all incidents)
+    Returns: dictionary dimension -> array with the ratio per incident
+    """
+    dimensions = encoder['dimensions']
+    df_keys = _keys(df, dimensions)
+    parent = np.full(len(df), encoder['prior'])
+    encoded = {}
+    for level, table in enumerate(encoder['levels']):
+        keys = df_keys[dimensions[0]] if level == 0 else pd.MultiIndex.from_frame(df_keys[dimensions[:level+1]])
+        rows = table.index.get_indexer(keys)
+        column = np.zeros(len(df), dtype=np.intp) if fold is None else np.asarray(fold) + 1 # 'all' is the first column
+        ratio = np.where(rows >= 0, table.to_numpy()[rows, column], parent)
+        encoded[dimensions[level]] = ratio
+        parent = ratio
+    return encoded
@@ -1,10 +1,10 @@
 """ stats:
-    Apply statistics on the incident tickets and store results in factors dataframe
+    Apply statistics on the incident tickets and store results in the factors registry (see factors.py)
 Input:
     - dataframe with incident tickets
-    - dataframe with factors 
+    - factors registry
 Output:
-    - factor dataframe
+    - factors registry
     - factor-values dataframe
 """
 
@@ -12,53 +12,136 @@ import pandas as pd
 import numpy as np
 import scipy.stats
 
-def chi2_stats(df: pd.DataFrame) -> pd.DataFrame :
-    """ apply chi2 statistic on the different columns of the incident tickets
-    Input: dataframe with incident tickets
-    Returns: new factors database
+from factors import create_factors, factors_of_type, by_chi
+
+# columns that describe the incident but are not analysed as factors
+date_columns = ['resolved_date_utc']
+key_columns = ['incident_number']  # identifies the incident in the stores (see incremental.refresh_store)
+non_factor_columns = date_columns + key_columns
+
+def contingency_tables(df, factors=None, tables=None, response='user_dissatisfied'):
+    """ count the responses for every value of the given factors (equivalent of pd.crosstab(df[fct], df[response]))
+        every factor is factorized to integer codes once and the counts for all factors are obtained in a single bincount
+        the tables are cached in 'tables': factors that were already counted are not counted again
+    Input: dataframe with incident tickets, factors (default: all columns except the response and the non factor columns), 
+           dictionary with the tables computed so far (cleared by the caller when the incident data changes)
+    Returns: dictionary factor -> dataframe with the counts (index: factor values, columns: response values)
     """
-    # analyse the df_factors: dataframe with all available columns
-    df_factors = pd.DataFrame(df.columns.values.tolist())
-    df_factors.columns=(['factor'])
-    df_factors['variable_type']="analyse"  # attribute to store the action: analyze, 
+    if tables is None:
+        tables = {}
+    if factors is None:
+        factors = [fct for fct in df.columns if fct != response and fct not in non_factor_columns]
+    factors = [fct for fct in factors if fct not in tables]
+    if len(factors) == 0:
+        return tables
+
+    y_codes, y_values = pd.factorize(df[response], sort=True)
+    n_responses = len(y_values)
+
+    # give every factor - value combination a unique cell number: (offset of the factor + value code) * number of responses + response code
+    cells = []
+    factor_values = []
+    offset = 0
+    for fct in factors:
+        codes, values = pd.factorize(df[fct], sort=True)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = np.asarray(values) # plain values, so that tables of dataframes with different categories can be combined
+        valid = (codes >= 0) & (y_codes >= 0) # ignore missing values, as crosstab does
+        cells.append((offset + codes[valid]) * n_responses + y_codes[valid])
+        factor_values.append(values)
+        offset += len(values)
 
-    # identify the data type for every of the df_factors
-    for fct in df_factors['factor']:
-        df_factors.loc[df_factors['factor']==fct,'dtype'] = df[fct].dtype
+    counts = np.bincount(np.concatenate(cells), minlength=offset*n_responses).reshape(offset, n_responses)
 
-    # identify the number of unique values for every of the factdors
-    for fct in df_factors['factor']:
-        df_factors.loc[df_factors['factor']==fct,'unique_values'] = df[fct].nunique()
+    # split the counts in a table per factor
+    offset = 0
+    for fct, values in zip(factors, factor_values):
+        ct = pd.DataFrame(counts[offset:offset+len(values)], index=pd.Index(values, name=fct), columns=pd.Index(y_values, name=response))
+        ct = ct.loc[ct.sum(axis=1)>0, ct.sum(axis=0)>0] # only keep the observed values
+        tables[fct] = ct
+        offset += len(values)
 
-    df_factors.loc[df_factors['factor']=="user_dissatisfied",'variable_type'] = 'response'
+    return tables
+
+def add_contingency_tables(tables, added):
+    """ add the counts of other contingency tables, e.g. to combine the tables of batches of incidents
+    Input: dictionary with the contingency tables, dictionary with the tables to add
+    Returns: dictionary with the combined tables (factors that are only in 'added' are included)
+    """
+    combined = dict(tables)
+    for fct, ct in added.items():
+        if fct in combined:
+            ct = combined[fct].add(ct, fill_value=0).fillna(0).astype('int64')
+            ct = ct.loc[ct.sum(axis=1)>0, ct.sum(axis=0)>0]
+        combined[fct] = ct
+    return combined
+
+def table_unique_values(tables, response='user_dissatisfied'):
+    """ number of unique values of the factors and of the response in the contingency tables (see chi2_stats)
+    Input: dictionary with the contingency tables
+    Returns: dictionary factor -> number of unique values
+    """
+    unique_values = {fct: len(ct) for fct, ct in tables.items()}
+    unique_values[response] = len(set().union(*(ct.columns for ct in tables.values())))
+    return unique_values
+
+def update_contingency_tables(tables, df_added, df_removed, response='user_dissatisfied'):
+    """ update the contingency tables for incidents that are added and incidents that are removed
+        instead of recounting all incidents
+    Input: dictionary with the contingency tables, dataframes with the added and removed incidents
+           (removed: expired incidents and the previous version of the incidents that are retrieved again, see incremental.refresh_store)
+    Returns: dictionary with the updated tables
+    """
+    factors = list(tables.keys())
+    added = contingency_tables(df_added, factors, response=response) if len(df_added) > 0 else {}
+    removed = contingency_tables(df_removed, factors, response=response) if len(df_removed) > 0 else {}
+
+    updated = {}
+    for fct, ct in tables.items():
+        if fct in added:
+            ct = ct.add(added[fct], fill_value=0)
+        if fct in removed:
+            ct = ct.sub(removed[fct], fill_value=0)
+        ct = ct.fillna(0).astype('int64')
+        updated[fct] = ct.loc[ct.sum(axis=1)>0, ct.sum(axis=0)>0]
+    return updated
+
+def chi2_stats(df: pd.DataFrame, tables=None, unique_values=None) -> dict :
+    """ apply chi2 statistic on the different columns of the incident tickets
+    Input: dataframe with incident tickets, optional cache with the contingency tables (see contingency_tables),
+           unique_values: number of unique values per column (default: counted in df, 
+           for the out-of-core analysis: df only contains the columns and the tables contain the counts of all incidents)
+    Returns: new factors registry (see factors.create_factors), ordered by descending chi
+    """
+    # register all available columns as factors, with their data type and number of unique values
+    factors = create_factors(df, unique_values, date_columns=date_columns, key_columns=key_columns)
 
     # for every of the factors: calculate the chi2 and p scores
     # to determine if the factor values are a differentiator
-    for fct in df_factors.loc[df_factors['variable_type']=="analyse",'factor']:
-        ct_cluster_satisfaction = pd.crosstab(df[fct],df['user_dissatisfied'])
-        chi, p, dof, expected  = scipy.stats.chi2_contingency(ct_cluster_satisfaction)
-        df_factors.loc[df_factors['factor']==fct,'chi'] = chi
-        df_factors.loc[df_factors['factor']==fct,'p'] = p
+    analysed = factors_of_type(factors, "analyse")
+    tables = contingency_tables(df, analysed, tables)
+    for fct in analysed:
+        factors[fct]['chi'], factors[fct]['p'] = scipy.stats.chi2_contingency(tables[fct])[:2]
     
-    # sort the factors so that the most differentiating factors are listed first
-    df_factors.sort_values(by='chi', ascending=False, inplace=True)
+    # order the factors so that the most differentiating factors are listed first
+    return {fct: factors[fct] for fct in by_chi(factors, factors)}
 
-    return df_factors
 
-
-def ratio_stats(df, df_factors):
+def ratio_stats(df, factors, tables=None):
     """ count the number of tickets for satisfied and dissatisfied responses
         for every of the given factors
         determine the ratio of dissatisfied responses
-    Input: dataframe with incident tickets, dataframe with the factors
+    Input: dataframe with incident tickets, factors registry, optional cache with the contingency tables
     Returns: dataframe with factor - value combinations
     """
 
     df_factor_values = pd.DataFrame()
 
     # for every factor - value combination, determine the satisfied dissatisfied counts and add to df_satisfaction
-    for fct in df_factors.loc[(df_factors['variable_type']=="analyse"),'factor']:
-        ct_cluster_satisfaction = pd.crosstab(df[fct],df['user_dissatisfied'])
+    analysed = factors_of_type(factors, "analyse")
+    tables = contingency_tables(df, analysed, tables)
+    for fct in analysed:
+        ct_cluster_satisfaction = tables[fct].copy()
         ct_cluster_satisfaction.columns=['satisfied_count','dissatisfied_count']
         ct_cluster_satisfaction.index.name='value'
         ct_cluster_satisfaction['factor']=fct
@@ -71,18 +154,40 @@ def ratio_stats(df, df_factors):
 
     return(df_factor_values)
     
-def binom_stats(df, avg_dissatisfaction,alpha,minimum_dissatisfied):
+def benjamini_hochberg(pvalues):
+    """ Benjamini-Hochberg adjustment of p-values for multiple testing (controls the false discovery rate)
+    Input: array with p-values
+    Returns: array with adjusted p-values (same order)
+    """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    n = len(pvalues)
+    if n == 0:
+        return pvalues
+    order = np.argsort(pvalues)
+    adjusted = pvalues[order] * n / np.arange(1, n+1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1] # enforce monotonicity, starting from the largest p-value
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+def binom_stats(df, avg_dissatisfaction,alpha,minimum_dissatisfied,fdr=False):
     """ apply cumulative binomial statistic on every row of the dataframe
-    Input: dataframe for row for every application
-    Returns: dataframe with additional column "pvalue"
+        the p-values are computed for all rows at once: P(X >= dissatisfied count) = binom.sf(count-1, total count, p)
+        (identical to scipy.stats.binomtest with alternative='greater')
+    Input: dataframe for row for every application, fdr: flag relevance on the Benjamini-Hochberg adjusted p-values
+    Returns: dataframe with additional column "pvalue" (and "pvalue_adjusted" when fdr)
     """
 
-    df["pvalue"] = df.apply(lambda x: scipy.stats.binomtest(int(x["dissatisfied count"]), 
-                                                            int(x["total count"]), 
-                                                            p=avg_dissatisfaction, 
-                                                            alternative='greater').pvalue, axis=1)
+    k = df["dissatisfied count"].to_numpy(dtype=np.float64).astype(np.int64) # truncated as in binomtest(int(...))
+    n = df["total count"].to_numpy(dtype=np.float64).astype(np.int64)
+    df["pvalue"] = scipy.stats.binom.sf(k-1, n, avg_dissatisfaction)
+
+    pvalue = df["pvalue"]
+    if fdr:
+        df["pvalue_adjusted"] = benjamini_hochberg(df["pvalue"])
+        pvalue = df["pvalue_adjusted"]
 
     df["relevant"]=True
-    df.loc[df["pvalue"]>=alpha,"relevant"]=False
+    df.loc[pvalue>=alpha,"relevant"]=False
     df.loc[df["dissatisfied count"]<minimum_dissatisfied,"relevant"]=False
     return(df)
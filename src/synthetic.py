@@ -0,0 +1,105 @@
+""" synthetic:
+    Generate synthetic incident tickets at a multiple of the size of the csv files in the data folder (for benchmarks)
+    - the response (user_dissatisfied, user_responded) is sampled from its distribution in the csv file
+    - every other column (or group of related columns) is sampled from its distribution given the response:
+      the marginal distributions and the correlation of every factor with the response are kept,
+      while the combinations of factor values are new (the rows are not copies of the csv rows)
+    - company, group and application are sampled together (a group belongs to one company),
+      the number of groups and applications can be scaled by creating copies of them
+Input:
+    - csv files with incidents (see incident_store.read_incidents), scale
+Output:
+    - dataframes (or csv files) with the same columns and data types as the csv files
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from incident_store import read_incidents, write_incidents
+
+# columns that are sampled together (the other columns are sampled on their own), the first column of a group is the response
+incident_columns = {
+    'response': ['user_dissatisfied'],
+    'groups': [['company', 'group', 'application'],  # hierarchy
+               ['contact_type', 'self_service'],
+               ['sla_breached', 'breached_reason_code'],
+               ['has_knowledge_article', 'kcs_solution']],
+}
+# all incidents: the factors are sampled given the survey response and the dissatisfaction (the response bias is kept, see propensity.py),
+# the groups of the incidents with a survey response apply when all incidents are retrieved with the same fields
+all_incident_columns = {
+    'response': ['user_responded', 'user_dissatisfied'],
+    'groups': incident_columns['groups'] + [['no resolution']],
+}
+
+def sample_given_response(df, n, response, groups, rng):
+    """ sample n rows: the response from its distribution, every column group from its distribution given the response
+    Input: dataframe, number of rows, response columns, list of column groups (sampled together), random generator
+    Returns: dataframe with n rows and the columns of df
+    """
+    grouped = [col for group in groups for col in group]
+    groups = groups + [[col] for col in df.columns if col not in response and col not in grouped]
+
+    # sample the response: positions of rows in df, the response of these rows is taken
+    positions = rng.integers(0, len(df), n)
+    codes, classes = pd.factorize(pd.MultiIndex.from_frame(df[response]))
+    sampled_codes = codes[positions]
+
+    columns = {col: df[col].to_numpy()[positions] for col in response}
+    for group in groups:
+        # every group of columns is taken from a random row with the same response
+        source = np.empty(n, dtype=np.int64)
+        for code in range(len(classes)):
+            rows = np.flatnonzero(codes == code)
+            target = np.flatnonzero(sampled_codes == code)
+            source[target] = rows[rng.integers(0, len(rows), len(target))]
+        for col in group:
+            columns[col] = df[col].to_numpy()[source]
+
+    return pd.DataFrame(columns, columns=df.columns).astype(df.dtypes.to_dict())
+
+def scale_hierarchy(df, copies, rng):
+    """ multiply the number of groups and applications: every row is assigned to one of the copies of its group and application
+    Input: dataframe with incidents, number of copies, random generator
+    Returns: dataframe with the renamed groups and applications (copy 0 keeps the original name)
+    """
+    if copies <= 1 or 'group' not in df.columns:
+        return df
+    copy = pd.Series(rng.integers(0, copies, len(df)), index=df.index)
+    suffix = np.where(copy > 0, "-" + copy.astype(str), "")
+    for col in ['group', 'application']:
+        df[col] = (df[col].astype(str) + suffix).astype('category')
+    return df
+
+def synthetic_incidents(csv_file, scale=1.0, hierarchy_scale=1, seed=0):
+    """ generate synthetic incidents with the columns and distributions of a csv file
+    Input: csv file with incidents (the incidents with survey responses or all incidents),
+           scale: number of rows as a multiple of the rows in the csv file
+           hierarchy_scale: number of groups and applications as a multiple of those in the csv file
+           seed: seed of the random generator
+    Returns: dataframe with typed columns
+    """
+    rng = np.random.default_rng(seed)
+    df = read_incidents(csv_file)
+    columns = all_incident_columns if 'user_responded' in df.columns else incident_columns
+    groups = [group for group in columns['groups'] if all(col in df.columns for col in group)]
+    df_synthetic = sample_given_response(df, int(round(len(df)*scale)), columns['response'], groups, rng)
+    return scale_hierarchy(df_synthetic, hierarchy_scale, rng)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generate synthetic incident files", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scale', type=float, default=10, help="number of incidents as a multiple of the incidents in the data folder")
+    parser.add_argument('--hierarchy-scale', type=int, default=1, help="number of groups and applications as a multiple of those in the data folder")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+    parser.add_argument('--output', default="synthetic", help="folder (in the data folder) to which the csv and Parquet files are written")
+    args = parser.parse_args()
+
+    data_dir = Path(__file__).parent.parent / "data"
+    output_dir = data_dir / args.output
+    output_dir.mkdir(exist_ok=True)
+    for name in ["incident_tickets", "all_incidents"]:
+        df = synthetic_incidents(data_dir / f"{name}.csv", args.scale, args.hierarchy_scale, args.seed)
+        write_incidents(df, output_dir / f"{name}.csv")
+        print(len(df), "synthetic incidents written to", output_dir / f"{name}.csv")
@@ -1,94 +1,86 @@
 """ transform_attributes:
     Modifies / transforms incident ticket dataframes at different stages of the review process
+    - the review steps are rules in rules.toml (see rules.py): thresholds and variable types of the factors, value rules
+      that are compiled into vectorized column operations
 Input:
     - dataframe with incident tickets
-    - dataframe with factors (list columns of interest)    
+    - factors registry (columns of interest, see factors.py)
+    - rules (default: rules.toml)
 Output:
-    - modified incident ticket and factor dataframes
+    - modified incident ticket dataframes and factors registry
 """
 import pandas as pd
 import numpy as np
+import scipy.sparse
 from stats import chi2_stats
-import random as random
+from factors import set_variable_type, factors_of_type, by_chi
+from pseudonymise import pseudonymise
+from rules import default_rules
 
-def transform_df_upon_db_retrieval (df):
-    """ transform dataframe as retrieved from the database
-    Input: dataframe with incident tickets
+# transformations of the ticket values that are shared with the scoring of new tickets (see scoring.ticket_features)
+max_days_to_resolve = default_rules['retrieval']['max_days_to_resolve']   # the time to resolve is truncated
+
+# columns derived from a field of the database query: column -> (field, function of the field values)
+# the functions apply to a dataframe column as well as to an array of ticket values (see scoring.ticket_features)
+retrieval_features = {
+    # time to resolve from seconds to days, truncated to 15 days
+    'days_to_resolve': ('am_ttr', lambda v: np.minimum(np.round(v/(24*3600)), max_days_to_resolve)),
+    # user is dissatisfied when survey response value is 1 or 2
+    'user_dissatisfied': ('survey_response_value', lambda v: (v < 3).astype('int')),
+    'sla_breached': ('sla_result', lambda v: (v == "Breached").astype('int')),
+    'caller_is_employee': ('caller_employee_type', lambda v: (v == "employees").astype('int')),
+    # all other priorities all bundled (VIP, Priority 2 and Priority 3)
+    'priority_is_4': ('sla_priority', lambda v: (v == "Priority 4").astype('int')),
+}
+
+# fields with the names of the company, assignment group and application: field -> (column with the pseudonyms, prefix)
+anonymised_fields = {
+    'assignment_group_company': ('company', "C"),
+    'assignment_group_name': ('group', "G"),
+    'ci_name': ('application', "A"),
+}
+
+def anonymise (df, column, new_column, prefix, pseudonyms):
+    """ replace the names in a column by stable pseudonyms (prefix + 5 digits, see pseudonymise)
+    Input: dataframe, column with the names, column for the pseudonyms, prefix, 
+           mapping table name -> pseudonym (pseudonyms for new names are added to the mapping table)
     Returns: modified dataframe
     """
-       
-    # Transorm time to resolve from seconds to days and truncate to 15 days
-    df['days_to_resolve']=np.round(df['am_ttr']/(24*3600)).astype('int')
-    df.loc[df['days_to_resolve']>15,'days_to_resolve']=15 
-    df.drop(columns='am_ttr', inplace=True) # drop time to resolve in seconds
-    
-    # user is dissatisfied when survey response value is 1 or 2
-    # code dissatisfied as 1
-    # drop the survey_response_value column
-    df['user_dissatisfied']=0
-    df.loc[df['survey_response_value']<3,'user_dissatisfied']=1
-    df = df.drop(columns='survey_response_value')
-
-    # sla_breached = 1 when sla_result == 'Breached'
-    df['sla_breached']=0
-    df.loc[df['sla_result']=="Breached",'sla_breached']=1
-    df = df.drop(columns='sla_result')
-
-    # caller_is_employee = 1 when caller_employee_type == 'employees'
-    df['caller_is_employee']=0
-    df.loc[df['caller_employee_type']=="employees",'caller_is_employee']=1
-    df = df.drop(columns='caller_employee_type')
-
-    # priority_4 = 1 when sla_priority == 'Priority 4', all other priorities all bundled (VIP, Priority 2 and Priority 3)
-    df['priority_is_4']=0
-    df.loc[df['sla_priority']=="Priority 4",'priority_is_4']=1
-    df = df.drop(columns='sla_priority')
-
-    # anonymise company
-    df["assignment_group_company"].fillna("None",inplace=True)   
-    companies = df["assignment_group_company"].unique()
-    df_companies = pd.DataFrame(data={"assignment_group_company":companies,"company":""})
-    df_companies["company"] = df_companies.apply(lambda x: "C"+str(random.randint(10000,99999)), axis=1)
-    df = pd.merge(df,df_companies, on="assignment_group_company")
-    df.drop(columns=["assignment_group_company"],inplace=True)
-
-    # anonymise assignment group
-    df["assignment_group_name"].fillna("None",inplace=True)
-    groups = df["assignment_group_name"].unique()
-    df_groups = pd.DataFrame(data={"assignment_group_name":groups,"group":""})
-    df_groups["group"] = df_groups.apply(lambda x: "G"+str(random.randint(10000,99999)), axis=1)
-    df = pd.merge(df,df_groups, on="assignment_group_name")
-    df.drop(columns=["assignment_group_name"],inplace=True)
-
-    # anonymise application name
-    df["ci_name"].fillna("None",inplace=True)
-    applications = df["ci_name"].unique()
-    df_applications = pd.DataFrame(data={"ci_name":applications,"application":""})
-    df_applications["application"] = df_applications.apply(lambda x: "A"+str(random.randint(10000,99999)), axis=1)
-    df = pd.merge(df,df_applications, on="ci_name")
-    df.drop(columns=["ci_name"],inplace=True)
+    df[new_column] = pseudonymise(df[column], prefix, pseudonyms)
+    return df.drop(columns=[column])
+
+def transform_df_upon_db_retrieval (df, pseudonyms=None):
+    """ transform dataframe as retrieved from the database (the transformations only depend on the row itself: can be applied per batch)
+    Input: dataframe with incident tickets, 
+           mapping tables column -> (name -> pseudonym) for the anonymisation of companies, groups and applications
+    Returns: modified dataframe
+    """
+
+    # derived columns coded as 0 / 1 (days for the time to resolve), the fields of the database query are dropped
+    for column, (field, derive) in retrieval_features.items():
+        df[column] = derive(df[field]).astype('int')
+        df = df.drop(columns=field)
+
+    # anonymise company, assignment group and application name
+    # the mapping tables are shared between the batches and the extractions: a name always gets the same pseudonym
+    if pseudonyms is None:
+        pseudonyms = {}
+    for field, (column, prefix) in anonymised_fields.items():
+        df = anonymise(df, field, column, prefix, pseudonyms.setdefault(column, {}))
     
     return df
 
-def transform_all_incidents_upon_db_retrieval (df):
-    """ transform dataframe as retrieved from the database
-    Input: dataframe with all incident tickets
+def transform_all_incidents_upon_db_retrieval (df, pseudonyms=None):
+    """ transform dataframe as retrieved from the database: the same transformations as for the incidents with a survey response
+        (see transform_df_upon_db_retrieval), with the columns user_responded and 'no resolution'
+    Input: dataframe with all incident tickets, mapping tables for the anonymisation (shared with the incidents with a survey response)
     Returns: modified dataframe
     """
-    
-    # Transorm time to resolve from seconds to days and truncate to 15 days
-    df['days_to_resolve']=np.round(df['am_ttr']/(24*3600)).astype('int')
-    df.loc[df['days_to_resolve']>15,'days_to_resolve']=15 
-    df.drop(columns='am_ttr', inplace=True) # drop time to resolve in seconds
-    
-    # user is dissatisfied when survey response value is 1 or 2
-    # code dissatisfied as 1
-    # drop the survey_response_value column
-    df['user_dissatisfied']=0
-    df.loc[df['survey_response_value']<3,'user_dissatisfied']=1
+
+    # user responded when a survey response value is given (user_dissatisfied is 0 for the incidents without a response)
     df['user_responded']=0
     df.loc[df['survey_response_value']>0,'user_responded']=1
-    df = df.drop(columns='survey_response_value')
+    df = transform_df_upon_db_retrieval(df, pseudonyms)
 
     df['no resolution']=0
     df.loc[df["close_code"].isin 
@@ -99,75 +91,228 @@ def transform_all_incidents_upon_db_retrieval (df):
         "Closed- Canceled",
         "Not Solved (not reproducible)",
         "Not Solved (Too Costly)"]),"no resolution"]=1
-    df = df.drop(columns="close_code")
     
     return df
 
-def transform_df_upon_chi2 (df_factors):
-    """ transform dataframe upon review of chi2 values
-    Input: dataframe with the factors (columns of interest)
-    Returns: modified factors dataframe
+def merge_values (series, values, new_value):
+    """ replace the given values by a new value
+        for a categorical column, the replaced values are also removed from the categories (so that no dummies are created for them)
+    Input: column, values to be replaced, new value
+    Returns: modified column
     """
-    # Ignore the factors for which the p value is greater than 5%
-    df_factors.loc[(df_factors['variable_type']=="analyse")&(df_factors['p']>0.05),"variable_type"] = "ignore"
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        if new_value not in series.cat.categories:
+            series = series.cat.add_categories([new_value])
+        series = series.mask(series.isin(values), new_value)
+        return series.cat.remove_unused_categories()
+
+    return series.mask(series.isin(values), new_value)
+
+def transform_df_upon_chi2 (factors, rules=default_rules):
+    """ transform the factors upon review of chi2 values
+    Input: factors registry (columns of interest), rules ([factors] thresholds)
+    Returns: modified factors registry
+    """
+    for fct in factors_of_type(factors, "analyse"):
+        # Ignore the factors for which the p value is greater than max_p (5%)
+        if factors[fct]['p'] > rules['factors']['max_p']:
+            set_variable_type(factors, fct, "ignore")
+
+        # Perform secondary analysis when number of values > max_unique_values (application, resolving group, ...)
+        elif factors[fct]['unique_values'] > rules['factors']['max_unique_values']:
+            set_variable_type(factors, fct, "analyse2")
+
+    return (factors)
 
-    # Perform secondary analysis when number of values > 20 (application, resolving group, ...)
-    df_factors.loc[(df_factors['variable_type']=="analyse")&(df_factors['unique_values']>20),"variable_type"] = "analyse2"  
+def value_operation (rule):
+    """ compile a value rule (see rules.py) into a vectorized operation on a column
+        clip: values above the limit are replaced by the limit, merge: the listed values are replaced by a new value
+    Input: value rule
+    Returns: function column (Series, or array for the scoring of new tickets) -> transformed column
+    """
+    if 'clip' in rule:
+        limit = rule['clip']
+        def clip(values):
+            return values.mask(values > limit, limit) if isinstance(values, pd.Series) else np.where(values > limit, limit, values)
+        return clip
 
-    return (df_factors)
+    def merge(values):
+        for new_value, old_values in rule['merge'].items():
+            values = merge_values(values, old_values, new_value) if isinstance(values, pd.Series) else np.where(np.isin(values, old_values), new_value, values)
+        return values
+    return merge
 
-def transform_df_upon_review_values (df_incidents, df_factors):
-    """ transform incident and factors dataframes upon review of the individual values
-    Input: dataframes with the incidents, dataframe with factors (columns of interest)
-    Returns: modified dataframes
+def value_operations (rules=default_rules):
+    """ the value rules compiled into operations (see value_operation), in the order of the rules
+    Returns: list of (column, operation)
     """
+    return [(rule['column'], value_operation(rule)) for rule in rules['values']]
 
-    # Limit reassignment count to given the low values for higher reassignment counts
-    df_incidents.loc[df_incidents['reassignment_count']>4,'reassignment_count']=4
+def transform_incidents_upon_review_values (df_incidents, rules=default_rules):
+    """ transform the incident values upon review of the individual values (only depends on the row itself: can be applied per batch)
+        e.g. limit the reassignment count, reclassify the close codes with less than 150 tickets
+    Input: dataframe with the incidents, rules ([[values]])
+    Returns: modified dataframe
+    """
+    for column, operation in value_operations(rules):
+        if column in df_incidents.columns:
+            df_incidents[column] = operation(df_incidents[column])
 
-    # Reclassify close codes with less than 150 tickets to 'Environmental Restoration'
-    df_incidents.loc[df_incidents['close_code'].isin(
-        ['Capacity Adjustment','Hardware Correction','Redundancy Activation']),'close_code']="Environmental Restoration"
+    return df_incidents
 
-    # plan assignment_group_company secondary analysis
-    df_factors.loc[(df_factors['factor']=="company"),"variable_type"] = "analyse2"
+def transform_factors_upon_review_values (factors, rules=default_rules):
+    """ select the factors for the subsequent analysis upon review of the individual values
+    Input: factors registry (columns of interest), rules ([factors] analyse2 and ignore)
+    Returns: modified factors registry
+    """
+    for fct in rules['factors'].get('analyse2', []):
+        set_variable_type(factors, fct, "analyse2")
 
-    # Ignore the ka_count_log for subsequent analysis given the lack of correlation with dissatisfaction
-    df_factors.loc[(df_factors['factor']=="ka_count_log"),"variable_type"] = "ignore"
+    for fct in rules['factors'].get('ignore', []):
+        set_variable_type(factors, fct, "ignore")
 
-    # Ignore the contact_type for subsequent analysis since 'self_service' is a better differentiator
-    df_factors.loc[(df_factors['factor']=="contact_type"),"variable_type"] = "ignore"
+    return factors
 
-    # Ignore the breached_reason_code for subsequent analysis since values are insufficiently differentiated or have low occurences
-    df_factors.loc[(df_factors['factor']=="breached_reason_code"),"variable_type"] = "ignore"
+def transform_df_upon_review_values (df_incidents, factors, rules=default_rules):
+    """ transform incident dataframe and factors upon review of the individual values
+    Input: dataframes with the incidents, factors registry (columns of interest), rules
+    Returns: modified dataframe and factors registry
+    """
+    return (transform_incidents_upon_review_values(df_incidents, rules), transform_factors_upon_review_values(factors, rules))
 
-    # Ignore the appl_tier for subsequent analysis since values are insufficiently differentiated or have low occurences
-    df_factors.loc[(df_factors['factor']=="appl_tier"),"variable_type"] = "ignore"
+def merged_close_codes (close_codes, rules=default_rules):
+    """ close codes after the value rules (e.g. the merge of the rare close codes, see transform_incidents_upon_review_values)
+    Input: close codes, rules
+    Returns: sorted list with the distinct close codes after the merge
+    """
+    merged = np.array(list(close_codes), dtype=object)
+    for column, operation in value_operations(rules):
+        if column == 'close_code':
+            merged = operation(merged)
+    return sorted(set(merged))
 
-    return (df_incidents, df_factors)
+def create_dummies (df_incidents, close_codes=None):
+    """ add a dummy column for every close code
+    Input: dataframe with the incidents, 
+           close_codes: all close codes (for batches of incidents that do not contain every close code, default: the categories of the column)
+    Returns: modified dataframe
+    """
+    close_code = df_incidents['close_code']
+    if close_codes is not None:
+        close_code = close_code.astype(pd.CategoricalDtype(close_codes))
+    return df_incidents.join(pd.get_dummies(close_code, prefix='close_code'))
 
+def add_dummy_factors (factors, dummy_factors):
+    """ add the factors of the dummy columns (see create_dummies) to the factors
+    Input: factors registry, chi2 statistics of the incidents with the dummy columns (see chi2_stats)
+    Returns: modified factors registry (the factors that were already registered keep their attributes)
+    """
+    set_variable_type(factors, "close_code", "one_hot_encoded")
+    for fct, attributes in dummy_factors.items():
+        if fct not in factors and fct.startswith("close_code_"):
+            attributes['one_hot'] = ("close_code", fct[len("close_code_"):]) # encoded column and value (see feature_matrix)
+        factors.setdefault(fct, attributes)
+    return factors
 
-def df_create_dummies (df_incidents, df_factors):
+def df_create_dummies (df_incidents, factors, tables=None):
     """ create dummy columns in df_incidents
-    Input: dataframe with the incidents, dataframe with the factors (columns of interest)
-    Returns: modified df_incident and df_factors dataframes
+    Input: dataframe with the incidents, factors registry (columns of interest), optional cache with the contingency tables
+    Returns: modified df_incident dataframe and factors registry
+    """
+    df_incidents = create_dummies(df_incidents)
+    factors = add_dummy_factors(factors, chi2_stats(df_incidents, tables))
+    return (df_incidents, factors)
+
+def add_encoded_factors (df_incidents, factors, encoded):
+    """ add the encoded ratios of the company, group and application (see shrinkage.encode) as columns and as factors of the model
+    Input: dataframe with the incidents, factors registry, dictionary dimension -> encoded ratio per incident
+    Returns: modified df_incident dataframe and factors registry (the factors that were already registered keep their attributes)
+    """
+    for dimension, ratio in encoded.items():
+        df_incidents[f"{dimension}_ratio"] = ratio
+        factors.setdefault(f"{dimension}_ratio", {'variable_type': 'encoded', 'dtype': ratio.dtype, 'unique_values': factors[dimension]['unique_values']})
+    return (df_incidents, factors)
+
+def compact_dtype (values):
+    """ smallest data type that holds the values of a column exactly (the tree compares the values as float32)
+    Input: array with the values
+    Returns: uint8 for flags, the smallest integer type for integer values (also when stored as float), float32 otherwise
+    """
+    if values.dtype == bool:
+        return np.dtype(np.uint8)
+    if len(values) > 0 and (values.dtype.kind in 'iu' or (values.dtype.kind == 'f' and np.all(values == np.round(values)))): # nan is not integer
+        for dtype in [np.uint8, np.int8, np.uint16, np.int16]:
+            if np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+def one_hot_codes (df_incidents, factors, X_columns):
+    """ the one hot encoded columns of X as codes of the encoded column (see add_dummy_factors)
+    Input: dataframe with the incidents, factors registry, columns of X
+    Returns: dictionary encoded column -> (columns numbers in X, code per incident: position of the value in these columns, -1 for other values)
     """
-    df_incidents = df_incidents.join(pd.get_dummies(df_incidents['close_code'], prefix='close_code'))
-    df_factors.loc[(df_factors['factor']=="close_code"),"variable_type"] = "one_hot_encoded"
-    df_factors = pd.concat([df_factors, chi2_stats(df_incidents)])
-    df_factors.drop_duplicates(subset='factor', keep='first', inplace=True)
-    df_factors.sort_values(by=['chi'],ascending=False,inplace=True)
-    return (df_incidents, df_factors)
+    encoded = {}
+    for colnum, fct in enumerate(X_columns):
+        if 'one_hot' in factors[fct]:
+            column, value = factors[fct]['one_hot']
+            encoded.setdefault(column, ([], []))
+            encoded[column][0].append(colnum)
+            encoded[column][1].append(value)
+    return {column: (np.array(colnums), pd.Categorical(df_incidents[column], categories=values).codes)
+            for column, (colnums, values) in encoded.items()}
+
+def feature_matrix (df_incidents, factors, X_columns, sparse=False):
+    """ feature matrix X of the incidents, without intermediate float64 or object arrays
+        the dummy columns of one hot encoded factors are set from the codes of the encoded column (e.g. close_code),
+        the incidents do not need the dummy columns
+    Input: dataframe with the incidents, factors registry, columns of X,
+           sparse: scipy.sparse CSC matrix (only the non zero values are stored, e.g. for factors with many one hot encoded values)
+    Returns: dense matrix in the smallest data type that holds all values (see compact_dtype) or sparse float32 matrix
+    """
+    n = len(df_incidents)
+    encoded = one_hot_codes(df_incidents, factors, X_columns)
+    one_hot_colnums = {colnum for colnums, codes in encoded.values() for colnum in colnums}
+    columns = {colnum: df_incidents[fct].to_numpy() for colnum, fct in enumerate(X_columns) if colnum not in one_hot_colnums}
+
+    if not sparse:
+        dtypes = [compact_dtype(values) for values in columns.values()] + ([np.dtype(np.uint8)] if encoded else [])
+        dtype = np.result_type(*dtypes) if dtypes else np.dtype(np.uint8)
+        X = np.zeros((n, len(X_columns)), dtype=np.float32 if dtype.kind == 'f' else dtype)
+        for colnum, values in columns.items():
+            X[:, colnum] = values
+        for colnums, codes in encoded.values():
+            rows = np.flatnonzero(codes >= 0)
+            X[rows, colnums[codes[rows]]] = 1
+        return X
+
+    # CSC: the row numbers and values of the non zero values, column by column
+    rows, data = [None] * len(X_columns), [None] * len(X_columns)
+    for colnum, values in columns.items():
+        rows[colnum] = np.flatnonzero(values) # missing values (nan) are stored
+        data[colnum] = values[rows[colnum]].astype(np.float32)
+    for colnums, codes in encoded.values():
+        order = np.argsort(codes, kind='stable') # the incidents grouped per value
+        counts = np.bincount(codes[codes >= 0], minlength=len(colnums))
+        starts = np.concatenate([[0], np.cumsum(counts)]) + np.count_nonzero(codes < 0)
+        for i, colnum in enumerate(colnums):
+            rows[colnum] = order[starts[i]:starts[i+1]]
+            data[colnum] = np.ones(counts[i], dtype=np.float32)
+    indptr = np.concatenate([[0], np.cumsum([len(column_rows) for column_rows in rows])])
+    return scipy.sparse.csc_matrix((np.concatenate(data), np.concatenate(rows), indptr), shape=(n, len(X_columns)))
+
+def model_columns (factors):
+    """ columns of X: the factors identified as 'analyse' (the most differentiating factors first), followed by the 'encoded' factors """
+    return by_chi(factors, factors_of_type(factors, 'analyse')) + factors_of_type(factors, 'encoded')
 
-def create_Xy (df_incidents, df_factors):
-    """ subset the columns of df_incidents to those identified as 'analyse' in factors
-    Input: dataframe with the incidents, dataframe with the factors, maximum number of factors to consider
-    Returns: modified df_incident and df_factors dataframes
+def create_Xy (df_incidents, factors, sparse=False):
+    """ subset the columns of df_incidents to those identified as 'analyse' in factors, followed by the 'encoded' factors (see add_encoded_factors)
+    Input: dataframe with the incidents, factors registry, sparse: sparse X (see feature_matrix)
+    Returns: X, y and the columns of X (the most differentiating factors first)
     """
-    X_columns = df_factors[df_factors['variable_type']=='analyse'].factor
-    X = np.array(df_incidents[X_columns])
+    X_columns = model_columns(factors)
+    X = feature_matrix(df_incidents, factors, X_columns, sparse)
 
-    y_column = df_factors[df_factors['variable_type']=='response'].factor
+    y_column = factors_of_type(factors, 'response')
     y = np.array (df_incidents[y_column]).squeeze()
 
     return X, y, X_columns
\ No newline at end of file
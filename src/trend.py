@@ -0,0 +1,249 @@
+""" trend:
+    Trend report that highlights 'abnormal' increases in user dissatisfaction per company, group and application
+    - the incidents are counted per group and per period (week or month of the resolution date): two arrays groups x periods
+      with the total and the dissatisfied counts, stored next to the incident store
+    - the counts are updated with the change parts of the store (see incident_store.py, incremental.py), the change set of the
+      contingency counts: the added incidents are counted and added, the replaced and expired incidents are subtracted.
+      The store is counted again when it was written in full since the last update (full extraction with -d, import, compaction)
+    - every group and period is tested against the average dissatisfaction, for all groups and periods at once:
+        - binomial test: P(X >= dissatisfied count) for the total count of the period (as stats.binom_stats)
+        - CUSUM: cumulative log-likelihood ratio of a doubled dissatisfaction ratio, accumulated over the periods (sustained increases)
+    - an alert is raised for the groups that exceed either test in the most recent periods
+      (for the CUSUM: above the threshold and increased in the period)
+
+    to run: python trend.py (update the counts of the incident store and print the alerts)
+Input:
+    - incident store (Parquet) with the resolution dates (resolved_date_utc), average dissatisfaction
+Output:
+    - counts per group and period (<incident store>.trend_W.pkl, <incident store>.trend_M.pkl)
+    - alert report: one row per group and recent period with an alert
+"""
+import argparse
+import pickle
+import numpy as np
+import pandas as pd
+import scipy.stats
+from pathlib import Path
+
+from incident_store import store_file, store_columns, read_incident_batches, change_parts, read_part
+from stats import benjamini_hochberg
+
+date_column = 'resolved_date_utc'
+trend_dimensions = ["company","group","application"]
+cusum_eps = 1e-6 # bounds of the in-control dissatisfaction ratio of the CUSUM
+trend_levels = [["company"], ["company","group"], ["company","group","application"]] # levels of the alert report
+
+def trend_file(csv_file, freq):
+    """ pickle file with the counts per group and period of the store """
+    return Path(csv_file).with_suffix(f'.trend_{freq}.pkl')
+
+def period_counts(df, freq="W", dimensions=trend_dimensions, response='user_dissatisfied'):
+    """ count the incidents and the dissatisfied responses per group and period
+    Input: dataframe with incidents (with resolution date), period frequency ("W": weeks, "M": months), dimensions of the groups, response
+    Returns: dictionary with the groups (index), the first period and the arrays total and dissatisfied (groups x periods)
+    """
+    df = df[df[date_column].notna()]
+    if len(df) == 0: # no incidents (e.g. an empty store): no groups and periods
+        return {'freq': freq, 'groups': pd.MultiIndex.from_arrays([[]] * len(dimensions), names=dimensions),
+                'first_period': pd.Period(ordinal=0, freq=freq), 'total': np.zeros((0, 0), dtype=np.int32),
+                'dissatisfied': np.zeros((0, 0), dtype=np.int32)}
+    group_codes, groups = pd.MultiIndex.from_frame(df[dimensions].astype(str)).factorize()
+    groups = groups.set_names(dimensions)
+    ordinals = df[date_column].dt.to_period(freq).array.asi8
+    first = ordinals.min()
+    n_periods = ordinals.max() - first + 1
+
+    # one cell per group and period: group code * number of periods + period
+    cells = group_codes * n_periods + (ordinals - first)
+    shape = (len(groups), n_periods)
+    return {
+        'freq': freq,
+        'groups': groups,
+        'first_period': pd.Period(ordinal=first, freq=freq),
+        'total': np.bincount(cells, minlength=shape[0]*shape[1]).reshape(shape).astype(np.int32),
+        'dissatisfied': np.bincount(cells, weights=df[response].to_numpy(), minlength=shape[0]*shape[1]).reshape(shape).astype(np.int32),
+    }
+
+def add_period_counts(trends, added, sign=1):
+    """ add (or subtract) the counts of other incidents (e.g. the incidents of a change part of the store) to the counts per group and period
+        the arrays are extended with the new groups (rows) and periods (columns): the existing rows and columns keep their position
+    Input: counts per group and period (see period_counts, None: no counts yet), counts to add (same frequency),
+           sign: 1 to add the counts, -1 to subtract them (e.g. the replaced and expired incidents)
+    Returns: dictionary with the combined counts
+    """
+    if len(added['groups']) == 0:
+        return trends
+    if trends is None or len(trends['groups']) == 0:
+        return {**added, 'total': sign * added['total'], 'dissatisfied': sign * added['dissatisfied']}
+
+    groups = trends['groups'].append(added['groups'].difference(trends['groups'], sort=False))
+    first = min(trends['first_period'], added['first_period'])
+    last = max(trends['first_period'] + trends['total'].shape[1], added['first_period'] + added['total'].shape[1])
+    shape = (len(groups), (last - first).n)
+
+    combined = {'freq': trends['freq'], 'groups': groups, 'first_period': first}
+    for counts in ['total', 'dissatisfied']:
+        array = np.zeros(shape, dtype=np.int32)
+        for source, source_sign in [(trends, 1), (added, sign)]:
+            rows = groups.get_indexer(source['groups'])
+            start = (source['first_period'] - first).n
+            array[rows, start:start + source[counts].shape[1]] += source_sign * source[counts]
+        combined[counts] = array
+    return combined
+
+def drop_empty_counts(trends):
+    """ remove the groups without incidents and the first and last periods without incidents (e.g. after the incidents are expired)
+    Input: counts per group and period (see period_counts)
+    Returns: dictionary with the counts of the groups and periods with incidents
+    """
+    rows = np.flatnonzero(trends['total'].sum(axis=1) > 0)
+    periods = np.flatnonzero(trends['total'].sum(axis=0) > 0)
+    if len(periods) == 0:
+        return {**trends, 'groups': trends['groups'][:0], 'total': np.zeros((0, 0), dtype=np.int32), 'dissatisfied': np.zeros((0, 0), dtype=np.int32)}
+    columns = slice(periods[0], periods[-1] + 1)
+    return {**trends, 'groups': trends['groups'][rows], 'first_period': trends['first_period'] + int(periods[0]),
+            'total': trends['total'][rows, columns], 'dissatisfied': trends['dissatisfied'][rows, columns]}
+
+def read_trends(csv_file, freq):
+    """ read the counts per group and period of the store, None when there are no counts """
+    file = trend_file(csv_file, freq)
+    if not file.exists():
+        return None
+    with open(file, 'rb') as f:
+        return pickle.load(f)
+
+def store_version(csv_file):
+    """ size and modification time of the Parquet file of the store: changed when the store is written in full """
+    stat = store_file(csv_file).stat()
+    return (stat.st_size, stat.st_mtime_ns)
+
+def update_trends(csv_file, freqs=("W","M"), batch_size=1_000_000):
+    """ update the counts per group and period with the change parts of the store that are written since the last update
+        (see incremental.refresh_store): the added incidents are added, the replaced and expired incidents are subtracted
+        the store is counted again when there are no counts or when the store was written in full since the last update
+        the store is read in batches, with the columns of the counts only
+    Input: csv file of the store, period frequencies, number of incidents per batch
+    Returns: dictionary frequency -> counts per group and period (empty when the store has no resolution dates)
+    """
+    columns = [date_column, 'user_dissatisfied'] + trend_dimensions
+    if not set(columns).issubset(store_columns(csv_file, batch_size)):
+        return {}
+
+    version, parts = store_version(csv_file), change_parts(csv_file)
+    last_part = parts[-1] if parts else 0
+    counts = {freq: read_trends(csv_file, freq) for freq in freqs}
+    recount = [freq for freq in freqs if counts[freq] is None or counts[freq]['store'] != version or counts[freq]['part'] > last_part]
+    if recount: # the batches of the store include the change parts
+        empty = pd.DataFrame({col: pd.Series(dtype='datetime64[ns]' if col == date_column else 'int8') for col in columns})
+        counts.update({freq: period_counts(empty, freq) for freq in recount})
+        for df in read_incident_batches(csv_file, batch_size, columns):
+            for freq in recount:
+                counts[freq] = add_period_counts(counts[freq], period_counts(df, freq))
+
+    for freq in freqs:
+        applied = last_part if freq in recount else counts[freq]['part']
+        for part in [part for part in parts if part > applied]:
+            for kind, sign in [('added', 1), ('removed', -1)]:
+                df = read_part(csv_file, part, kind, columns)
+                if df is not None:
+                    counts[freq] = add_period_counts(counts[freq], period_counts(df, freq), sign)
+        counts[freq] = {**drop_empty_counts(counts[freq]), 'store': version, 'part': last_part}
+        with open(trend_file(csv_file, freq), 'wb') as f:
+            pickle.dump(counts[freq], f, protocol=pickle.HIGHEST_PROTOCOL)
+    return counts
+
+def rollup_counts(trends, level):
+    """ counts per period for a level of the group hierarchy (e.g. per company)
+    Input: counts per group and period (see period_counts), dimensions of the level
+    Returns: index of the level, arrays total and dissatisfied (level values x periods)
+    """
+    codes, index = trends['groups'].droplevel([dim for dim in trends['groups'].names if dim not in level]).factorize()
+    index = index.set_names(level)
+    totals, dissatisfied = [], []
+    for counts, result in [(trends['total'], totals), (trends['dissatisfied'], dissatisfied)]:
+        array = np.zeros((len(index), counts.shape[1]), dtype=np.int64)
+        np.add.at(array, codes, counts)
+        result.append(array)
+    return index, totals[0], dissatisfied[0]
+
+def cusum(total, dissatisfied, p0, ratio=2.0):
+    """ upper CUSUM of the dissatisfaction per group over the periods (binomial log-likelihood ratio, p1 = ratio * p0)
+        S(t) = max(0, S(t-1) + dissatisfied(t) * log(p1/p0) + (total(t) - dissatisfied(t)) * log((1-p1)/(1-p0)))
+        p0 is clipped to [eps, 1-eps]: a baseline of 0 (no dissatisfied responses) or 1 gives finite increments
+    Input: arrays total and dissatisfied (groups x periods), in-control dissatisfaction ratio p0, ratio of the out-of-control ratio
+    Returns: array with the CUSUM statistic (groups x periods)
+    """
+    p0 = min(max(p0, cusum_eps), 1 - cusum_eps)
+    p1 = min(ratio * p0, max(0.99, (1 + p0) / 2)) # p1 > p0, also for a p0 of 0.99 or more
+    increments = dissatisfied * np.log(p1/p0) + (total - dissatisfied) * np.log((1-p1)/(1-p0))
+    statistic = np.empty(increments.shape)
+    s = np.zeros(increments.shape[0])
+    for period in range(increments.shape[1]): # vectorised over the groups
+        s = np.maximum(0, s + increments[:, period])
+        statistic[:, period] = s
+    return statistic
+
+def trend_alerts(trends, baseline, alpha=0.05, minimum_dissatisfied=5, recent_periods=1, cusum_threshold=5.0, fdr=False):
+    """ test every group and period against the baseline and report the groups with an alert in the most recent periods
+    Input: counts per group and period (see period_counts), baseline: average dissatisfaction ratio,
+           alpha: significance level of the binomial test, minimum_dissatisfied: minimum number of dissatisfied responses for an alert,
+           recent_periods: number of most recent periods that are reported, cusum_threshold: CUSUM value that raises an alert,
+           fdr: adjust the p-values of the reported cells for multiple testing (Benjamini-Hochberg)
+    Returns: dataframe with one row per level value (company, group, application) and recent period with an alert
+    """
+    alerts = []
+    for level in trend_levels:
+        index, total, dissatisfied = rollup_counts(trends, level)
+        pvalue = scipy.stats.binom.sf(dissatisfied - 1, total, baseline) # P(X >= dissatisfied count), 1 for periods without incidents
+        statistic = cusum(total, dissatisfied, baseline)
+
+        # ratio of the preceding periods (all history before the recent periods)
+        recent = slice(max(total.shape[1] - recent_periods, 0), total.shape[1])
+        history_total = total[:, :recent.start].sum(axis=1)
+        history_ratio = np.divide(dissatisfied[:, :recent.start].sum(axis=1), history_total,
+                                  out=np.full(len(index), np.nan), where=history_total > 0)
+
+        rows, periods = np.nonzero(total[:, recent] > 0)
+        periods += recent.start
+        df = index[rows].to_frame(index=False)
+        df.insert(0, 'level', level[-1])
+        df['period'] = [str(trends['first_period'] + int(period)) for period in periods]
+        df['total count'] = total[rows, periods]
+        df['dissatisfied count'] = dissatisfied[rows, periods]
+        df['dissatisfaction%'] = df['dissatisfied count'] / df['total count']
+        df['previous dissatisfaction%'] = history_ratio[rows]
+        df['pvalue'] = pvalue[rows, periods]
+        df['cusum'] = statistic[rows, periods]
+        df['cusum_increase'] = statistic[rows, periods] - np.where(periods > 0, statistic[rows, periods-1], 0)
+        alerts.append(df)
+
+    df_alerts = pd.concat(alerts, ignore_index=True)
+    df_alerts = df_alerts[['level'] + trend_dimensions + [col for col in df_alerts.columns if col not in ['level'] + trend_dimensions]]
+    if fdr:
+        df_alerts['pvalue_adjusted'] = benjamini_hochberg(df_alerts['pvalue'])
+    pvalue = df_alerts['pvalue_adjusted'] if fdr else df_alerts['pvalue']
+    df_alerts['binomial_alert'] = (pvalue < alpha) & (df_alerts['dissatisfied count'] >= minimum_dissatisfied)
+    df_alerts['cusum_alert'] = (df_alerts['cusum'] > cusum_threshold) & (df_alerts['cusum_increase'] > 0) # above the threshold and still increasing
+    df_alerts = df_alerts[df_alerts['binomial_alert'] | df_alerts['cusum_alert']]
+    return df_alerts.sort_values(by=['period','pvalue','cusum'], ascending=[False,True,False]).reset_index(drop=True)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Trend report: abnormal increases of the dissatisfaction", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-incidents_fname', default="incident_tickets", help="CSV file with Incident data")
+    parser.add_argument('--freq', default="W", choices=["W","M"], help="periods: weeks or months")
+    parser.add_argument('--periods', type=int, default=1, help="number of most recent periods to report")
+    parser.add_argument('--baseline', type=float, default=None, help="average dissatisfaction ratio (default: ratio of all counted incidents)")
+    parser.add_argument('--fdr', help="adjust the p-values for multiple testing (Benjamini-Hochberg)", action='store_true')
+    args = parser.parse_args()
+
+    incident_file = Path(__file__).parent.parent / "data" / f"{args.incidents_fname}.csv"
+    counts = update_trends(incident_file, (args.freq,))
+    if not counts:
+        print("The incident store has no resolution dates:", incident_file)
+    else:
+        trends = counts[args.freq]
+        baseline = args.baseline or trends['dissatisfied'].sum() / trends['total'].sum()
+        df_alerts = trend_alerts(trends, baseline, recent_periods=args.periods, fdr=args.fdr)
+        print(f"{len(trends['groups'])} groups x {trends['total'].shape[1]} periods, baseline {baseline:.3f}")
+        print(df_alerts.to_string(index=False))
@@ -0,0 +1,75 @@
+""" test_bootstrap:
+    The bootstrap intervals (bootstrap.py) equal direct computations
+    - the sums of a replicate equal the predict_proba deltas of the refitted tree, the sums of batches equal the sums of all incidents
+    - the percentile intervals per company equal a hand computed example
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.tree import DecisionTreeClassifier
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bootstrap import (group_codes, replicate_seeds, fit_replicate, replicate_sums, add_sums, bootstrap_samples,
+                       bootstrap_deltas, percentile_interval, delta_intervals, group_intervals)
+
+def incidents(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([rng.integers(0, 10, n), rng.integers(0, 2, n), rng.integers(0, 3, n)]).astype(np.float32)
+    y = (rng.random(n) < 0.05 + 0.03 * X[:, 0] * X[:, 1]).astype(int)
+    df_groups = pd.DataFrame({'company': rng.choice(["C1", "C2"], n), 'group': rng.choice(["G1", "G2", "G3"], n)})
+    return X, y, df_groups
+
+def test_replicate_sums_equal_predict_proba():
+    X, y, df_groups = incidents()
+    model = DecisionTreeClassifier(max_depth=4, min_samples_leaf=20, random_state=0).fit(X, y)
+    colnums, values, report = [1, 2], [0, 1], [0]
+    seed = replicate_seeds(1)[0]
+    tree = fit_replicate(model.get_params(), X, y, seed)
+
+    # the replicate is the model refitted on the rows drawn with replacement
+    rows = np.random.default_rng(seed).integers(len(y), size=len(y))
+    refitted = DecisionTreeClassifier(**model.get_params()).fit(X[rows], y[rows])
+    proba = refitted.predict_proba(X)[:, 1]
+    deltas = []
+    for colnum, value in zip(colnums, values):
+        Z = X.copy()
+        Z[:, colnum] = value
+        deltas.append(refitted.predict_proba(Z)[:, 1] - proba)
+
+    codes, keys = group_codes(df_groups, ['company', 'group'])
+    sums = replicate_sums(tree, X, colnums, values, report, codes, len(keys))
+    np.testing.assert_allclose(sums['deltas'], [d.sum() for d in deltas])
+    expected = df_groups.assign(proba=proba, delta=deltas[0]).groupby(['company', 'group'])[['proba', 'delta']].sum()
+    np.testing.assert_allclose(sums['groups'], expected.loc[list(keys)].to_numpy())
+
+    # batches: the group numbers of the first batch are kept, the sums are added
+    batch_sums, batch_keys = None, None
+    for start in range(0, len(y), 1000):
+        batch = slice(start, start + 1000)
+        batch_codes, batch_keys = group_codes(df_groups[batch], ['company', 'group'], batch_keys)
+        batch_sums = add_sums(batch_sums, [replicate_sums(tree, X[batch], colnums, values, report, batch_codes, len(batch_keys))])
+    rows = batch_keys.get_indexer(keys)
+    np.testing.assert_allclose(batch_sums[0]['deltas'], sums['deltas'])
+    np.testing.assert_allclose(batch_sums[0]['groups'][rows], sums['groups'])
+
+def test_bootstrap_deltas_intervals():
+    X, y, df_groups = incidents()
+    model = DecisionTreeClassifier(max_depth=4, min_samples_leaf=20, random_state=0).fit(X, y)
+    samples = bootstrap_deltas(model, X, y, [1], [0], [0], df_groups, ['company', 'group'], ['proba', 'delta'], replicates=4, n_jobs=1)
+    assert samples['replicates'] == 4 and samples['deltas'].shape == (4, 1) and samples['n'] == len(y)
+    low, high = delta_intervals(samples)
+    np.testing.assert_allclose([low[0], high[0]], np.percentile(samples['deltas'][:, 0] / len(y), [5, 95]))
+
+def test_percentile_intervals():
+    np.testing.assert_allclose(percentile_interval(np.arange(101)), [5, 95])
+    # 2 replicates, company C1: (1 + 2) / 3 and (3 + 4) / 3, company C2: 3 / 3 and 6 / 3
+    keys = pd.MultiIndex.from_tuples([("C1", "G1"), ("C1", "G2"), ("C2", "G3")], names=['company', 'group'])
+    sums = [{'deltas': np.zeros(1), 'groups': np.array([[1.], [2.], [3.]])}, {'deltas': np.zeros(1), 'groups': np.array([[3.], [4.], [6.]])}]
+    samples = bootstrap_samples(sums, keys, np.array([1, 2, 3]), 6, ['dissatisfaction_proba'])
+    df = group_intervals(samples, ['company'])
+    np.testing.assert_allclose(df.loc["C1"], [1 + 0.05 * 4 / 3, 1 + 0.95 * 4 / 3])
+    np.testing.assert_allclose(df.loc["C2"], [1.05, 1.95])
+    assert list(df.columns) == ['dissatisfaction_proba low', 'dissatisfaction_proba high']
@@ -0,0 +1,49 @@
+""" test_diagnostics:
+    The calibration scorer and reports (diagnostics.py) equal their reference implementations
+    - decile_calibration_score (bincount) equals the pandas pivot of the original score function, integer weights equal repeated rows
+    - the decile calibration error of the calibration summary equals decile_calibration_error, brier_score equals sklearn
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.metrics import brier_score_loss
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from diagnostics import decile_calibration_score, decile_calibration_error, brier_score, calibration_table, calibration_summary
+
+def pivot_score(y_true, y_pred):
+    """ the original score function: sums per rounded dense percentile rank (pd.pivot_table) """
+    df_test = pd.DataFrame({'actual': y_true, 'prob': y_pred})
+    df_test['dissatisfaction_rank'] = (df_test['prob'].rank(pct=True, method='dense') * 10).round(0).astype('int')
+    pivot_test = pd.pivot_table(df_test, index=['dissatisfaction_rank'], values=['actual', 'prob'], aggfunc='sum')
+    return 1 / (pivot_test['prob'] - pivot_test['actual']).abs().mean()
+
+def predictions(kind, n=2000, seed=0):
+    """ responses and predictions: few unique values (the leaves of a tree) or continuous values """
+    rng = np.random.default_rng(seed)
+    y_pred = rng.choice([0.02, 0.05, 0.1, 0.2, 0.35, 0.6], n) if kind == 'leaves' else rng.beta(1, 8, n)
+    return (rng.random(n) < y_pred).astype(int), y_pred
+
+@pytest.mark.parametrize('kind', ['leaves', 'continuous'])
+def test_score_equals_pivot(kind):
+    y_true, y_pred = predictions(kind)
+    assert np.isclose(decile_calibration_score(y_true, y_pred), pivot_score(y_true, y_pred))
+
+def test_weights_equal_repeated_rows():
+    y_true, y_pred = predictions('leaves')
+    weight = np.random.default_rng(1).integers(1, 4, len(y_true))
+    rows = np.repeat(np.arange(len(y_true)), weight)
+    assert np.isclose(decile_calibration_error(y_true, y_pred, weight), decile_calibration_error(y_true[rows], y_pred[rows]))
+    assert np.isclose(brier_score(y_true, y_pred, weight), brier_score(y_true[rows], y_pred[rows]))
+
+def test_calibration_summary():
+    y_true, y_pred = predictions('leaves')
+    summary = calibration_summary(calibration_table(y_true, y_pred))
+    total = summary[summary['decile'] == 'all'].iloc[0]
+    assert np.isclose(total['difference'], decile_calibration_error(y_true, y_pred))
+    assert np.isclose(total['brier'], brier_score_loss(y_true, y_pred))
+    assert np.isclose(total['actual dissatisfaction%'], y_true.mean()) and np.isclose(total['predicted dissatisfaction%'], y_pred.mean())
@@ -0,0 +1,78 @@
+""" test_flat_tree:
+    The flattened tree (flat_tree.py) predicts as DecisionTreeClassifier.predict_proba
+    - predict for float, small integer, boolean and sparse matrices, with missing values
+    - predict_overrides equals predict_proba of X with the overridden column, for every override
+    - depth_probas equals the node at the depth on the decision path
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import scipy.sparse
+from sklearn.tree import DecisionTreeClassifier
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from flat_tree import flatten, predict, predict_overrides, depth_probas
+
+def fitted_tree(X, seed=0, max_depth=8):
+    """ tree on a response that depends on the first columns of X """
+    rng = np.random.default_rng(seed)
+    Xf = np.asarray(X, dtype=np.float64)
+    logit = np.nan_to_num(Xf[:, 0], nan=2) - np.nan_to_num(Xf[:, 1]) + 0.5 * np.nan_to_num(Xf[:, 2])
+    y = (rng.random(len(Xf)) < 1 / (1 + np.exp(-logit + 1))).astype(int)
+    return DecisionTreeClassifier(max_depth=max_depth, min_samples_leaf=5, random_state=seed).fit(Xf, y)
+
+def matrices(n=4000, seed=0):
+    """ the same kind of data as float, int8 and bool matrices """
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([rng.integers(0, 16, n), rng.integers(0, 2, n), rng.integers(0, 4, n), rng.integers(0, 2, n)]).astype(np.int8)
+    return {'float32': X.astype(np.float32), 'int8': X, 'bool': X[:, [1, 3]].astype(bool)}
+
+@pytest.mark.parametrize('kind', ['float32', 'int8', 'bool', 'sparse'])
+def test_predict_equals_predict_proba(kind):
+    X = matrices()['float32' if kind == 'sparse' else kind]
+    if kind == 'bool':
+        X = np.column_stack([X, X[:, :1]])
+    clf = fitted_tree(X)
+    expected = clf.predict_proba(np.asarray(X, dtype=np.float32))[:, 1]
+    X_input = scipy.sparse.csr_matrix(X) if kind == 'sparse' else X
+    np.testing.assert_array_equal(predict(clf, X_input), expected)
+    np.testing.assert_array_equal(predict(flatten(clf), X_input), expected)
+
+def test_predict_missing_values():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(4000, 4)).astype(np.float32)
+    X[rng.random(X.shape) < 0.1] = np.nan
+    clf = fitted_tree(X)
+    np.testing.assert_array_equal(predict(clf, X), clf.predict_proba(X)[:, 1])
+
+@pytest.mark.parametrize('kind', ['float32', 'int8', 'sparse'])
+def test_predict_overrides_equal_predict_proba(kind):
+    X = matrices()['float32' if kind == 'sparse' else kind]
+    clf = fitted_tree(X)
+    colnums, values = [0, 0, 1, 2, 3, 2], [0, 3.5, 1, 2, 0, 300] # a fraction and a value outside int8 for the int8 matrix
+    proba = predict_overrides(clf, scipy.sparse.csr_matrix(X) if kind == 'sparse' else X, colnums, values)
+    np.testing.assert_array_equal(proba[0], clf.predict_proba(X.astype(np.float32))[:, 1])
+    for i, (colnum, value) in enumerate(zip(colnums, values)):
+        Z = X.astype(np.float32)
+        Z[:, colnum] = value
+        np.testing.assert_array_equal(proba[i+1], clf.predict_proba(Z)[:, 1])
+
+def test_depth_probas_equal_decision_path():
+    X = matrices()['float32']
+    clf = fitted_tree(X)
+    path = clf.decision_path(X).toarray().astype(bool)
+    depth = np.zeros(clf.tree_.node_count, dtype=int)
+    for node in range(clf.tree_.node_count):
+        for child in [clf.tree_.children_left[node], clf.tree_.children_right[node]]:
+            if child >= 0:
+                depth[child] = depth[node] + 1
+    value = clf.tree_.value[:, 0, :]
+    node_proba = value[:, 1] / value.sum(axis=1)
+    probas = depth_probas(clf, X, [1, 3, 20])
+    for d, proba in probas.items():
+        # deepest node on the path with a depth of at most d
+        node = np.where(path & (depth <= d), np.arange(len(depth)), -1).max(axis=1)
+        np.testing.assert_allclose(proba, node_proba[node])
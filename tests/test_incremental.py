@@ -0,0 +1,62 @@
+""" test_incremental:
+    The refreshed stores and their contingency counts (incremental.refresh_store) equal a full extraction,
+    with survey responses that arrive after the refresh and incidents that are resolved again (sqlite stand-in, see extraction.py)
+    - the refresh writes a change part and leaves the csv file, a compaction writes the store and the csv file in full
+"""
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import incremental
+import pseudonymise
+from extraction import stand_in_incidents, stand_in_connect, write_stand_in, extract_incidents, refresh_concurrently
+from incident_store import change_files, read_incidents, read_incident_batches
+from incremental import read_counts
+from stats import contingency_tables
+
+@pytest.mark.parametrize('max_change_parts', [30, 1])
+def test_refresh_equals_full_extraction(tmp_path, monkeypatch, max_change_parts):
+    monkeypatch.setattr(pseudonymise, '_key', b"test key")
+    monkeypatch.setattr(incremental, 'max_change_parts', max_change_parts)
+    now = datetime.utcnow()
+    df = stand_in_incidents(5000)
+    df['resolved_date_utc'] = [(now - timedelta(days=2 + i % 300, seconds=i)).strftime('%Y-%m-%d %H:%M:%S') for i in range(len(df))]
+    db = tmp_path / "lake.db"
+    write_stand_in(db, df)
+    connect = stand_in_connect(db)
+    files = [tmp_path / "incident_tickets.csv", tmp_path / "all_incidents.csv"]
+    refresh_concurrently(*files, connect)
+
+    # survey responses for incidents resolved in the last 10 days, incidents that are reopened and resolved again
+    with sqlite3.connect(db) as conn:
+        conn.execute("update dm_incidentcube set survey_response_value = 1 where survey_response_value = 0 and resolved_date_utc > ?",
+                     ((now - timedelta(days=10)).strftime('%Y-%m-%d %H:%M:%S'),))
+        conn.execute("update dm_incidentcube set resolved_date_utc = ?, reassignment_count = reassignment_count + 1 where rowid % 97 = 0",
+                     (now.strftime('%Y-%m-%d %H:%M:%S'),))
+    conn.close()
+    csv_mtimes = [file.stat().st_mtime_ns for file in files]
+    refreshed = refresh_concurrently(*files, connect)
+    for file, mtime in zip(files, csv_mtimes):
+        # the refresh is written as a change part, the store and the csv file are written in full by the compaction only
+        assert (len(change_files(file)) > 0) == (max_change_parts > 1)
+        assert (file.stat().st_mtime_ns == mtime) == (max_change_parts > 1)
+
+    (tmp_path / "full").mkdir()
+    full = extract_incidents(tmp_path / "full" / "incident_tickets.csv", tmp_path / "full" / "all_incidents.csv", connect)
+    for df_refreshed, df_full, file, response in zip(refreshed, full, files, ['user_dissatisfied', 'user_responded']):
+        assert df_refreshed['incident_number'].is_unique
+        by_number = lambda df: df.sort_values('incident_number').reset_index(drop=True)[sorted(df_full.columns)].astype(str)
+        pd.testing.assert_frame_equal(by_number(df_refreshed), by_number(df_full))
+        pd.testing.assert_frame_equal(by_number(read_incidents(file)), by_number(df_full))
+        pd.testing.assert_frame_equal(by_number(pd.concat(read_incident_batches(file, 1000), ignore_index=True)), by_number(df_full))
+        tables, full_tables = read_counts(file), contingency_tables(df_full, response=response)
+        assert set(tables) == set(full_tables)
+        for fct in tables:
+            pd.testing.assert_frame_equal(tables[fct].sort_index(), full_tables[fct].sort_index(),
+                                          check_names=False, check_index_type=False, check_column_type=False, check_dtype=False)
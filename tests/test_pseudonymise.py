@@ -0,0 +1,40 @@
+""" test_pseudonymise:
+    The pseudonyms (pseudonymise.pseudonymise) are stable and unique, a full pseudonym space raises a ValueError instead of probing forever
+"""
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import pseudonymise
+from pseudonymise import pseudonymise as pseudonymise_names
+
+def test_stable_and_unique(monkeypatch):
+    monkeypatch.setattr(pseudonymise, '_key', b"test key")
+    names = pd.Series([f"group {i}" for i in range(2000)])
+    mapping = {}
+    pseudonyms = pseudonymise_names(names, "G", mapping)
+    assert len(set(pseudonyms)) == len(names) and all(p.startswith("G") and len(p) == 6 for p in pseudonyms)
+    assert list(pseudonymise_names(names, "G", {})) == list(pseudonyms) # same pseudonyms in another extraction
+    assert list(pseudonymise_names(names, "G", mapping)) == list(pseudonyms)
+
+def test_full_space(monkeypatch):
+    monkeypatch.setattr(pseudonymise, '_key', b"test key")
+    monkeypatch.setattr(pseudonymise, 'pseudonym_space', 10)
+    mapping = {}
+    # the collisions of the 10 names are resolved: every pseudonym of the space is used once
+    assert sorted(pseudonymise_names(pd.Series([f"group {i}" for i in range(10)]), "G", mapping)) == [f"G{10000 + i}" for i in range(10)]
+    with pytest.raises(ValueError, match="do not fit"):
+        pseudonymise_names(pd.Series(["group 10"]), "G", mapping)
+    assert len(mapping) == 10
+
+    # no free pseudonym within max_probes hashes
+    monkeypatch.setattr(pseudonymise, 'max_probes', 1)
+    mapping = {}
+    pseudonymise_names(pd.Series(["a"]), "G", mapping)
+    name = next(name for name in (f"group {i}" for i in range(100)) if pseudonymise.pseudonym(name, "G") in mapping.values())
+    with pytest.raises(ValueError, match="no free pseudonym"):
+        pseudonymise_names(pd.Series([name]), "G", mapping)
@@ -0,0 +1,87 @@
+""" test_scoring:
+    Scoring of tickets in the schema of the database query (scoring.py)
+    - the features of the tickets equal the columns of the extraction (transform_attributes.transform_df_upon_db_retrieval),
+      the encoded company, group and application use the pseudonyms of the extraction
+    - the scoring service answers invalid tickets with 400 and a failure of the scoring with 500
+"""
+import json
+import sys
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pytest
+from sklearn.tree import DecisionTreeClassifier
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import pseudonymise
+import scoring
+from extraction import stand_in_incidents
+from flat_tree import flatten
+from scoring import score, scoring_handler
+from shrinkage import assign_folds, encoding_counts, create_encoder, encode
+from transform_attributes import transform_df_upon_db_retrieval
+
+features = ['days_to_resolve', 'sla_breached', 'caller_is_employee', 'priority_is_4', 'reassignment_count', 'group_ratio']
+
+@pytest.fixture
+def artifact(monkeypatch):
+    """ model artifact of a tree on the extracted stand-in incidents, with the target encoding of the groups """
+    monkeypatch.setattr(pseudonymise, '_key', b"test key")
+    df_raw = stand_in_incidents(3000)
+    pseudonyms = {}
+    df = transform_df_upon_db_retrieval(df_raw.copy(), pseudonyms)
+    encoder = create_encoder(encoding_counts(df, assign_folds(len(df))))
+    X = df[features[:-1]].to_numpy(dtype=np.float32)
+    X = np.column_stack([X, encode(encoder, df)['group']]).astype(np.float32)
+    model = DecisionTreeClassifier(max_depth=6, random_state=0).fit(X, df['user_dissatisfied'])
+    model_artifact = {'model': model, 'tree': flatten(model), 'features': features, 'interventions': ['pred_sla_breached_0'],
+                      'colnums': [1], 'values': [0.0], 'avg_dissatisfaction': df['user_dissatisfied'].mean(), 'encoder': encoder,
+                      'pseudonyms': pseudonyms, 'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    return model_artifact, df_raw, X
+
+def test_tickets_scored_as_extracted(artifact):
+    model_artifact, df_raw, X = artifact
+    mapping = {dimension: dict(names) for dimension, names in model_artifact['pseudonyms'].items()}
+    # json tickets: the values are python objects, a new group gets the ratio of its company
+    tickets = json.loads(df_raw.to_json(orient='records'))
+    tickets[0]['assignment_group_name'] = "a new group"
+    results = score(model_artifact, tickets)
+    expected = model_artifact['model'].predict_proba(X)[:, 1]
+    np.testing.assert_allclose([result['dissatisfaction_proba'] for result in results[1:]], expected[1:], rtol=1e-6)
+    assert model_artifact['pseudonyms'] == mapping # the new names are not added to the mapping tables
+
+def post(port, body):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/score", data=body.encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+def test_service_errors(artifact, monkeypatch):
+    model_artifact, df_raw, X = artifact
+    server = ThreadingHTTPServer(("127.0.0.1", 0), scoring_handler(model_artifact))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        port = server.server_address[1]
+        ticket = json.loads(df_raw.iloc[:1].to_json(orient='records'))[0]
+        status, body = post(port, json.dumps(ticket))
+        assert status == 200 and 0 <= body['dissatisfaction_proba'] <= 1
+        for invalid in ["not json", '"a string"', "[1, 2]", "[]", json.dumps({'am_ttr': 10}),
+                        json.dumps({**ticket, 'am_ttr': "ten"}), json.dumps({**ticket, 'sla_result': None, 'reassignment_count': [1]})]:
+            status, body = post(port, invalid)
+            assert status == 400, invalid
+        def fail(*args):
+            raise RuntimeError("failure of the scoring")
+        monkeypatch.setattr(scoring, 'predict_deltas', fail)
+        status, body = post(port, json.dumps(ticket))
+        assert status == 500 and 'error' in body
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,52 @@
+""" test_shrinkage:
+    The empirical Bayes ratios and the target encoding (shrinkage.py) equal a hand computed example
+    - two companies of 10 incidents with 5 and 1 dissatisfied: average 0.3, prior strength 170/19 (method of moments),
+      shrunk ratios 146/360 and 70/360, the groups and applications do not vary more than by chance (their company's ratio)
+    - out of fold (2 folds): the counts of the other fold are shrunk to the out of fold average
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from shrinkage import prior_strength, encoding_counts, create_encoder, encode
+
+def incidents():
+    """ C1/G1/A1: fold 0 4 of 5 dissatisfied, fold 1 1 of 5; C2/G2/A2: fold 0 0 of 5, fold 1 1 of 5 """
+    return pd.DataFrame({
+        'company': ["C1"] * 10 + ["C2"] * 10,
+        'group': ["G1"] * 10 + ["G2"] * 10,
+        'application': ["A1"] * 10 + ["A2"] * 10,
+        'user_dissatisfied': [1, 1, 1, 1, 0] + [1, 0, 0, 0, 0] + [0, 0, 0, 0, 0] + [1, 0, 0, 0, 0],
+        'fold': [0] * 5 + [1] * 5 + [0] * 5 + [1] * 5,
+    })
+
+def test_prior_strength():
+    # rho = ((2^2 + 2^2) / 0.21 - 20) / (2 * 10 * 9) = 19/189, strength = 1/rho - 1
+    assert np.isclose(prior_strength([10, 10], [5, 1], 0.3), 170 / 19)
+    assert np.isinf(prior_strength([10, 10], [3, 3], 0.3)) # no more variation than by chance
+
+def test_encode_all_incidents():
+    df = incidents()
+    encoder = create_encoder(encoding_counts(df, df['fold'].to_numpy()), folds=2)
+    assert np.isclose(encoder['prior'], 0.3) and np.isclose(encoder['strengths'][0], 170 / 19)
+    assert np.isinf(encoder['strengths'][1]) and np.isinf(encoder['strengths'][2])
+
+    new = pd.DataFrame({'company': ["C1", "C2", "C1", "C3"], 'group': ["G1", "G2", "G9", "G9"], 'application': ["A1", "A2", "A9", "A9"]})
+    encoded = encode(encoder, new)
+    c1, c2 = 146 / 360, 70 / 360
+    np.testing.assert_allclose(encoded['company'], [c1, c2, c1, 0.3]) # a new company gets the average
+    np.testing.assert_allclose(encoded['group'], [c1, c2, c1, 0.3])    # a new group gets the ratio of its company
+    np.testing.assert_allclose(encoded['application'], [c1, c2, c1, 0.3])
+
+def test_encode_out_of_fold():
+    df = incidents()
+    encoder = create_encoder(encoding_counts(df, df['fold'].to_numpy()), folds=2)
+    encoded = encode(encoder, df, df['fold'].to_numpy())
+    # fold 0: counts of fold 1 (C1 1 of 5, C2 1 of 5) shrunk to 2/10, fold 1: counts of fold 0 (4 of 5, 0 of 5) shrunk to 4/10
+    expected = np.repeat([53 / 265, 144 / 265, 53 / 265, 68 / 265], 5)
+    for dimension in ['company', 'group', 'application']:
+        np.testing.assert_allclose(encoded[dimension], expected)
@@ -0,0 +1,72 @@
+""" test_stats:
+    The vectorised statistics of stats.py equal their reference implementations
+    - contingency_tables (single bincount) equals pd.crosstab per factor, also with missing values and categorical columns
+    - binom_stats (vectorised binom.sf) equals scipy.stats.binomtest per row, benjamini_hochberg equals known adjusted p-values
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from stats import contingency_tables, binom_stats, benjamini_hochberg
+
+def incidents(n=5000, seed=0):
+    """ incidents with a categorical, a text, an integer and a float factor (with missing values) """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'close_code': pd.Categorical(rng.choice(["Data Correction", "Reboot / Restart", "Software Correction", "unused"][:3], n),
+                                     categories=["Data Correction", "Reboot / Restart", "Software Correction", "unused"]),
+        'contact_type': rng.choice(["chat", "phone", None], n, p=[0.5, 0.45, 0.05]),
+        'reopened': rng.integers(0, 2, n),
+        'reassignment_count': np.where(rng.random(n) < 0.1, np.nan, rng.poisson(1, n)),
+        'incident_number': [f"INC{i:08d}" for i in range(n)],
+        'user_dissatisfied': rng.integers(0, 2, n),
+    })
+
+def test_contingency_tables_equal_crosstab():
+    df = incidents()
+    tables = contingency_tables(df)
+    assert set(tables) == {'close_code', 'contact_type', 'reopened', 'reassignment_count'} # not the incident number
+    for fct, ct in tables.items():
+        expected = pd.crosstab(df[fct], df['user_dissatisfied'])
+        # the tables hold the plain values that are observed (tables of stores with other categories can be combined)
+        expected = expected[expected.sum(axis=1) > 0]
+        expected.index = pd.Index(np.asarray(expected.index), name=fct)
+        pd.testing.assert_frame_equal(ct, expected, check_dtype=False, check_index_type=False, check_column_type=False)
+
+def test_contingency_tables_cached():
+    df = incidents()
+    tables = contingency_tables(df, ['reopened'])
+    reopened = tables['reopened']
+    tables = contingency_tables(df, ['reopened', 'contact_type'], tables)
+    assert tables['reopened'] is reopened and set(tables) == {'reopened', 'contact_type'}
+
+def test_binom_stats_equal_binomtest():
+    rng = np.random.default_rng(0)
+    total = rng.integers(0, 200, 300)
+    df = pd.DataFrame({'total count': total, 'dissatisfied count': rng.binomial(total, 0.15)})
+    df.loc[0, ['total count', 'dissatisfied count']] = [0, 0]
+    df.loc[1, ['total count', 'dissatisfied count']] = [50, 50]
+    df = binom_stats(df, 0.1, 0.05, 5)
+    expected = [scipy.stats.binomtest(int(k), int(n), 0.1, alternative='greater').pvalue if n > 0 else 1.0
+                for k, n in zip(df['dissatisfied count'], df['total count'])]
+    np.testing.assert_allclose(df['pvalue'], expected, rtol=1e-9, atol=1e-300)
+    assert (df['relevant'] == ((df['pvalue'] < 0.05) & (df['dissatisfied count'] >= 5))).all()
+
+def test_benjamini_hochberg():
+    # R: p.adjust(c(0.01, 0.04, 0.03, 0.005, 0.2, 0.5), method = "BH")
+    np.testing.assert_allclose(benjamini_hochberg([0.01, 0.04, 0.03, 0.005, 0.2, 0.5]), [0.03, 0.06, 0.06, 0.03, 0.24, 0.5])
+    np.testing.assert_allclose(benjamini_hochberg([0.9, 0.8]), [0.9, 0.9])
+    assert len(benjamini_hochberg([])) == 0
+    pvalues = np.random.default_rng(0).random(500) ** 3
+    np.testing.assert_allclose(benjamini_hochberg(pvalues), scipy.stats.false_discovery_control(pvalues))
+
+def test_binom_stats_fdr():
+    df = pd.DataFrame({'total count': [100, 100, 100, 100], 'dissatisfied count': [20, 17, 15, 10]})
+    df = binom_stats(df, 0.1, 0.05, 5, fdr=True)
+    np.testing.assert_allclose(df['pvalue_adjusted'], benjamini_hochberg(df['pvalue']))
+    assert (df['relevant'] == (df['pvalue_adjusted'] < 0.05)).all()
@@ -0,0 +1,138 @@
+""" test_trend:
+    The incremental trend counts (trend.update_trends) equal a full recount of the store
+    - an unsorted store counted in several batches gives the counts of one batch
+    - a second update without changes keeps the counts, a store that is written in full is counted again
+    - the change parts of a refresh (sqlite stand-in, see extraction.py) are applied: a late survey response,
+      an incident that is resolved again and expired incidents, a full extraction (-d) resets the counts
+    - the CUSUM is finite for a baseline of 0 or 1
+"""
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import pseudonymise
+from extraction import stand_in_incidents, stand_in_connect, write_stand_in, extract_incidents, refresh_concurrently
+from incident_store import write_incidents, read_incidents, change_parts
+from trend import update_trends, period_counts, trend_file, cusum, trend_alerts
+
+def store(n=10000, seed=0, start="2024-01-01"):
+    """ incidents with random (unsorted) resolution dates over a year """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'resolved_date_utc': pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, n), unit='s'),
+        'user_dissatisfied': rng.integers(0, 2, n),
+        'company': rng.choice(["C1", "C2", "C3"], n),
+        'group': rng.choice(["G1", "G2", "G3", "G4"], n),
+        'application': rng.choice(["A1", "A2"], n),
+    })
+
+def assert_same_counts(counts, df, freq):
+    """ the counts equal the counts of all incidents in one batch (the group order may differ) """
+    full = period_counts(df, freq)
+    rows = counts['groups'].get_indexer(full['groups'])
+    assert (rows >= 0).all() and len(counts['groups']) == len(full['groups'])
+    assert counts['first_period'] == full['first_period']
+    for array in ['total', 'dissatisfied']:
+        np.testing.assert_array_equal(counts[array][rows], full[array])
+    assert counts['total'].sum() == len(df)
+
+def test_batches_equal_one_batch(tmp_path):
+    df = store()
+    csv_file = tmp_path / "incidents.csv"
+    write_incidents(df, csv_file)
+    counts = update_trends(csv_file, batch_size=1000)
+    for freq in ["W", "M"]:
+        assert_same_counts(counts[freq], write_incidents(df, tmp_path / "copy.csv"), freq)
+
+def test_update_without_and_with_new_incidents(tmp_path):
+    df = store()
+    csv_file = tmp_path / "incidents.csv"
+    write_incidents(df, csv_file)
+    update_trends(csv_file, batch_size=1000)
+
+    # no change of the store: the counts are unchanged
+    counts = update_trends(csv_file, batch_size=1000)
+    assert_same_counts(counts["W"], df, "W")
+
+    # a store that is written in full is counted again
+    df_new = store(500, seed=1, start="2025-01-01")
+    df_all = pd.concat([df, df_new], ignore_index=True)
+    write_incidents(df_all, csv_file)
+    counts = update_trends(csv_file, batch_size=1000)
+    assert_same_counts(counts["W"], df_all, "W")
+    assert trend_file(csv_file, "W").exists()
+
+def stand_in(tmp_path, monkeypatch):
+    """ stand-in of the data lake with incidents resolved in the last 300 days, the incident store is refreshed once """
+    monkeypatch.setattr(pseudonymise, '_key', b"test key")
+    now = datetime.utcnow()
+    df = stand_in_incidents(5000)
+    df['resolved_date_utc'] = [(now - timedelta(days=2 + i % 300, seconds=i)).strftime('%Y-%m-%d %H:%M:%S') for i in range(len(df))]
+    db = tmp_path / "lake.db"
+    write_stand_in(db, df)
+    files = [tmp_path / "incident_tickets.csv", tmp_path / "all_incidents.csv"]
+    refresh_concurrently(*files, stand_in_connect(db))
+    update_trends(files[0])
+    return db, files, now
+
+def update_lake(db, statement, parameters):
+    with sqlite3.connect(db) as conn:
+        conn.execute(statement, parameters)
+    conn.close()
+
+def test_late_response(tmp_path, monkeypatch):
+    db, files, now = stand_in(tmp_path, monkeypatch)
+    # a dissatisfied response arrives for incidents without a response that were resolved in the last 10 days
+    update_lake(db, "update dm_incidentcube set survey_response_value = 1 where survey_response_value = 0 and resolved_date_utc > ?",
+                ((now - timedelta(days=10)).strftime('%Y-%m-%d %H:%M:%S'),))
+    refresh_concurrently(*files, stand_in_connect(db))
+    assert len(change_parts(files[0])) == 1
+    counts = update_trends(files[0])
+    for freq in ["W", "M"]:
+        assert_same_counts(counts[freq], read_incidents(files[0]), freq)
+
+def test_resolved_again(tmp_path, monkeypatch):
+    db, files, now = stand_in(tmp_path, monkeypatch)
+    # incidents that are reopened and resolved again are moved to the current period (counted once)
+    update_lake(db, "update dm_incidentcube set resolved_date_utc = ?, survey_response_value = 1 where rowid % 97 = 0",
+                (now.strftime('%Y-%m-%d %H:%M:%S'),))
+    refresh_concurrently(*files, stand_in_connect(db))
+    counts = update_trends(files[0])
+    for freq in ["W", "M"]:
+        assert_same_counts(counts[freq], read_incidents(files[0]), freq)
+
+def test_expired_and_full_extraction(tmp_path, monkeypatch):
+    db, files, now = stand_in(tmp_path, monkeypatch)
+    # the incidents resolved before a window of 200 days are expired and subtracted
+    refresh_concurrently(*files, stand_in_connect(db), window_days=200)
+    counts = update_trends(files[0])
+    df_store = read_incidents(files[0])
+    assert len(df_store) > 0 and df_store['resolved_date_utc'].min() > now - timedelta(days=200)
+    assert_same_counts(counts["W"], df_store, "W")
+
+    # a full extraction (-d) replaces the store: the counts are counted again
+    update_lake(db, "delete from dm_incidentcube where rowid % 2 = 0", ())
+    extract_incidents(*files, stand_in_connect(db), read=False)
+    counts = update_trends(files[0])
+    assert_same_counts(counts["W"], read_incidents(files[0]), "W")
+
+def test_cusum_degenerate_baseline():
+    total = np.array([[10, 10, 10], [10, 0, 10]])
+    dissatisfied = np.array([[0, 5, 10], [0, 0, 0]])
+    with np.errstate(all='raise'):
+        for p0 in [0.0, 1.0, 0.995]:
+            statistic = cusum(total, dissatisfied, p0)
+            assert np.isfinite(statistic).all() and (statistic >= 0).all()
+        # without dissatisfied responses in the baseline, every dissatisfied response increases the statistic
+        statistic = cusum(total, dissatisfied, 0.0)
+        assert statistic[0, 1] > 0 and statistic[0, 2] > statistic[0, 1] and (statistic[1] == 0).all()
+
+    # no dissatisfied incidents at all: no alerts
+    trends = period_counts(store().assign(user_dissatisfied=0), "M")
+    assert len(trend_alerts(trends, 0.0)) == 0